@@ -0,0 +1,153 @@
+import time, sqlite3
+from pathlib import Path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scans (
+	id INTEGER PRIMARY KEY,
+	started REAL NOT NULL,
+	finished REAL,
+	lines INTEGER
+);
+CREATE TABLE IF NOT EXISTS errors (
+	id INTEGER PRIMARY KEY,
+	task TEXT NOT NULL,
+	path TEXT NOT NULL,
+	type TEXT NOT NULL,
+	first_seen REAL NOT NULL,
+	last_seen REAL NOT NULL,
+	first_scan INTEGER NOT NULL,
+	last_scan INTEGER NOT NULL,
+	log_offset INTEGER,
+	scene_id INTEGER,
+	missing_scan INTEGER,
+	UNIQUE (task, path)
+);
+CREATE INDEX IF NOT EXISTS errors_path ON errors (path);
+CREATE INDEX IF NOT EXISTS errors_type ON errors (type);
+CREATE INDEX IF NOT EXISTS errors_first_scan ON errors (first_scan);
+CREATE INDEX IF NOT EXISTS errors_missing_scan ON errors (missing_scan);
+"""
+
+UPSERT_ERROR = """
+INSERT INTO errors (task, path, type, first_seen, last_seen, first_scan, last_scan, log_offset)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (task, path) DO UPDATE SET
+	type = excluded.type,
+	last_seen = excluded.last_seen,
+	last_scan = excluded.last_scan,
+	log_offset = excluded.log_offset
+"""
+
+INSERT_ERROR = """
+INSERT INTO errors (task, path, type, first_seen, last_seen, first_scan, last_scan, log_offset)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (task, path) DO NOTHING
+"""
+
+ERROR_COLUMNS = "task, path, type, first_seen, last_seen, log_offset, scene_id, missing_scan"
+
+class ErrorStore:
+	"""sqlite history of every error found in the stash log
+
+	each run of the log scanner is recorded as a scan, errors keep the scans they were first and last seen in
+	and the scan their file was found missing in, so changes between runs can be queried without reading the log
+	"""
+
+	def __init__(self, path):
+		self.path = Path(path)
+		self.db = sqlite3.connect(self.path)
+		self.db.row_factory = sqlite3.Row
+		self.db.executescript(SCHEMA)
+
+	def __repr__(self) -> str:
+		return f"<ErrorStore {self.path}>"
+
+	def close(self):
+		self.db.close()
+
+	def start_scan(self):
+		with self.db:
+			cursor = self.db.execute("INSERT INTO scans (started) VALUES (?)", (time.time(),))
+		return cursor.lastrowid
+
+	def finish_scan(self, scan_id, lines):
+		with self.db:
+			self.db.execute("UPDATE scans SET finished = ?, lines = ? WHERE id = ?", (time.time(), lines, scan_id))
+
+	def last_scan_id(self):
+		row = self.db.execute("SELECT MAX(id) FROM scans WHERE finished IS NOT NULL").fetchone()
+		return row[0]
+
+	def record(self, scan_id, results, overwrite=True):
+		"""upserts {task: {path: error}} results in a single transaction
+
+		with overwrite False existing errors are left untouched, used for errors from older rotated logs
+		"""
+		now = time.time()
+		rows = [
+			(task, file_path, error.get("type", ""), now, now, scan_id, scan_id, error.get("offset"))
+			for task, file_errors in results.items()
+			for file_path, error in file_errors.items()
+		]
+		with self.db:
+			self.db.executemany(UPSERT_ERROR if overwrite else INSERT_ERROR, rows)
+		return len(rows)
+
+	def update_presence(self, scan_id, paths, existing_paths):
+		"""marks files that no longer exist as missing from scan_id and clears files that came back"""
+		missing = [(scan_id, p) for p in paths if p not in existing_paths]
+		present = [(p,) for p in paths if p in existing_paths]
+		with self.db:
+			self.db.executemany("UPDATE errors SET missing_scan = ? WHERE path = ? AND missing_scan IS NULL", missing)
+			self.db.executemany("UPDATE errors SET missing_scan = NULL WHERE path = ? AND missing_scan IS NOT NULL", present)
+
+	def set_scene_ids(self, scene_ids):
+		"""stores resolved scene ids, scene_ids is a dict of {path: scene_id}"""
+		with self.db:
+			self.db.executemany("UPDATE errors SET scene_id = ? WHERE path = ?", [(s, p) for p, s in scene_ids.items()])
+
+	def paths(self, task=None):
+		if task:
+			return [r[0] for r in self.db.execute("SELECT path FROM errors WHERE task = ?", (task,))]
+		return [r[0] for r in self.db.execute("SELECT DISTINCT path FROM errors")]
+
+	def errors(self, task, include_missing=True):
+		"""errors for task as {path: error} in the same shape the log scanner produces"""
+		query = f"SELECT {ERROR_COLUMNS} FROM errors WHERE task = ?"
+		if not include_missing:
+			query += " AND missing_scan IS NULL"
+		return {row["path"]: self._to_error(row) for row in self.db.execute(query + " ORDER BY id", (task,))}
+
+	def new_errors(self, scan_id=None):
+		"""errors first seen in scan_id, defaults to the last finished scan"""
+		scan_id = scan_id or self.last_scan_id()
+		rows = self.db.execute(f"SELECT {ERROR_COLUMNS} FROM errors WHERE first_scan = ? ORDER BY id", (scan_id,))
+		return [self._to_error(row) for row in rows]
+
+	def disappeared_errors(self, scan_id=None):
+		"""errors whose file was found missing in scan_id, defaults to the last finished scan"""
+		scan_id = scan_id or self.last_scan_id()
+		rows = self.db.execute(f"SELECT {ERROR_COLUMNS} FROM errors WHERE missing_scan = ? ORDER BY id", (scan_id,))
+		return [self._to_error(row) for row in rows]
+
+	def counts(self):
+		rows = self.db.execute("SELECT task, type, COUNT(*) FROM errors WHERE missing_scan IS NULL GROUP BY task, type")
+		return [tuple(row) for row in rows]
+
+	def clear(self):
+		with self.db:
+			self.db.execute("DELETE FROM errors")
+			self.db.execute("DELETE FROM scans")
+
+	@staticmethod
+	def _to_error(row):
+		return {
+			"task": row["task"],
+			"file": row["path"],
+			"type": row["type"],
+			"first_seen": row["first_seen"],
+			"last_seen": row["last_seen"],
+			"offset": row["log_offset"],
+			"scene_id": row["scene_id"],
+			"missing": row["missing_scan"] is not None,
+		}
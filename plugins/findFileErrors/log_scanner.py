@@ -0,0 +1,398 @@
+import re, os, gzip, json, mmap, time, hashlib
+from pathlib import Path
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import stashapi.log as log
+
+try:
+	import fcntl
+except ModuleNotFoundError:
+	# windows
+	fcntl = None
+	import msvcrt
+
+def line_hash(raw_line):
+	return hashlib.sha1(raw_line).hexdigest()
+
+class LogCheckpoint:
+	"""position in the stash log that has already been scanned
+
+	saved as json next to the errors directory so a run only reads the bytes appended since the last run,
+	the inode and a hash of the last line read are kept to detect a rotated or truncated log
+	"""
+
+	def __init__(self, path, name):
+		self.path = Path(path)
+		self.name = name
+
+		self.log_path = None
+		self.inode = None
+		self.offset = 0
+		self.line_hash = None
+		self.line_length = 0
+
+		self.load()
+
+	def __repr__(self) -> str:
+		return f"<LogCheckpoint {self.name} ({self.log_path}:{self.offset})>"
+
+	def _read_all(self):
+		if not self.path.exists():
+			return {}
+		try:
+			return json.loads(self.path.read_text(encoding="utf-8"))
+		except (ValueError, OSError) as e:
+			log.warning(f"could not read log checkpoint {self.path}: {e}")
+			return {}
+
+	def load(self):
+		state = self._read_all().get(self.name, {})
+		self.log_path = state.get("log_path")
+		self.inode = state.get("inode")
+		self.offset = state.get("offset", 0)
+		self.line_hash = state.get("line_hash")
+		self.line_length = state.get("line_length", 0)
+
+	def save(self):
+		state = self._read_all()
+		state[self.name] = {
+			"log_path": self.log_path,
+			"inode": self.inode,
+			"offset": self.offset,
+			"line_hash": self.line_hash,
+			"line_length": self.line_length,
+		}
+		tmp_path = self.path.with_suffix(".tmp")
+		tmp_path.write_text(json.dumps(state, indent=2), encoding="utf-8")
+		os.replace(tmp_path, self.path)
+
+	def reset(self):
+		self.log_path = None
+		self.inode = None
+		self.offset = 0
+		self.line_hash = None
+		self.line_length = 0
+
+	def update(self, log_path, inode, offset, last_line=None):
+		self.log_path = str(log_path)
+		self.inode = inode
+		self.offset = offset
+		if last_line is not None:
+			self.line_hash = line_hash(last_line)
+			self.line_length = len(last_line)
+
+	def resume_offset(self, log_path, log_file, stat):
+		"""offset to continue reading log_file from, 0 if the log was replaced, rotated or truncated since the checkpoint"""
+		if not self.offset:
+			return 0
+		if self.log_path != str(log_path):
+			log.info(f"log file changed from {self.log_path} to {log_path}, reading from start")
+			return 0
+		if self.inode != stat.st_ino:
+			log.info(f"log file {log_path} was rotated since last run, reading from start")
+			return 0
+		if stat.st_size < self.offset:
+			log.info(f"log file {log_path} was truncated since last run, reading from start")
+			return 0
+		if self.line_hash:
+			log_file.seek(self.offset - self.line_length)
+			if line_hash(log_file.read(self.line_length)) != self.line_hash:
+				log.info(f"log file {log_path} was rewritten since last run, reading from start")
+				return 0
+		return self.offset
+
+class ScanLock:
+	"""exclusive lock held while the log is scanned and the checkpoint saved
+
+	the follower of a job and a task run by hand read the log from the same checkpoint, without the lock
+	both would read the same lines and the checkpoint saved last would win, the lock is released when
+	the process exits so a crashed scan never leaves it held
+	"""
+
+	def __init__(self, path):
+		self.path = Path(path)
+		self.file = None
+
+	def __repr__(self) -> str:
+		return f"<ScanLock {self.path}{' held' if self.file else ''}>"
+
+	def _lock(self, blocking):
+		if fcntl:
+			fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+			return
+		self.file.seek(0)
+		while True:
+			try:
+				msvcrt.locking(self.file.fileno(), msvcrt.LK_NBLCK, 1)
+				return
+			except OSError:
+				if not blocking:
+					raise
+				time.sleep(0.1)
+
+	def __enter__(self):
+		self.file = open(self.path, "a+b")
+		try:
+			self._lock(blocking=False)
+		except OSError:
+			log.info("waiting for another scan of the log to finish")
+			self._lock(blocking=True)
+		return self
+
+	def __exit__(self, *exc_info):
+		if not fcntl:
+			self.file.seek(0)
+			msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+		# closing the file releases a flock
+		self.file.close()
+		self.file = None
+
+def read_log_lines(log_path, checkpoint):
+	"""yields (offset, raw_line) for lines appended to the log since checkpoint, advancing the checkpoint past every line yielded
+
+	a trailing line without a newline is still being written by stash and is left for the next run
+	"""
+	with open(log_path, mode="rb") as log_file:
+		stat = os.fstat(log_file.fileno())
+		offset = checkpoint.resume_offset(log_path, log_file, stat)
+		if offset:
+			log.debug(f"resuming log scan at byte {offset} of {stat.st_size}")
+		log_file.seek(offset)
+
+		last_line = None
+		try:
+			for raw_line in log_file:
+				if not raw_line.endswith(b"\n"):
+					break
+				yield offset, raw_line
+				offset += len(raw_line)
+				last_line = raw_line
+		finally:
+			checkpoint.update(log_path, stat.st_ino, offset, last_line)
+
+def follow_log(log_path, checkpoint, is_running, poll_interval=2.0):
+	"""tail -f for the log, yields an iterator of the (offset, raw_line) pairs appended since the previous one every poll
+
+	stops once is_running() returns False, the log is read once more after that so lines written as the job ended are included,
+	each iterator must be consumed before asking for the next
+	"""
+	while True:
+		running = is_running()
+		yield read_log_lines(log_path, checkpoint)
+		if not running:
+			return
+		time.sleep(poll_interval)
+
+class ErrorClassifier:
+	"""matches one kind of error in the stash log
+
+	pattern is only run on lines containing the plain prefilter substring,
+	it must capture the errored path in a "file" group, the "type" group defaults to the classifier name
+	"""
+
+	def __init__(self, name, task, prefilter, pattern):
+		self.name = name
+		self.task = task
+		self.prefilter = prefilter
+		self.pattern = re.compile(pattern)
+
+	def __repr__(self) -> str:
+		return f"<ErrorClassifier {self.name}>"
+
+	def classify(self, line):
+		m = self.pattern.search(line)
+		if not m:
+			return None
+		error = m.groupdict()
+		if not error.get("type"):
+			error["type"] = self.name
+		return error
+
+ERROR_CLASSIFIERS = []
+
+def register_classifier(name, task, prefilter, pattern):
+	"""adds a classifier to the registry, classifiers are tried in registration order and the first match wins"""
+	classifier = ErrorClassifier(name, task, prefilter, pattern)
+	ERROR_CLASSIFIERS.append(classifier)
+	return classifier
+
+register_classifier("probe", "scan_errors", "FFProbe",
+	r'(?P<probe>FFProbe encountered an error with <(?P<file>.+)>)')
+register_classifier("transcode", "generate_errors", "error generating transcode",
+	r'error generating (?P<type>transcode):.+?ffmpeg.+?<.+?-i (?P<file>.+?) -(?:c:v|vf|map|f) ')
+register_classifier("sprite", "generate_errors", "error generating sprite",
+	r'error generating (?P<type>sprite):.+?ffmpeg.+?<.+?-i (?P<file>.+) -frames')
+register_classifier("phash", "generate_errors", "error generating phash",
+	r'error generating (?P<type>phash):.+?ffmpeg.+?<.+?-i (?P<file>.+) -frames')
+register_classifier("heatmap", "generate_errors", "error generating heatmap",
+	r'error generating (?P<type>heatmap):.+?(?P<file>(?:[A-Za-z]:)?[\\/].+?\.funscript)')
+# catch all for remaining generate tasks that run ffmpeg (screenshots, previews, ...)
+register_classifier("generate", "generate_errors", "error generating",
+	r'error generating (?P<type>\w+?):.+?ffmpeg.+?<.+?-i (?P<file>.+) -frames')
+
+class LogScanner:
+	"""sends every log line through the registered classifiers in a single pass"""
+
+	def __init__(self, classifiers=None, encoding="utf-8"):
+		self.classifiers = classifiers if classifiers is not None else ERROR_CLASSIFIERS
+		self.encoding = encoding
+		# group classifiers by prefilter so each substring is only checked once per line,
+		# prefilters are checked against the raw bytes so only candidate lines are decoded
+		self.prefilters = defaultdict(list)
+		for classifier in self.classifiers:
+			self.prefilters[classifier.prefilter.encode(encoding)].append(classifier)
+		self.lines = 0
+		self.matches = Counter()
+		self.elapsed = 0.0
+
+	def classify(self, raw_line):
+		line = None
+		for prefilter, classifiers in self.prefilters.items():
+			if prefilter not in raw_line:
+				continue
+			if line is None:
+				line = raw_line.decode(self.encoding, errors="replace")
+			for classifier in classifiers:
+				if error := classifier.classify(line):
+					return classifier, error
+		return None, None
+
+	def scan(self, lines, results=None):
+		"""classifies (offset, raw_line) pairs into results, a dict of {task: {path: error}} where later lines overwrite earlier ones"""
+		if results is None:
+			results = {}
+		for classifier in self.classifiers:
+			results.setdefault(classifier.task, {})
+
+		start = time.perf_counter()
+		for offset, raw_line in lines:
+			self.lines += 1
+			try:
+				classifier, error = self.classify(raw_line)
+			except Exception as e:
+				log.debug(f"error reading line {self.lines} of log file: {e}")
+				continue
+			if error:
+				self.matches[classifier.name] += 1
+				error["offset"] = offset
+				results[classifier.task][error["file"]] = error
+		self.elapsed += time.perf_counter() - start
+		return results
+
+	def add_counts(self, lines, matches):
+		"""adds line and match counts from a scanner that ran in another process"""
+		self.lines += lines
+		self.matches.update(matches)
+
+	def counts(self):
+		return self.lines, dict(self.matches)
+
+	def report(self):
+		rate = self.lines / self.elapsed if self.elapsed else 0
+		log.info(f"scanned {self.lines} lines in {self.elapsed:.2f}s ({rate:,.0f} lines/sec)")
+		for classifier in self.classifiers:
+			log.info(f"{classifier.name}: {self.matches[classifier.name]} matches")
+
+def merge_results(results, chunk_results):
+	"""merges results of a later part of the log, later errors for a path replace earlier ones"""
+	for task, file_errors in chunk_results.items():
+		results.setdefault(task, {}).update(file_errors)
+	return results
+
+def split_chunks(data, start, end, count):
+	"""splits data[start:end] into at most count (start, end) ranges that end on a newline"""
+	size = max((end - start) // count, 1)
+	chunks = []
+	chunk_start = start
+	while chunk_start < end:
+		newline = data.find(b"\n", min(chunk_start + size, end) - 1, end)
+		chunk_end = newline + 1 if newline != -1 else end
+		chunks.append((chunk_start, chunk_end))
+		chunk_start = chunk_end
+	return chunks
+
+def _mmap_lines(data, end):
+	offset = data.tell()
+	while offset < end:
+		raw_line = data.readline()
+		yield offset, raw_line
+		offset += len(raw_line)
+
+def _stream_lines(log_file):
+	offset = 0
+	for raw_line in log_file:
+		yield offset, raw_line
+		offset += len(raw_line)
+
+def scan_chunk(log_path, start, end, encoding="utf-8"):
+	"""process pool worker, classifies the lines of log_path between byte start and end"""
+	scanner = LogScanner(encoding=encoding)
+	with open(log_path, mode="rb") as log_file:
+		with mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+			data.seek(start)
+			results = scanner.scan(_mmap_lines(data, end))
+	return results, *scanner.counts()
+
+def scan_archive(log_path, encoding="utf-8"):
+	"""process pool worker, classifies every line of a rotated log streaming it through gzip if compressed
+
+	offsets of errors found in a compressed log are positions in the decompressed stream
+	"""
+	scanner = LogScanner(encoding=encoding)
+	log_path = Path(log_path)
+	open_log = gzip.open if log_path.suffix == ".gz" else open
+	with open_log(log_path, mode="rb") as log_file:
+		results = scanner.scan(_stream_lines(log_file))
+	return results, *scanner.counts()
+
+def scan_log_parallel(log_path, checkpoint, scanner, results, workers):
+	"""memory maps the log and scans the part appended since the checkpoint in chunks across a process pool"""
+	start_time = time.perf_counter()
+	with open(log_path, mode="rb") as log_file:
+		stat = os.fstat(log_file.fileno())
+		offset = checkpoint.resume_offset(log_path, log_file, stat)
+		if stat.st_size == 0:
+			return results
+		with mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+			# only scan complete lines, a trailing partial line is left for the next run
+			end = data.rfind(b"\n", offset) + 1 or offset
+			chunks = split_chunks(data, offset, end, workers)
+			last_line = None
+			if end > offset:
+				newline = data.rfind(b"\n", offset, end - 1)
+				last_line = data[newline + 1 if newline != -1 else offset:end]
+
+	log.debug(f"scanning bytes {offset}-{end} of log in {len(chunks)} chunks")
+	with ProcessPoolExecutor(max_workers=workers) as pool:
+		futures = [pool.submit(scan_chunk, log_path, chunk_start, chunk_end, scanner.encoding) for chunk_start, chunk_end in chunks]
+		# merge in log order so the last error seen for a path wins like a sequential scan
+		for future in futures:
+			chunk_results, lines, matches = future.result()
+			merge_results(results, chunk_results)
+			scanner.add_counts(lines, matches)
+
+	checkpoint.update(log_path, stat.st_ino, end, last_line)
+	scanner.elapsed += time.perf_counter() - start_time
+	return results
+
+def scan_archives(archive_paths, scanner, workers):
+	"""scans rotated logs one per worker, archive_paths should be ordered oldest to newest"""
+	results = {}
+	start_time = time.perf_counter()
+	with ProcessPoolExecutor(max_workers=workers) as pool:
+		futures = [pool.submit(scan_archive, str(path), scanner.encoding) for path in archive_paths]
+		for future in futures:
+			archive_results, lines, matches = future.result()
+			merge_results(results, archive_results)
+			scanner.add_counts(lines, matches)
+	scanner.elapsed += time.perf_counter() - start_time
+	return results
+
+def find_archives(log_path):
+	"""rotated copies of the log next to it (stash.log.1, stash.log.2.gz, ...), oldest first"""
+	log_path = Path(log_path)
+	# only numbered rotations, not files like stash.log.tmp or stash.log.bak that share the prefix
+	rotation = re.compile(re.escape(log_path.name) + r"\.\d+(\.gz)?")
+	archives = [p for p in log_path.parent.glob(f"{log_path.name}.*") if rotation.fullmatch(p.name) and p.is_file()]
+	return sorted(archives, key=lambda p: p.stat().st_mtime)
@@ -1,124 +1,385 @@
-import re, sys, json
+import os, sys, json, time, hashlib, subprocess
 from pathlib import Path
+from collections import defaultdict
 from string import Template
 
 from stashapi.stashapp import StashInterface
 import stashapi.log as log
 
+from path_check import DirectoryCache
+from error_store import ErrorStore
+from log_scanner import LogCheckpoint, LogScanner, ScanLock, read_log_lines, follow_log, scan_log_parallel, scan_archives, find_archives
+
+# pyCommon is installed as its own plugin next to this one
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+try:
+	from pyCommon.instrument import instrument_run
+	from pyCommon.replay import record_run
+	from pyCommon.journal import Journal
+	from pyCommon.transport import AsyncTransport
+except ModuleNotFoundError:
+	instrument_run = record_run = Journal = AsyncTransport = None
+
 plugin_path = Path(__file__).parent
 
 txt_file_path = Path(plugin_path, "errors")
 txt_file_path.mkdir(exist_ok=True)
+checkpoint_path = Path(plugin_path, "log_checkpoint.json")
+# held while the log is scanned, a job follower and a task run by hand take turns
+scan_lock_path = Path(txt_file_path, "scan.lock")
+store_path = Path(txt_file_path, "errors.db")
+# scenes an interrupted tagging task already tagged
+journal_path = Path(txt_file_path, "tag_errors.journal")
 
 TAG_TEMPLATE = Template("[FileError] $error_type generation error")
 FILE_ENCODING = "utf-8"
+ERROR_TASKS = ["scan_errors", "generate_errors"]
+# unread log size above which the log is scanned in parallel chunks
+PARALLEL_MIN_BYTES = 64 * 1024 * 1024
+# folders listed concurrently when checking errored files still exist
+STAT_WORKERS = 16
+# seconds between checks for new log lines while following a job
+FOLLOW_INTERVAL = 2.0
+# seconds before the scene index is rebuilt to find scenes created by a running job
+INDEX_MAX_AGE = 60
+# scenes tagged per request, tagged scenes are journaled after every request
+TAG_BATCH_SIZE = 1000
+# tag requests sent at once when the pyCommon plugin is installed, 1 sends one request at a time
+REQUEST_CONCURRENCY = 4
+JOB_DONE_STATUSES = ["FINISHED", "CANCELLED", "FAILED"]
+
+dir_cache = DirectoryCache(STAT_WORKERS)
+# sends tag updates concurrently when pyCommon is installed, created on first use
+transport = None
+# set on startup when timings or requests are recorded, they also watch the transport
+instrument = recorder = None
+
+SCENE_FILES_QUERY = """
+SELECT scenes_files.scene_id, folders.path, files.basename
+FROM scenes_files
+JOIN files ON files.id = scenes_files.file_id
+JOIN folders ON folders.id = files.parent_folder_id
+"""
         
 def main():
-	global stash
+	global stash, store, instrument, recorder
 	
 	json_input = json.loads(sys.stdin.read())
 
 	stash = StashInterface(json_input["server_connection"])
+	if record_run:
+		recorder = record_run(stash, "findFileErrors")
+	if instrument_run and (instrument := instrument_run(stash, "findFileErrors", plugin_path)):
+		instrument.patch(sys.modules[__name__], "find_generate_errors", "find_scan_errors", "find_archived_errors", "scan_log_parallel", "export_results", "tag_scenes_with_file_errors")
+		instrument.patch(LogScanner, "scan")
+	store = ErrorStore(store_path)
 
 	MODE = json_input['args']['mode']
+	WORKERS = int(json_input['args'].get('workers') or os.cpu_count() or 1)
 	
 	if MODE == "scan_errors":
-		find_scan_errors()
+		find_scan_errors(WORKERS)
 	if MODE == "generate_errors":
-		file_errors = find_generate_errors()
+		file_errors = find_generate_errors(WORKERS)
+		tag_scenes_with_file_errors(file_errors)
+	if MODE == "archive_errors":
+		file_errors = find_archived_errors(WORKERS)
 		tag_scenes_with_file_errors(file_errors)
+	if MODE == "reset":
+		reset_error_history()
+	if MODE == "error_report":
+		report_errors()
 	if MODE == "scan_check":
-		stash.metadata_scan()
-		stash.run_plugin_task("findFileErrors", "Find Scan Errors")
-	# TODO
-	# if MODE == "generate_check":
-	# 	stash.metadata_generate()
-	# 	stash.run_plugin_task("findFileErrors", "generate_errors")
+		start_job_follower(stash.metadata_scan(), json_input)
+	if MODE == "generate_check":
+		start_job_follower(stash.metadata_generate(), json_input)
+	if MODE == "follow_job":
+		follow_job_errors(json_input['args']['job_id'])
 
+	if transport:
+		transport.close()
 	log.exit("ok")
 
-def find_scan_errors():
-	ffprobe_pattern = r'(?P<probe>FFProbe encountered an error with <(?P<file>.+)>)'
-	log_path = stash.get_configuration("general { logFile }")["general"]["logFile"]
-	
-	file_errors = {}
-	with open(log_path, mode="r", encoding=FILE_ENCODING) as log_file:
-		for i, line in enumerate(log_file):
-			try:
-				if m := re.search(ffprobe_pattern, line):
-					file_errors[m.group(2)] = m.groupdict()
-			except Exception as e:
-				log.debug(f"error reading line {i} of log file: {e}")
-
-	errors_path = Path(txt_file_path,"scan_errors.txt")
+def get_transport():
+	global transport
+	if transport is None and AsyncTransport and REQUEST_CONCURRENCY > 1:
+		# every request is one bulk update of up to TAG_BATCH_SIZE scenes, they are not merged further
+		transport = AsyncTransport(stash, concurrency=REQUEST_CONCURRENCY, batch_size=1)
+		if instrument:
+			instrument.watch_transport(transport)
+		if recorder:
+			recorder.watch_transport(transport)
+	return transport
+
+def get_log_path():
+	return stash.get_configuration("general { logFile }")["general"]["logFile"]
+
+def write_error_list(errors_path, file_paths):
 	with open(errors_path, "w", encoding=FILE_ENCODING) as error_log:
-		for file_path, match_dict in file_errors.items():
-			file_path = Path(file_path)
-			if not file_path.exists():
-				continue # ignore files that no longer exist
-			error_log.write(f"{file_path}\n")
+		for file_path in file_paths:
+			error_log.write(f"{Path(file_path)}\n")
 
-	log.info(f"found {len(file_errors)} files with errors logged to {errors_path}")
+def reset_error_history():
+	store.clear()
+	checkpoint_path.unlink(missing_ok=True)
+	journal_path.unlink(missing_ok=True)
+	log.info("cleared previous results, next run will read the whole log file")
 
-def find_generate_errors():
-	generate_pattern = r'error generating (?P<type>\w+?):.+?ffmpeg.+?<.+?-i (?P<file>.+) -frames'
-	log_path = stash.get_configuration("general { logFile }")["general"]["logFile"]
-	
-	# find errors in log file
-	file_errors = {}
-	with open(log_path, mode="r", encoding=FILE_ENCODING) as log_file:
-		for line in log_file:
-			m = re.search(generate_pattern, line)
-			if not m:
+def export_results(scan_id):
+	"""updates which errored files still exist and writes the text lists of those that do"""
+	paths = store.paths()
+	existing_paths = dir_cache.existing_paths(paths)
+	store.update_presence(scan_id, paths, existing_paths)
+	for task in ERROR_TASKS:
+		file_errors = store.errors(task, include_missing=False)
+		errors_path = Path(txt_file_path, f"{task}.txt")
+		write_error_list(errors_path, file_errors)
+		log.info(f"found {len(file_errors)} files with {task.replace('_', ' ')} logged to {errors_path}")
+
+def report_changes(scan_id=None):
+	new_errors = store.new_errors(scan_id)
+	disappeared_errors = store.disappeared_errors(scan_id)
+	log.info(f"{len(new_errors)} new errors, {len(disappeared_errors)} errored files no longer exist")
+	for error in new_errors:
+		log.info(f"new {error['type']} error: {error['file']}")
+	for error in disappeared_errors:
+		log.info(f"no longer exists: {error['file']}")
+
+def report_errors():
+	for task, error_type, count in store.counts():
+		log.info(f"{task.replace('_', ' ')}: {count} {error_type}")
+	report_changes()
+
+def find_log_errors(workers=1):
+	"""reads the lines appended to the log since the last run once, classifying them for every error task"""
+	log_path = get_log_path()
+	scanner = LogScanner(encoding=FILE_ENCODING)
+	scan_id = store.start_scan()
+
+	results = {task: {} for task in ERROR_TASKS}
+	with ScanLock(scan_lock_path):
+		# read under the lock, a follower may have moved the checkpoint while this task waited
+		checkpoint = LogCheckpoint(checkpoint_path, "log")
+		unread_bytes = Path(log_path).stat().st_size - checkpoint.offset
+		if workers > 1 and unread_bytes >= PARALLEL_MIN_BYTES:
+			log.info(f"scanning {unread_bytes / 1024**2:,.0f}MB of log using {workers} processes")
+			scan_log_parallel(log_path, checkpoint, scanner, results, workers)
+		else:
+			scanner.scan(read_log_lines(log_path, checkpoint), results)
+		store.record(scan_id, results)
+		checkpoint.save()
+	scanner.report()
+
+	export_results(scan_id)
+	store.finish_scan(scan_id, scanner.lines)
+	report_changes(scan_id)
+	return {task: store.errors(task) for task in ERROR_TASKS}
+
+def find_archived_errors(workers=1):
+	"""scans rotated copies of the log (including .gz) and adds errors not already found in the current log"""
+	log_path = get_log_path()
+	archives = find_archives(log_path)
+	if not archives:
+		log.info(f"no rotated log files found next to {log_path}")
+		return {}
+	log.info(f"scanning {len(archives)} rotated log files using {min(workers, len(archives))} processes")
+
+	scanner = LogScanner(encoding=FILE_ENCODING)
+	scan_id = store.start_scan()
+	with ScanLock(scan_lock_path):
+		archive_results = scan_archives(archives, scanner, workers)
+		# errors already found in the current log are newer than anything archived
+		store.record(scan_id, archive_results, overwrite=False)
+	scanner.report()
+
+	export_results(scan_id)
+	store.finish_scan(scan_id, scanner.lines)
+	report_changes(scan_id)
+	return store.errors("generate_errors")
+
+def find_scan_errors(workers=1):
+	return find_log_errors(workers)["scan_errors"]
+
+def find_generate_errors(workers=1):
+	return find_log_errors(workers)["generate_errors"]
+
+def index_scene_paths():
+	"""maps every scene file path, and the same path without its extension, to the ids of scenes using that file"""
+	rows = stash.sql_query(SCENE_FILES_QUERY).get("rows", [])
+	path_index = defaultdict(set)
+	stem_index = defaultdict(set)
+	for scene_id, folder_path, basename in rows:
+		file_path = os.path.join(folder_path, basename)
+		path_index[file_path].add(scene_id)
+		stem_index[os.path.splitext(file_path)[0]].add(scene_id)
+	log.debug(f"indexed {len(rows)} scene files")
+	return path_index, stem_index
+
+def find_scene_ids(file_path, path_index, stem_index):
+	file_path = os.path.normpath(file_path)
+	if scene_ids := path_index.get(file_path):
+		return scene_ids
+	# errors on sidecar files (funscripts) only share the path without extension with their scene
+	return stem_index.get(os.path.splitext(file_path)[0], set())
+
+class SceneTagger:
+	"""tags scenes whose files have errors, resolving paths through an in-memory index of scene files"""
+
+	def __init__(self):
+		self.path_index = None
+		self.stem_index = None
+		self.indexed_at = 0
+		self.tag_ids = {}
+		self.tagged_scene_ids = set()
+
+	def refresh(self):
+		self.path_index, self.stem_index = index_scene_paths()
+		self.indexed_at = time.time()
+
+	def resolve(self, file_path):
+		return find_scene_ids(file_path, self.path_index, self.stem_index)
+
+	def plan(self, file_errors):
+		"""the tags to add as a list of (tag name, tag id, sorted scene ids), tags that do not exist yet are created"""
+		if not file_errors:
+			return []
+		if self.path_index is None:
+			self.refresh()
+		elif time.time() - self.indexed_at > INDEX_MAX_AGE and not all(self.resolve(p) for p in file_errors):
+			# files may belong to scenes created since the index was built
+			self.refresh()
+
+		# group scenes by the tag they need so each tag is added with one bulk update
+		tag_scene_ids = defaultdict(set)
+		resolved_scene_ids = {}
+		for file_path, error_dict in file_errors.items():
+			scene_ids = self.resolve(file_path)
+			if len(scene_ids) != 1:
+				log.info(error_dict)
 				continue
-			file_errors[m.group(2)] = m.groupdict()
+			resolved_scene_ids[file_path] = next(iter(scene_ids))
+			tag_name = TAG_TEMPLATE.substitute(error_type=error_dict.get("type","").lower())
+			tag_scene_ids[tag_name].update(scene_ids)
+		store.set_scene_ids(resolved_scene_ids)
 
-	errors_path = Path(txt_file_path,"generate_errors.txt")
-	with open(errors_path, "w", encoding=FILE_ENCODING) as error_log:
-		for file_path, match_dict in file_errors.items():
-			file_path = Path(file_path)
-			if not file_path.exists():
-				continue # ignore files that no longer exist
-			error_log.write(f"{file_path}\n")
+		work = []
+		for tag_name, scene_ids in tag_scene_ids.items():
+			tag_id = self.tag_ids.get(tag_name)
+			if not tag_id:
+				tag_id = stash.find_tag(tag_name, create=True).get("id")
+				self.tag_ids[tag_name] = tag_id
+			work.append((tag_name, tag_id, sorted(scene_ids)))
+		return work
 
-	return file_errors
+	def tag(self, file_errors, progress=True, journal=None, work=None):
+		"""adds the error tags, scenes journaled as tagged with a tag by an interrupted run are skipped
+
+		work is the result of plan(file_errors) when it was already made
+		"""
+		if work is None:
+			work = self.plan(file_errors)
+		for i, (tag_name, tag_id, scene_ids) in enumerate(work):
+			if progress:
+				log.progress(i/len(work))
+			self.tagged_scene_ids.update(scene_ids)
+			# units are tag:scene so a scene with errors of two types is tagged with both
+			scene_ids = [s for s in scene_ids if journal is None or f"{tag_id}:{s}" not in journal]
+			if not scene_ids:
+				continue
+			log.info(f"adding {tag_name} to {len(scene_ids)} scenes")
+			chunks = [scene_ids[start:start + TAG_BATCH_SIZE] for start in range(0, len(scene_ids), TAG_BATCH_SIZE)]
+			updates = [{"ids": chunk, "tag_ids": { "ids": [tag_id], "mode": "ADD"}} for chunk in chunks]
+			if transport := get_transport():
+				results = transport.stream_mutations(("bulkSceneUpdate", update, "BulkSceneUpdateInput!") for update in updates)
+			else:
+				results = (stash.update_scenes(update) for update in updates)
+			for chunk, result in zip(chunks, results):
+				# a chunk stash answered without scenes is tagged again by the next run
+				if journal and result is not None:
+					journal.commit(f"{tag_id}:{s}" for s in chunk)
 
 def tag_scenes_with_file_errors(file_errors):
 
 	count = len(file_errors)
 	log.info(f"found {count} file errors looking for related scenes...")
 
-	tag_id_lookup = {}
-
-	# find scene in stash with file
-	scene_ids_with_errors = 0
-	for i, error_tuple in enumerate(file_errors.items()):
-		file_path, error_dict = error_tuple
-		log.progress(i/count)
-		file_path = Path(file_path)
-		scenes = stash.find_scenes({
-			"path": {
-				"value": f"{file_path}\"",
-				"modifier": "INCLUDES"
-			}
-		})
-		if len(scenes) != 1:
-			log.info(error_dict)
-			continue
-		scene_id = scenes[0]["id"]
-		tag_name = TAG_TEMPLATE.substitute(error_type=error_dict.get("type","").lower())
-		tag_id = tag_id_lookup.get(tag_name)
-		if not tag_id:
-			tag_id = stash.find_tag(tag_name, create=True).get("id")
-			tag_id_lookup[tag_name] = tag_id	
-		stash.update_scenes({
-			"ids": [scene_id],
-			"tag_ids": { "ids": [tag_id], "mode": "ADD"}
-		})
-		scene_ids_with_errors += 1
-
-	log.info(f"found and tagged {scene_ids_with_errors} scenes that had files with errors")
-		
+	tagger = SceneTagger()
+	work = tagger.plan(file_errors)
+	# adding a tag twice changes nothing, the journal saves the requests of scenes tagged before an interruption,
+	# it is keyed by the scenes to tag so a run with other errors starts over
+	journal = None
+	if Journal:
+		key = hashlib.sha1(json.dumps([[tag_id, scene_ids] for _, tag_id, scene_ids in work]).encode()).hexdigest()
+		journal = Journal(journal_path, key)
+		if journal.resumed:
+			log.info(f"resuming an interrupted run, {len(journal.done)} scene tags were already added")
+	tagger.tag(file_errors, journal=journal, work=work)
+	if journal:
+		journal.finish()
+
+	log.info(f"found and tagged {len(tagger.tagged_scene_ids)} scenes that had files with errors")
+
+def start_job_follower(job_id, json_input):
+	"""follows job_id from a detached copy of this plugin
+
+	stash runs queued jobs one at a time so this task has to exit before the job it queued can start
+	"""
+	follower_input = json.dumps({
+		"server_connection": json_input["server_connection"],
+		"args": {"mode": "follow_job", "job_id": job_id},
+	})
+	popen_kwargs = {}
+	if os.name == "nt":
+		popen_kwargs["creationflags"] = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+	else:
+		popen_kwargs["start_new_session"] = True
+
+	follow_log_path = Path(txt_file_path, "follow_job.log")
+	with open(follow_log_path, "w", encoding=FILE_ENCODING) as follow_log_file:
+		follower = subprocess.Popen(
+			[sys.executable, __file__],
+			stdin=subprocess.PIPE,
+			stdout=subprocess.DEVNULL,
+			stderr=follow_log_file,
+			**popen_kwargs
+		)
+	follower.stdin.write(follower_input.encode(FILE_ENCODING))
+	follower.stdin.close()
+	log.info(f"queued job {job_id}, errors will be tagged as they are logged, see {follow_log_path} for details")
+
+def follow_job_errors(job_id):
+	"""tails the log while stash job_id is queued or running, recording and tagging errors as they are logged"""
+	log_path = get_log_path()
+	checkpoint = LogCheckpoint(checkpoint_path, "log")
+	scanner = LogScanner(encoding=FILE_ENCODING)
+	tagger = SceneTagger()
+	scan_id = store.start_scan()
+
+	def job_running():
+		job = stash.find_job(job_id)
+		if not job:
+			return False
+		if job.get("progress") is not None:
+			log.progress(job["progress"])
+		return job["status"] not in JOB_DONE_STATUSES
+
+	log.info(f"following {log_path} until job {job_id} finishes")
+	for lines in follow_log(log_path, checkpoint, job_running, FOLLOW_INTERVAL):
+		with ScanLock(scan_lock_path):
+			# lines are read from the checkpoint on disk, a task run by hand may have scanned some since the last poll
+			checkpoint.load()
+			results = scanner.scan(lines, {task: {} for task in ERROR_TASKS})
+			if any(results.values()):
+				store.record(scan_id, results)
+			checkpoint.save()
+		if results["generate_errors"]:
+			tagger.tag(results["generate_errors"], progress=False)
+	scanner.report()
+
+	export_results(scan_id)
+	store.finish_scan(scan_id, scanner.lines)
+	report_changes(scan_id)
+	log.info(f"tagged {len(tagger.tagged_scene_ids)} scenes that had files with errors")
 
 if __name__ == '__main__':
 	main()
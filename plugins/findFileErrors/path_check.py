@@ -0,0 +1,58 @@
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import stashapi.log as log
+
+def list_directory(directory):
+	"""names in directory normalized for comparison, None if the directory could not be read"""
+	try:
+		with os.scandir(directory) as entries:
+			return {os.path.normcase(entry.name) for entry in entries}
+	except FileNotFoundError:
+		return set()
+	except OSError as e:
+		log.debug(f"could not list {directory}: {e}")
+		return None
+
+class DirectoryCache:
+	"""directory listings for the run so every folder is listed at most once
+
+	on network mounts a single scandir per folder is much cheaper than a stat per file,
+	folders are listed concurrently by a bounded thread pool
+	"""
+
+	def __init__(self, workers=16):
+		self.workers = workers
+		self.listings = {}
+
+	def __repr__(self) -> str:
+		return f"<DirectoryCache ({len(self.listings)} folders)>"
+
+	def prefetch(self, directories):
+		missing = [d for d in set(directories) if d not in self.listings]
+		if not missing:
+			return
+		with ThreadPoolExecutor(max_workers=min(self.workers, len(missing))) as pool:
+			for directory, names in zip(missing, pool.map(list_directory, missing)):
+				self.listings[directory] = names
+
+	def existing_paths(self, paths):
+		"""the subset of paths that exist on disk"""
+		by_directory = defaultdict(list)
+		for path in paths:
+			directory, name = os.path.split(os.path.normpath(path))
+			by_directory[directory].append((path, name))
+		self.prefetch(by_directory.keys())
+
+		existing = set()
+		for directory, entries in by_directory.items():
+			names = self.listings[directory]
+			for path, name in entries:
+				if names is None:
+					# unreadable folder, the file itself may still be accessible
+					if os.path.exists(path):
+						existing.add(path)
+				elif os.path.normcase(name) in names:
+					existing.add(path)
+		return existing
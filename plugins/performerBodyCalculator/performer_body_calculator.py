@@ -1,5 +1,6 @@
-import sys, json
+import sys, json, hashlib
 import logging as log
+from pathlib import Path
 from collections import defaultdict 
 
 try:
@@ -21,13 +22,65 @@ from performer_calculator import *
 from body_tags import *
 log.basicConfig(format="%(message)s", handlers=[StashLogHandler()], level=config.log_level)
 
+# pyCommon is installed as its own plugin next to this one
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+try:
+    from pyCommon.instrument import instrument_run
+    from pyCommon.replay import record_run
+    from pyCommon.journal import Journal
+    from pyCommon.transport import AsyncTransport
+except ModuleNotFoundError:
+    instrument_run = record_run = Journal = AsyncTransport = None
+
+# performers updated per request, updated performers are journaled after every request
+UPDATE_BATCH_SIZE = 1000
+# performers requested per page, only one page of performer details is held at a time
+PAGE_SIZE = 1000
+# pages and tag updates requested at once when the pyCommon plugin is installed, 1 sends one request at a time
+REQUEST_CONCURRENCY = 4
+
+FIND_PERFORMERS = """
+query FindPerformers($filter: FindFilterType, $performer_filter: PerformerFilterType) {
+    findPerformers(filter: $filter, performer_filter: $performer_filter) {
+        count
+        performers { %s }
+    }
+}
+"""
+
+# sends requests concurrently when pyCommon is installed, created on first use
+transport = None
+# set on startup when timings or requests are recorded, they also watch the transport
+instrument = recorder = None
+
 def main():
+    global instrument, recorder
+
+    if record_run:
+        recorder = record_run(stash, "performer_body_calculator")
+    if instrument_run and (instrument := instrument_run(stash, "performer_body_calculator", Path(__file__).parent)):
+        instrument.patch(sys.modules[__name__], "run_calculator", "enumtag_stash_init")
+        instrument.patch(StashPerformer, "__init__")
 
     if mode == "run_calculator":
         run_calculator()
     if mode == "destroy_managed_tags":
         destroy_managed_tags()
 
+    if transport:
+        transport.close()
+
+def get_transport():
+    global transport
+    if transport is None and AsyncTransport and REQUEST_CONCURRENCY > 1:
+        # every mutation is one bulk update of up to UPDATE_BATCH_SIZE performers, they are not merged further
+        transport = AsyncTransport(stash, concurrency=REQUEST_CONCURRENCY, batch_size=1)
+        if instrument:
+            instrument.watch_transport(transport)
+        if recorder:
+            recorder.watch_transport(transport)
+    return transport
+
 def destroy_managed_tags():
     tags = stash.find_tags(f={"description":{"value": "^\\[Managed By: PBC Plugin\\]","modifier": "MATCHES_REGEX"}}, fragment="id")
     log.info(f"Deleting {len(tags)} tags...")
@@ -42,30 +95,44 @@ def run_calculator():
     for enum_class in get_tag_classes():
         enumtag_stash_init(enum_class, all_tag_ids)
 
-    # get performers with measurements
-    performers = stash.find_performers(fragment=PERFORMER_FRAGMENT)
-    
-    log.info("Removing existing plugin tags...")
-    stash.update_performers({
-        "ids": [p["id"] for p in performers],
-        "tag_ids":{
-            "ids": all_tag_ids,
-            "mode": "REMOVE"
-        }
-    })
-
+    # only performers with measurements, weight or height are sent, a page at a time
+    total = stash.find_performers(filter={"per_page": 1}, fragment="id", get_count=True)[0]
+    digest = hashlib.sha1(json.dumps(all_tag_ids).encode())
+    count = parsed = 0
     log.info("Parsing Performers...")
-    for p in performers:
-        p_id = f"{p['name']} ({p['id']})"
-        try:
-            p = StashPerformer(p)
-            p.get_tag_updates(tag_updates)
-        except DebugException as e:
-            log.debug(f"{p_id}: {e}")
-        except WarningException as e:
-            log.warning(f"{p_id}: {e}")
-        except Exception as e:
-            log.error(f"{p_id}: {e}")
+    for count, performers in iter_performer_pages(PERFORMER_FILTER, PERFORMER_FRAGMENT):
+        digest.update(json.dumps(performers, sort_keys=True).encode())
+        for p in performers:
+            p_id = f"{p['name']} ({p['id']})"
+            try:
+                p = StashPerformer(p)
+                p.get_tag_updates(tag_updates)
+            except DebugException as e:
+                log.debug(f"{p_id}: {e}")
+            except WarningException as e:
+                log.warning(f"{p_id}: {e}")
+            except Exception as e:
+                log.error(f"{p_id}: {e}")
+        parsed += len(performers)
+        log.progress(parsed / max(count, 1))
+    log.info(f"Parsed {parsed} performers, skipped {total - count} of {total} without measurements, weight or height")
+
+    # an interrupted run on the same performers and tags continues with the updates it had not sent
+    journal = None
+    if Journal:
+        journal = Journal(Path(__file__).parent / "run_calculator.journal", digest.hexdigest())
+        if journal.resumed:
+            log.info(f"Resuming an interrupted run, {len(journal.done)} updates were already sent")
+
+    # tags are removed from every performer that has one, also those that lost their measurements since the last run,
+    # once tags are being added the tagged performers are no longer the ones to remove them from
+    if not (journal and "remove" in journal):
+        log.info("Removing existing plugin tags...")
+        tags_filter = {"tags": {"value": all_tag_ids, "modifier": "INCLUDES", "depth": 0}}
+        tagged_ids = [p["id"] for _, page in iter_performer_pages(tags_filter, "id") for p in page]
+        update_performers(tagged_ids, all_tag_ids, "REMOVE", journal, "remove")
+        if journal:
+            journal.commit(["remove"])
 
     for enum, performer_ids in tag_updates.items():
         if not isinstance(enum, config.TAGS_TO_USE):
@@ -74,13 +141,51 @@ def run_calculator():
         if not performer_ids:
             continue
         log.info(f"Adding {enum} tag to {len(performer_ids)} performer(s)...")
-        stash.update_performers({
-            "ids": performer_ids,
-            "tag_ids":{
-                "ids": [enum.tag_id],
-                "mode": "ADD"
-            }
-        })
+        update_performers(performer_ids, [enum.tag_id], "ADD", journal, str(enum))
+
+    if journal:
+        journal.finish()
+
+def iter_performer_pages(performer_filter, fragment):
+    """yields (count, performers) for every page of performers matching the filter, ordered by id
+
+    with pyCommon the pages after the first are requested REQUEST_CONCURRENCY at a time
+    """
+    page_filter = lambda page: {"page": page, "per_page": PAGE_SIZE, "sort": "id", "direction": "ASC", "q": ""}
+    count, performers = stash.find_performers(f=performer_filter, filter=page_filter(1), fragment=fragment, get_count=True)
+    if performers:
+        yield count, performers
+    if len(performers) < PAGE_SIZE or PAGE_SIZE >= count:
+        return
+    pages = range(2, (count - 1) // PAGE_SIZE + 2)
+    if transport := get_transport():
+        query = FIND_PERFORMERS % fragment
+        for data in transport.stream((query, {"filter": page_filter(page), "performer_filter": performer_filter}) for page in pages):
+            if data["findPerformers"]["performers"]:
+                yield count, data["findPerformers"]["performers"]
+        return
+    for page in pages:
+        performers = stash.find_performers(f=performer_filter, filter=page_filter(page), fragment=fragment)
+        if performers:
+            yield count, performers
+        if len(performers) < PAGE_SIZE:
+            return
+
+def update_performers(performer_ids, tag_ids, mode, journal=None, step=""):
+    """bulk updates tags in batches, performers journaled for this step were updated by an interrupted run"""
+    # adding or removing a tag again changes nothing, the journal only saves the requests
+    if journal:
+        performer_ids = [p for p in performer_ids if f"{step}:{p}" not in journal]
+    batches = [performer_ids[start:start + UPDATE_BATCH_SIZE] for start in range(0, len(performer_ids), UPDATE_BATCH_SIZE)]
+    updates = [{"ids": batch, "tag_ids": {"ids": tag_ids, "mode": mode}} for batch in batches]
+    if transport := get_transport():
+        results = transport.stream_mutations(("bulkPerformerUpdate", update, "BulkPerformerUpdateInput!") for update in updates)
+    else:
+        results = (stash.update_performers(update) for update in updates)
+    for batch, result in zip(batches, results):
+        # a batch stash answered without performers is sent again by the next run
+        if journal and result is not None:
+            journal.commit(f"{step}:{p}" for p in batch)
 
 def enumtag_stash_init(enum_class, tag_id_list=[]):
     for enum in enum_class:
@@ -29,6 +29,14 @@ height_cm
 ethnicity
 gender
 """
+# performers with something to calculate tags from, weight and height of 0 are treated as missing
+PERFORMER_FILTER = {
+    "measurements": {"value": "", "modifier": "NOT_NULL"},
+    "OR": {
+        "weight": {"value": 0, "modifier": "GREATER_THAN"},
+        "OR": {"height_cm": {"value": 0, "modifier": "GREATER_THAN"}},
+    },
+}
 
 class StashPerformer:
 
@@ -0,0 +1,134 @@
+"""benchmarks local phash matching on synthetic corpora with planted near duplicates
+
+	python benchmarks/bench_phash.py
+	python benchmarks/bench_phash.py --sizes 10000 100000 --distance 8 --json results.jsonl
+
+for every corpus size it reports the hamming kernel throughput, time and pairs/sec of the
+multi-index search, recall against brute force and the planted pairs, and peak memory,
+appending results as json lines makes it easy to compare releases
+"""
+import sys, json, time, argparse, platform, resource, tracemalloc
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from hamming import hamming, hamming_matrix, neighbors_within, pairs_within
+from phash_index import PhashIndex
+
+# corpora up to this size are checked against a full brute force search, larger ones against a sample
+BRUTE_FORCE_LIMIT = 20000
+RECALL_SAMPLE = 1000
+
+def make_corpus(size, distance, duplicate_rate=0.05, seed=0):
+	"""random hashes where duplicate_rate of them are copies of another hash with up to distance bits flipped
+
+	returns (hashes, planted) where planted is an array of (original, copy) index pairs
+	"""
+	rng = np.random.default_rng(seed)
+	hashes = rng.integers(0, 2**64, size=size, dtype=np.uint64, endpoint=False)
+	copies = int(size * duplicate_rate)
+	copy_index = rng.choice(np.arange(1, size), size=copies, replace=False)
+	original_index = (rng.random(copies) * copy_index).astype(np.int64)
+	flips = np.zeros(copies, dtype=np.uint64)
+	for n, bits in enumerate(rng.integers(0, distance + 1, size=copies)):
+		for bit in rng.choice(64, size=bits, replace=False):
+			flips[n] |= np.uint64(1) << np.uint64(bit)
+	hashes[copy_index] = hashes[original_index] ^ flips
+	return hashes, np.stack([original_index, copy_index], axis=1)
+
+def pair_set(i, j):
+	low, high = np.minimum(i, j), np.maximum(i, j)
+	return set(zip(low.tolist(), high.tolist()))
+
+def index_pairs(index, distance):
+	"""all close pairs from the index as corpus positions, identical hashes are expanded"""
+	pairs = set()
+	members = {}
+	for row, unique in enumerate(index.row_hash.tolist()):
+		members.setdefault(unique, []).append(row)
+	for rows in members.values():
+		pairs.update((a, b) for n, a in enumerate(rows) for b in rows[n + 1:])
+	for i, j in index.pairs(distance):
+		for a, b in zip(i.tolist(), j.tolist()):
+			pairs.update((min(x, y), max(x, y)) for x in members[a] for y in members[b])
+	return pairs
+
+def brute_force_pairs(hashes, distance, sample=None):
+	if sample is None:
+		return set().union(*(pair_set(i, j) for i, j in pairs_within(hashes, distance)))
+	pairs = set()
+	for i, j in neighbors_within(hashes[sample], hashes, distance):
+		i = sample[i]
+		keep = i != j
+		pairs.update(pair_set(i[keep], j[keep]))
+	return pairs
+
+def bench_kernel(hashes, repeat=20):
+	"""hash comparisons per second of the tiled hamming kernel"""
+	block = hashes[:256]
+	candidates = hashes[:min(len(hashes), 4096)]
+	start = time.perf_counter()
+	for _ in range(repeat):
+		hamming_matrix(block, candidates)
+	elapsed = time.perf_counter() - start
+	return len(block) * len(candidates) * repeat / elapsed
+
+def bench_size(size, distance, duplicate_rate, seed):
+	hashes, planted = make_corpus(size, distance, duplicate_rate, seed)
+	result = {"size": size, "distance": distance, "duplicate_rate": duplicate_rate}
+	result["kernel_comparisons_per_sec"] = bench_kernel(hashes)
+
+	tracemalloc.start()
+	start = time.perf_counter()
+	index = PhashIndex(np.arange(size), hashes)
+	groups = index.groups(distance)
+	result["search_seconds"] = time.perf_counter() - start
+	result["peak_traced_mb"] = tracemalloc.get_traced_memory()[1] / 1024**2
+	tracemalloc.stop()
+	result["groups"] = len(groups)
+
+	found = index_pairs(index, distance)
+	result["pairs"] = len(found)
+	result["pairs_per_sec"] = len(found) / result["search_seconds"] if result["search_seconds"] else 0
+
+	if size <= BRUTE_FORCE_LIMIT:
+		expected = brute_force_pairs(hashes, distance)
+		result["recall"] = len(found & expected) / len(expected) if expected else 1.0
+	else:
+		sample = np.random.default_rng(seed + 1).choice(size, size=RECALL_SAMPLE, replace=False)
+		expected = brute_force_pairs(hashes, distance, sample)
+		sampled = set(sample.tolist())
+		found_sample = {p for p in found if p[0] in sampled or p[1] in sampled}
+		result["recall"] = len(found_sample & expected) / len(expected) if expected else 1.0
+		result["recall_sample"] = RECALL_SAMPLE
+	planted_close = planted[hamming(hashes[planted[:, 0]], hashes[planted[:, 1]]) <= distance]
+	planted_pairs = pair_set(planted_close[:, 0], planted_close[:, 1])
+	result["planted_recall"] = len(found & planted_pairs) / len(planted_pairs) if planted_pairs else 1.0
+	result["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+	return result
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+	parser.add_argument("--distance", type=int, default=8)
+	parser.add_argument("--duplicate-rate", type=float, default=0.05)
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--json", help="append results as json lines to this file")
+	args = parser.parse_args()
+
+	print(f"{'size':>9} {'kernel cmp/s':>13} {'search s':>9} {'pairs':>9} {'pairs/s':>10} {'recall':>7} {'planted':>7} {'peak MB':>8} {'rss MB':>7}")
+	for size in args.sizes:
+		result = bench_size(size, args.distance, args.duplicate_rate, args.seed)
+		result.update({"numpy": np.__version__, "python": platform.python_version(), "time": time.time()})
+		print(
+			f"{result['size']:>9} {result['kernel_comparisons_per_sec']:>13.3g} {result['search_seconds']:>9.2f} "
+			f"{result['pairs']:>9} {result['pairs_per_sec']:>10.0f} {result['recall']:>7.3f} "
+			f"{result['planted_recall']:>7.3f} {result['peak_traced_mb']:>8.1f} {result['max_rss_mb']:>7.0f}"
+		)
+		if args.json:
+			with open(args.json, "a", encoding="utf-8") as f:
+				f.write(json.dumps(result) + "\n")
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,229 @@
+"""benchmarks loading and comparing duplicate scenes with the SceneTable against one object per scene
+
+	python benchmarks/bench_scenes.py
+	python benchmarks/bench_scenes.py --scenes 100000 500000 --json results.jsonl
+
+the baseline is the StashScene class of the plugin before SceneTable, copied unchanged with its
+timestamp parsing, both use the compare functions from config_example.py (compare_path changed
+since, it is skipped with the example PATH_PRIORITY), the vectorized KeepRanker is timed too when
+numpy is installed, the keep scenes and remove reasons of every representation are checked to be the same
+"""
+import re, sys, json, time, random, argparse, platform, tracemalloc
+import datetime as dt
+from pathlib import Path
+from inspect import getmembers, isfunction
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import config_example as config
+from config_example import log
+from scene_table import SceneTable, StashScene
+
+try:
+	from ranking import KeepRanker, ranked_priority
+except ModuleNotFoundError:
+	KeepRanker = None
+
+CODECS = ["h264", "hevc", "av1", "mpeg4", "wmv3"]
+
+def baseline_parse_timestamp(ts, format="%Y-%m-%dT%H:%M:%S%z"):
+	ts = re.sub(r"\.\d+", "", ts)  # remove fractional seconds
+	return dt.datetime.strptime(ts, format)
+
+class BaselineScene:
+	"""the StashScene of phashDuplicateTagger.py before SceneTable, one python object per scene, copied unchanged"""
+
+	def __init__(self, scene=None) -> None:
+		if len(scene["files"]) != 1:
+			raise Exception(f"Scene has {len(scene['files'])} file(s), must have one file for comparing")
+		file = scene["files"][0]
+
+		self.id = int(scene["id"])
+		self.created_at = baseline_parse_timestamp(file["created_at"])
+		if scene.get("date"):
+			self.date = baseline_parse_timestamp(scene["date"], format="%Y-%m-%d")
+		else:
+			self.date = None
+		self.path = scene.get("path")
+		self.width = file["width"]
+		self.height = file["height"]
+		# File size in # of BYTES
+		self.size = int(file["size"])
+		self.frame_rate = int(file["frame_rate"])
+		self.bitrate = int(file["bit_rate"])
+		self.duration = float(file["duration"])
+		# replace any existing tagged title
+		self.title = re.sub(r"^\[Dupe: \d+[KR]\]\s+", "", scene["title"])
+		self.path = file["path"]
+		self.tag_ids = [t["id"] for t in scene["tags"]]
+		self.gallery_ids = [g["id"] for g in scene["galleries"]]
+
+		self.remove_reason = None
+
+		self.codec = file["video_codec"].upper()
+		if self.codec in config.CODEC_PRIORITY:
+			self.codec_priority = config.CODEC_PRIORITY[self.codec]
+		else:
+			self.codec_priority = None
+			log.warning(f"could not find codec {self.codec} used in SceneID:{self.id}")
+
+	def __repr__(self) -> str:
+		return f"<StashScene ({self.id})>"
+
+	def compare(self, other):
+		if not (isinstance(other, BaselineScene)):
+			raise Exception(f"can only compare to <StashScene> not <{type(other)}>")
+
+		if self.id == other.id:
+			return None, f"Matching IDs {self.id}=={other.id}"
+
+		def compare_not_found(*args, **kwargs):
+			raise Exception("comparison not found")
+		for type in config.PRIORITY:
+			try:
+				compare_function = getattr(self, f"compare_{type}", compare_not_found)
+				result = compare_function(other)
+				if result and len(result) == 2:
+					best, msg = result
+					return best, msg
+			except Exception as e:
+				log.error(f"Issue Comparing {self.id} {other.id} using <{type}> {e}")
+		return None, f"{self.id} worse than {other.id}"
+
+def make_scenes(count, seed=0):
+	"""scene dicts shaped like the SLIM_SCENE_FRAGMENT response, in groups of 2-4 similar scenes"""
+	rng = random.Random(seed)
+	start = dt.datetime(2018, 1, 1, tzinfo=dt.timezone.utc)
+	scenes, groups = [], []
+	while len(scenes) < count:
+		height = rng.choice([480, 720, 1080, 2160])
+		size = rng.randrange(10**8, 10**10)
+		bitrate = rng.randrange(10**6, 2 * 10**7)
+		group = []
+		for _ in range(rng.randint(2, 5)):
+			created = start + dt.timedelta(seconds=rng.randrange(10**8), microseconds=rng.randrange(10**6))
+			scene_id = len(scenes) + 1
+			scenes.append({
+				"id": str(scene_id),
+				"title": f"scene {scene_id}",
+				"date": f"20{rng.randint(10, 23)}-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}" if rng.random() < 0.5 else None,
+				"tags": [{"id": str(rng.randrange(100))}] if rng.random() < 0.3 else [],
+				"galleries": [],
+				"files": [{
+					"size": size + rng.choice([0, rng.randrange(-150000, 150000), rng.randrange(-10**8, 10**8)]),
+					"path": f"/media/library/{scene_id % 97}/scene_{scene_id}.mp4",
+					"width": height * 16 // 9,
+					"height": rng.choice([height, height // 2]),
+					"bit_rate": bitrate + rng.choice([0, rng.randrange(-10**4, 10**4), rng.randrange(-10**6, 10**6)]),
+					"created_at": created.isoformat().replace("+00:00", "Z"),
+					"duration": rng.uniform(60, 3600),
+					"frame_rate": rng.choice([24, 25, 30, 60]),
+					"video_codec": rng.choice(CODECS),
+				}],
+			})
+			group.append(len(scenes) - 1)
+		groups.append(group)
+	return scenes, groups
+
+def best_of(group):
+	keep = group[0]
+	for scene in group[1:]:
+		better, _ = scene.compare(keep)
+		if better:
+			keep = better
+	return keep.id, [s.remove_reason for s in group]
+
+def bench(name, scenes, groups, load):
+	# memory is measured on a separate load, tracing allocations slows loading down several times
+	tracemalloc.start()
+	loaded = load(scenes)
+	memory = tracemalloc.get_traced_memory()[0] / 1024**2
+	tracemalloc.stop()
+	del loaded
+
+	start = time.perf_counter()
+	loaded = load(scenes)
+	load_seconds = time.perf_counter() - start
+
+	start = time.perf_counter()
+	keep = [best_of([loaded[i] for i in group]) for group in groups]
+	compare_seconds = time.perf_counter() - start
+	return {
+		"representation": name,
+		"scenes": len(scenes),
+		"load_seconds": load_seconds,
+		"scenes_per_sec": len(scenes) / load_seconds,
+		"compare_seconds": compare_seconds,
+		"memory_mb": memory,
+	}, keep
+
+def bench_ranked(scenes, groups):
+	table = SceneTable(config.CODEC_PRIORITY, config.PATH_PRIORITY)
+	start = time.perf_counter()
+	for scene in scenes:
+		table.add(scene)
+	load_seconds = time.perf_counter() - start
+
+	start = time.perf_counter()
+	keep_rows, reasons = KeepRanker(table, config.PRIORITY, config.PATH_PRIORITY).keep_rows(groups)
+	keep = [(table.ids[row], [reasons.get(r) for r in group]) for row, group in zip(keep_rows, groups)]
+	compare_seconds = time.perf_counter() - start
+	return {
+		"representation": "ranked",
+		"scenes": len(scenes),
+		"load_seconds": load_seconds,
+		"scenes_per_sec": len(scenes) / load_seconds,
+		"compare_seconds": compare_seconds,
+		"memory_mb": None,
+	}, keep
+
+def load_baseline(scenes):
+	return [BaselineScene(s) for s in scenes]
+
+def load_table(scenes):
+	table = SceneTable(config.CODEC_PRIORITY, config.PATH_PRIORITY)
+	return [StashScene(table=table, row=table.add(s)) for s in scenes]
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--scenes", type=int, nargs="+", default=[10_000, 100_000])
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--json", help="append results as json lines to this file")
+	args = parser.parse_args()
+
+	# the compare functions warn about odd files, they are not part of what is measured
+	config.log.warning = lambda *args, **kwargs: None
+	for name, func in getmembers(config, isfunction):
+		if re.match(r"^compare_", name):
+			setattr(StashScene, name, func)
+			setattr(BaselineScene, name, func)
+	StashScene.priority = config.PRIORITY
+	StashScene.codec_priorities = config.CODEC_PRIORITY
+	StashScene.path_priorities = config.PATH_PRIORITY
+
+	print(f"{'scenes':>8} {'representation':>15} {'load s':>8} {'scenes/s':>10} {'compare s':>10} {'memory MB':>10}")
+	for count in args.scenes:
+		scenes, groups = make_scenes(count, args.seed)
+		results = []
+		object_result, object_keep = bench("baseline", scenes, groups, load_baseline)
+		results.append(object_result)
+		table_result, table_keep = bench("table", scenes, groups, load_table)
+		results.append(table_result)
+		if object_keep != table_keep:
+			sys.exit(f"table decisions differ for {sum(a != b for a, b in zip(object_keep, table_keep))} groups")
+		if KeepRanker and ranked_priority(config):
+			ranked_result, ranked_keep = bench_ranked(scenes, groups)
+			results.append(ranked_result)
+			if object_keep != ranked_keep:
+				sys.exit(f"ranked decisions differ for {sum(a != b for a, b in zip(object_keep, ranked_keep))} groups")
+		for result in results:
+			result.update({"python": platform.python_version(), "time": time.time()})
+			print(
+				f"{result['scenes']:>8} {result['representation']:>15} {result['load_seconds']:>8.2f} "
+				f"{result['scenes_per_sec']:>10.0f} {result['compare_seconds']:>10.2f} {result['memory_mb'] or 0:>10.1f}"
+			)
+			if args.json:
+				with open(args.json, "a", encoding="utf-8") as f:
+					f.write(json.dumps(result) + "\n")
+
+if __name__ == "__main__":
+	main()
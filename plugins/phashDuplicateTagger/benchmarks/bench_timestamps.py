@@ -0,0 +1,83 @@
+"""micro benchmark of parse_timestamp against the regex and strptime parser it replaced
+
+	python benchmarks/bench_timestamps.py
+	python benchmarks/bench_timestamps.py --count 500000 --json results.jsonl
+
+every variant stash produces is timed uncached (unique timestamps) and cached (timestamps repeating
+like the file times and dates of a real library), results are checked against the old parser
+"""
+import re, sys, json, time, random, argparse, platform
+import datetime as dt
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from scene_table import parse_timestamp, parse_epoch
+
+VARIANTS = {
+	"utc": "{}Z",
+	"fraction_utc": "{}.{:06d}Z",
+	"nanoseconds_utc": "{}.{:06d}123Z",
+	"offset": "{}+02:00",
+	"fraction_offset": "{}.{:03d}-07:00",
+}
+
+def strptime_timestamp(ts, format="%Y-%m-%dT%H:%M:%S%z"):
+	"""the parser used before the fromisoformat fast path"""
+	ts = re.sub(r"\.\d+", "", ts)  # remove fractional seconds
+	return dt.datetime.strptime(ts, format)
+
+def make_timestamps(variant, count, distinct, seed=0):
+	rng = random.Random(seed)
+	start = dt.datetime(2015, 1, 1)
+	pool = []
+	for _ in range(distinct):
+		moment = (start + dt.timedelta(seconds=rng.randrange(3 * 10**8))).strftime("%Y-%m-%dT%H:%M:%S")
+		fraction = rng.randrange(1000) if "{:03d}" in VARIANTS[variant] else rng.randrange(10**6)
+		pool.append(VARIANTS[variant].format(moment, fraction))
+	return [pool[rng.randrange(distinct)] for _ in range(count)]
+
+def timed(parse, timestamps):
+	start = time.perf_counter()
+	for ts in timestamps:
+		parse(ts)
+	return len(timestamps) / (time.perf_counter() - start)
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--count", type=int, default=200_000)
+	parser.add_argument("--repeat-distinct", type=int, default=2_000, help="distinct timestamps in the cached runs")
+	parser.add_argument("--json", help="append results as json lines to this file")
+	args = parser.parse_args()
+
+	print(f"{'variant':>16} {'strptime/s':>11} {'fast/s':>11} {'cached/s':>11} {'epoch/s':>11} {'speedup':>8}")
+	for variant in VARIANTS:
+		unique = make_timestamps(variant, args.count, args.count)
+		repeated = make_timestamps(variant, args.count, args.repeat_distinct, seed=1)
+		for ts in unique[:1000] + repeated[:1000]:
+			if parse_timestamp.__wrapped__(ts) != strptime_timestamp(ts):
+				sys.exit(f"{variant} parsed differently: {ts}")
+
+		parse_timestamp.cache_clear()
+		parse_epoch.cache_clear()
+		result = {
+			"variant": variant,
+			"count": args.count,
+			"strptime_per_sec": timed(strptime_timestamp, unique),
+			# unique timestamps measure the fast path itself, the cache only adds a miss
+			"fast_per_sec": timed(parse_timestamp.__wrapped__, unique),
+			"cached_per_sec": timed(parse_timestamp, repeated),
+			"epoch_cached_per_sec": timed(parse_epoch, repeated),
+			"python": platform.python_version(),
+			"time": time.time(),
+		}
+		result["speedup"] = result["fast_per_sec"] / result["strptime_per_sec"]
+		print(
+			f"{variant:>16} {result['strptime_per_sec']:>11.0f} {result['fast_per_sec']:>11.0f} "
+			f"{result['cached_per_sec']:>11.0f} {result['epoch_cached_per_sec']:>11.0f} {result['speedup']:>7.1f}x"
+		)
+		if args.json:
+			with open(args.json, "a", encoding="utf-8") as f:
+				f.write(json.dumps(result) + "\n")
+
+if __name__ == "__main__":
+	main()
@@ -7,7 +7,8 @@ from stashapi.tools import human_bytes, human_bits
 #	flag: Keep/Remove/Unknown flag
 SCENE_TITLE_TEMPLATE = "$group_size|$scene_id$flag"
 
-# Path priority is from highest to lowest and works off the root of the path
+# Path priority is from highest to lowest and works off the root of the path,
+# a file in nested folders counts as being in the deepest one
 PATH_PRIORITY = ['/root/most/important/path','/root/least/important/path']
 PRIORITY = ["bitrate_per_pixel", "resolution", "bitrate", "encoding", "size", "age"]
 CODEC_PRIORITY = {
@@ -29,6 +30,27 @@ UNKNOWN_TAG_NAME = "[PDT: Unknown]"
 IGNORE_TAG_NAME = "[PDT: Ignore]"
 IGNORE_PATHS = []
 
+# Match phashes locally instead of asking stash, needs numpy (pip install numpy)
+# local matching scales to large libraries and finds the same groups as stash
+LOCAL_MATCHING = False
+# Distance used by the "Set Dupe Tags (CUSTOM)" task, always matched locally (0-64)
+CUSTOM_DISTANCE = 6
+# Save the ids of the plugin's tags to tag_cache.json and reuse them on the next run
+PERSIST_TAG_CACHE = False
+# Scene titles and new scenes are sent in batches of this many scenes
+MUTATION_BATCH_SIZE = 500
+# Requests sent at once when the pyCommon plugin is installed, for pages of duplicate scene details and
+# batches of titles and new scenes, 1 sends one request at a time
+REQUEST_CONCURRENCY = 4
+# File the "Plan Dupe Tags" tasks write to and "Apply Dupe Tag Plan" reads, defaults to pdt_plan.jsonl in the plugin folder
+PLAN_FILE = None
+# Remember the decision for every duplicate group in pdt_decisions.db, later tag runs with the same
+# distance and config only compare groups whose scenes or files changed and only update scenes whose tags changed
+INCREMENTAL_TAGGING = True
+# Pick keep scenes for many groups at once with numpy, only used while the compare functions in
+# PRIORITY are unchanged from this file, otherwise scenes are compared one pair at a time
+VECTORIZED_RANKING = True
+
 
 def compare_bitrate_per_pixel(self, other):
 
@@ -159,34 +181,26 @@ def compare_encoding(self, other):
 def compare_path(self, other):
 	if PATH_PRIORITY[0] == '/root/most/important/path':
 		return
-	if not self.path or not other.path:
+	# path_score is the index of the deepest PATH_PRIORITY folder holding the file, len(PATH_PRIORITY) if none
+	if self.path_score is None or other.path_score is None:
 		return
-
-	min_score = len(PATH_PRIORITY)
-	self.score = min_score
-	other.score = min_score
-	for score, path in enumerate(PATH_PRIORITY):
-		if path in self.path:
-			self.score = score
-		if path in other.path:
-			other.score = score
-
-	if self.score == other.score:
+	if self.path_score == other.path_score:
 		return
 
-	if self.score < other.score:
+	if self.path_score < other.path_score:
 		better, worse = self, other
 	else:
 		worse, better = self, other
 	worse.remove_reason = "filepath"
-	return better, f"Prefer Filepath {PATH_PRIORITY[better.score]} | {better.id} better than {worse.id}"
+	better_path = PATH_PRIORITY[better.path_score]
+	return better, f"Prefer Filepath {better_path} | {better.id} better than {worse.id}"
 
 def compare_gallery_count(self, other):
-    if self.gallery_ids.length == other.gallery_ids.length:
+    if len(self.gallery_ids) == len(other.gallery_ids):
         return
-    if self.gallery_ids.length > other.gallery_ids.length:
+    if len(self.gallery_ids) > len(other.gallery_ids):
         better, worse = self, other
     else:
         worse, better = self, other
     worse.remove_reason = "gallery count"
-    return better, f"More Galleries {better.id}:{better.height}p > {worse.id}:{worse.gallery_ids}"
\ No newline at end of file
+    return better, f"More Galleries {better.id}:{len(better.gallery_ids)} > {worse.id}:{len(worse.gallery_ids)}"
\ No newline at end of file
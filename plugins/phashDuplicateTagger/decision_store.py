@@ -0,0 +1,127 @@
+import json, time, sqlite3, hashlib
+from pathlib import Path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+	id INTEGER PRIMARY KEY,
+	signature TEXT NOT NULL,
+	started REAL NOT NULL,
+	finished REAL
+);
+CREATE TABLE IF NOT EXISTS groups (
+	fingerprint TEXT PRIMARY KEY,
+	decision TEXT,
+	last_run INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS scenes (
+	scene_id INTEGER PRIMARY KEY,
+	title TEXT NOT NULL,
+	tags TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS groups_last_run ON groups (last_run);
+"""
+
+def group_fingerprint(scene_ids, attributes):
+	"""hash of the sorted scene ids of a group and every attribute that can change its decision
+
+	attributes is a dict of {scene_id: [attribute rows]}, the file attributes, gallery ids and tag ids of the scene
+	"""
+	digest = hashlib.sha1()
+	for scene_id in sorted(scene_ids):
+		rows = sorted(json.dumps(row, default=str) for row in attributes.get(scene_id, []))
+		digest.update(json.dumps([scene_id, rows]).encode())
+	return digest.hexdigest()
+
+class DecisionStore:
+	"""sqlite store of the decision made for every duplicate group and the state each scene was tagged with
+
+	groups are keyed by a fingerprint of their scenes and file attributes so unchanged groups reuse the stored
+	decision, scenes keep the title and tags they were given so only scenes whose state changed are updated,
+	stored results are only valid for runs with the same signature (distance and config)
+	"""
+
+	def __init__(self, path):
+		self.path = Path(path)
+		self.db = sqlite3.connect(self.path)
+		self.db.executescript(SCHEMA)
+		self.run_id = None
+
+	def __repr__(self) -> str:
+		return f"<DecisionStore {self.path}>"
+
+	def close(self):
+		self.db.close()
+
+	def last_signature(self):
+		"""signature of the last run, None when it did not finish and scenes may be in an unknown state"""
+		row = self.db.execute("SELECT signature, finished FROM runs ORDER BY id DESC LIMIT 1").fetchone()
+		return row[0] if row and row[1] else None
+
+	def start_run(self, signature):
+		"""starts a run, returns True when results of the last run can be reused"""
+		incremental = self.last_signature() == signature
+		with self.db:
+			if not incremental:
+				self._clear()
+			cursor = self.db.execute("INSERT INTO runs (signature, started) VALUES (?, ?)", (signature, time.time()))
+		self.run_id = cursor.lastrowid
+		return incremental
+
+	def resume_run(self, signature):
+		"""continues the last run when it did not finish and had the same signature, returns False when there is none"""
+		row = self.db.execute("SELECT id, signature, finished FROM runs ORDER BY id DESC LIMIT 1").fetchone()
+		if not row or row[1] != signature or row[2]:
+			return False
+		self.run_id = row[0]
+		return True
+
+	def finish_run(self):
+		"""drops groups that were not seen in this run and marks the run as complete"""
+		with self.db:
+			self.db.execute("DELETE FROM groups WHERE last_run < ?", (self.run_id,))
+			self.db.execute("UPDATE runs SET finished = ? WHERE id = ?", (time.time(), self.run_id))
+
+	def decisions(self, fingerprints):
+		"""stored decisions as {fingerprint: decision} for the fingerprints that are known, marking them as seen"""
+		found = {}
+		for start in range(0, len(fingerprints), 500):
+			chunk = fingerprints[start:start + 500]
+			rows = self.db.execute(
+				f"SELECT fingerprint, decision FROM groups WHERE fingerprint IN ({','.join('?' * len(chunk))})", chunk
+			)
+			found.update((fingerprint, json.loads(decision)) for fingerprint, decision in rows)
+		with self.db:
+			self.db.executemany("UPDATE groups SET last_run = ? WHERE fingerprint = ?", [(self.run_id, f) for f in found])
+		return found
+
+	def save_decisions(self, decisions):
+		"""stores {fingerprint: decision}, decision is None for groups that were not tagged"""
+		with self.db:
+			self.db.executemany(
+				"INSERT OR REPLACE INTO groups (fingerprint, decision, last_run) VALUES (?, ?, ?)",
+				[(f, json.dumps(d), self.run_id) for f, d in decisions.items()],
+			)
+
+	def scene_states(self):
+		"""the state every tagged scene was left in as {scene_id: (title, tags)}"""
+		return {
+			scene_id: (title, tuple(json.loads(tags)))
+			for scene_id, title, tags in self.db.execute("SELECT scene_id, title, tags FROM scenes")
+		}
+
+	def set_scene_states(self, states):
+		with self.db:
+			self.db.execute("DELETE FROM scenes")
+			self.db.executemany(
+				"INSERT INTO scenes (scene_id, title, tags) VALUES (?, ?, ?)",
+				[(scene_id, title, json.dumps(list(tags))) for scene_id, (title, tags) in states.items()],
+			)
+
+	def _clear(self):
+		self.db.execute("DELETE FROM groups")
+		self.db.execute("DELETE FROM scenes")
+		self.db.execute("DELETE FROM runs")
+
+	def clear(self):
+		with self.db:
+			self._clear()
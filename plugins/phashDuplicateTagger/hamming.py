@@ -0,0 +1,59 @@
+import numpy as np
+
+# rows of a tile compared at once, ROWS x COLS uint64 xor results (512KB) stay in L2 cache
+TILE_ROWS = 256
+TILE_COLS = 256
+
+M1 = np.uint64(0x5555555555555555)
+M2 = np.uint64(0x3333333333333333)
+M4 = np.uint64(0x0F0F0F0F0F0F0F0F)
+H01 = np.uint64(0x0101010101010101)
+
+def popcount_swar(values):
+	"""set bits of each uint64 using the parallel bit counting trick"""
+	values = np.asarray(values, dtype=np.uint64)
+	values = values - ((values >> np.uint64(1)) & M1)
+	values = (values & M2) + ((values >> np.uint64(2)) & M2)
+	values = (values + (values >> np.uint64(4))) & M4
+	return ((values * H01) >> np.uint64(56)).astype(np.uint8)
+
+if hasattr(np, "bitwise_count"):
+	# numpy >= 2.0 has a native popcount
+	def popcount64(values):
+		return np.bitwise_count(np.asarray(values, dtype=np.uint64))
+else:
+	popcount64 = popcount_swar
+
+def hamming(a, b):
+	"""element wise hamming distance between two uint64 arrays"""
+	return popcount64(np.bitwise_xor(a, b))
+
+def hamming_matrix(block, candidates):
+	"""len(block) x len(candidates) matrix of hamming distances"""
+	return popcount64(np.bitwise_xor(block[:, None], candidates[None, :]))
+
+def neighbors_within(queries, hashes, distance, rows=TILE_ROWS, cols=TILE_COLS):
+	"""yields (query index, hash index) arrays for every hash within distance of every query, tile by tile"""
+	queries = np.asarray(queries, dtype=np.uint64)
+	hashes = np.asarray(hashes, dtype=np.uint64)
+	for row in range(0, len(queries), rows):
+		block = queries[row:row + rows]
+		for col in range(0, len(hashes), cols):
+			i, j = np.nonzero(hamming_matrix(block, hashes[col:col + cols]) <= distance)
+			if len(i):
+				yield i + row, j + col
+
+def pairs_within(hashes, distance, rows=TILE_ROWS, cols=TILE_COLS):
+	"""brute force, yields (i, j) arrays with i < j for every pair of hashes within distance"""
+	hashes = np.asarray(hashes, dtype=np.uint64)
+	for row in range(0, len(hashes), rows):
+		block = hashes[row:row + rows]
+		# tiles left of the diagonal only hold pairs already found
+		first_col = row - row % cols
+		for col in range(first_col, len(hashes), cols):
+			i, j = np.nonzero(hamming_matrix(block, hashes[col:col + cols]) <= distance)
+			i += row
+			j += col
+			keep = i < j
+			if keep.any():
+				yield i[keep], j[keep]
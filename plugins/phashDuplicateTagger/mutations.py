@@ -0,0 +1,163 @@
+from collections import deque
+
+import stashapi.log as log
+
+SCENES_UPDATE = """
+mutation ScenesUpdate($input: [SceneUpdateInput!]!) {
+	scenesUpdate(input: $input) { id }
+}
+"""
+
+class MutationPlanner:
+	"""collects scene changes and sends them to stash in as few requests as possible
+
+	tag changes are grouped by the set of tags added or removed and sent as one bulk update per set at flush(),
+	titles and new scenes differ per scene, with a pyCommon AsyncTransport they are queued as single sceneUpdate
+	and sceneCreate mutations that the transport sends as batches of aliased fields over its pool of connections,
+	without one they are sent in batches of batch_size from the calling thread, titles and new scenes are sent as
+	soon as a batch is full while tag changes are held until flush()
+	"""
+
+	def __init__(self, stash, transport=None, batch_size=500):
+		self.stash = stash
+		self.transport = transport
+		self.batch_size = max(1, int(batch_size))
+		self.tag_sets = {}
+		self.titles = []
+		self.new_scenes = []
+		# futures of the mutations queued with the transport, oldest first
+		self.pending = deque()
+		# requests sent from this thread, the transport counts the requests it merged the queued mutations into
+		self.requests = 0
+		self.transport_requests = transport.stats["mutation_requests"] if transport else 0
+		self.updated = 0
+		# scenes whose change was not applied, from failed requests, errors or scenes missing from the response
+		self.failed = 0
+		self.last_error = None
+
+	def __repr__(self) -> str:
+		return f"<MutationPlanner ({len(self.tag_sets)} tag sets, {len(self.titles)} titles, {len(self.new_scenes)} new scenes queued)>"
+
+	def add_tags(self, scene_id, tag_ids, mode="ADD"):
+		tag_ids = frozenset(t for t in tag_ids if t)
+		if tag_ids:
+			self.tag_sets.setdefault((mode, tag_ids), []).append(scene_id)
+
+	def remove_tags(self, scene_id, tag_ids):
+		self.add_tags(scene_id, tag_ids, mode="REMOVE")
+
+	def set_title(self, scene_id, title):
+		if self.transport:
+			self._queue("sceneUpdate", {"id": scene_id, "title": title}, "SceneUpdateInput!")
+			return
+		self.titles.append({"id": scene_id, "title": title})
+		if len(self.titles) >= self.batch_size:
+			self._send_titles()
+
+	def create_scene(self, scene_input):
+		if self.transport:
+			self._queue("sceneCreate", scene_input, "SceneCreateInput!")
+			return
+		self.new_scenes.append(scene_input)
+		if len(self.new_scenes) >= self.batch_size:
+			self._send_new_scenes()
+
+	def update(self, scene_id, title=None, tag_ids=None):
+		if title is not None:
+			self.set_title(scene_id, title)
+		if tag_ids:
+			self.add_tags(scene_id, tag_ids)
+
+	def _queue(self, field, input, input_type):
+		# the transport caps the requests in flight, the futures held here are capped so a large run stays small
+		while len(self.pending) >= self.batch_size * self.transport.concurrency * 2:
+			self._collect(self.pending.popleft())
+		self.pending.append(self.transport.submit_mutation(field, input, input_type))
+
+	def _collect(self, future):
+		try:
+			result = future.result()
+		except Exception as e:
+			self._fail(1, e)
+			return
+		if result is None:
+			self._fail(1, "stash returned no scene")
+		else:
+			self.updated += 1
+
+	def _fail(self, count, error):
+		self.failed += count
+		# every mutation of a failed request raises the same error, it is logged once
+		if str(error) != self.last_error:
+			self.last_error = str(error)
+			log.error(f"failed to update scenes: {error}")
+
+	def _applied(self, batch, scenes):
+		"""number of scenes stash returned for a batch, the rest of the batch is counted as failed
+
+		stash answers a request that failed for some scenes with the data of the others and the errors,
+		stashapi logs the errors and returns the data, so missing and null scenes are what shows the failure
+		"""
+		applied = sum(1 for scene in scenes or [] if scene)
+		if applied < len(batch):
+			self._fail(len(batch) - applied, f"stash did not update {len(batch) - applied} of {len(batch)} scenes")
+		return applied
+
+	def _update_titles(self, batch):
+		result = self.stash.call_GQL(SCENES_UPDATE, {"input": batch})
+		return self._applied(batch, result.get("scenesUpdate"))
+
+	def _create_scenes(self, batch):
+		variables = ", ".join(f"$input{n}: SceneCreateInput!" for n in range(len(batch)))
+		fields = "\n".join(f"\tscene{n}: sceneCreate(input: $input{n}) {{ id }}" for n in range(len(batch)))
+		result = self.stash.call_GQL(f"mutation ScenesCreate({variables}) {{\n{fields}\n}}", {f"input{n}": s for n, s in enumerate(batch)})
+		# a scene that could not be created is null under its alias, with its error beside the data
+		return self._applied(batch, [result.get(f"scene{n}") for n in range(len(batch))])
+
+	def _send(self, send, batch):
+		self.requests += 1
+		try:
+			self.updated += send(batch)
+		except Exception as e:
+			self._fail(len(batch), e)
+
+	def _send_titles(self):
+		if not self.titles:
+			return
+		batch, self.titles = self.titles[:self.batch_size], self.titles[self.batch_size:]
+		self._send(self._update_titles, batch)
+
+	def _send_new_scenes(self):
+		if not self.new_scenes:
+			return
+		batch, self.new_scenes = self.new_scenes[:self.batch_size], self.new_scenes[self.batch_size:]
+		self._send(self._create_scenes, batch)
+
+	def flush(self):
+		"""sends every queued change and waits for the requests still running"""
+		while self.titles:
+			self._send_titles()
+		while self.new_scenes:
+			self._send_new_scenes()
+		if self.pending:
+			self.transport.flush()
+			while self.pending:
+				self._collect(self.pending.popleft())
+
+		# removals are sent first so a tag that moved between scenes is never left off
+		for (mode, tag_ids), scene_ids in sorted(self.tag_sets.items(), key=lambda item: item[0][0] != "REMOVE"):
+			for start in range(0, len(scene_ids), self.batch_size):
+				chunk = scene_ids[start:start + self.batch_size]
+				self.requests += 1
+				try:
+					self._applied(chunk, self.stash.update_scenes({
+						"ids": chunk,
+						"tag_ids": {"mode": mode, "ids": sorted(tag_ids)},
+					}))
+				except Exception as e:
+					self._fail(len(chunk), e)
+		self.tag_sets = {}
+		if self.transport:
+			self.requests += self.transport.stats["mutation_requests"] - self.transport_requests
+			self.transport_requests = self.transport.stats["mutation_requests"]
+		log.debug(f"updated or created {self.updated} scenes, {self.requests} requests sent")
@@ -0,0 +1,50 @@
+import os
+
+WINDOWS = os.name == "nt"
+
+def path_components(path):
+	"""components of a path the way pathlib compares them, without building a Path"""
+	if WINDOWS:
+		path = path.replace("\\", "/").lower()
+	components = [c for c in path.split("/") if c and c != "."]
+	if path.startswith("/"):
+		components.insert(0, "/")
+	return components
+
+class PathMatcher:
+	"""prefix trie of folders for finding which of them a file is in with one walk down its path
+
+	each folder keeps its index in the list it was built from, a file matches the deepest
+	folder it is inside of, the same folders Path(folder) in Path(file).parents would find
+	"""
+
+	def __init__(self, folders):
+		self.folders = list(folders)
+		self.root = {}
+		for index, folder in enumerate(self.folders):
+			node = self.root
+			for component in path_components(folder):
+				node = node.setdefault(component, {})
+			# the first entry wins when a folder is listed twice
+			node.setdefault(None, index)
+
+	def __repr__(self) -> str:
+		return f"<PathMatcher ({len(self.folders)} folders)>"
+
+	def __bool__(self):
+		return bool(self.folders)
+
+	def match(self, path):
+		"""index of the deepest folder that contains path, None when it is in none of them"""
+		match = None
+		node = self.root
+		# the last component is the file itself which can not be one of its own parents
+		for component in path_components(path)[:-1]:
+			node = node.get(component)
+			if node is None:
+				break
+			match = node.get(None, match)
+		return match
+
+	def contains(self, path):
+		return self.match(path) is not None
@@ -1,5 +1,6 @@
-import re, sys, json
+import re, sys, json, hashlib
 import datetime as dt
+from collections import deque
 from pathlib import Path
 from string import Template
 from inspect import getmembers, isfunction
@@ -17,8 +18,52 @@ try:
 except ModuleNotFoundError:
 	log.exit(err="could not import config, have you renamed config_example.py to config.py?")
 
+from tag_cache import TagCache, reason_tag_name
+from mutations import MutationPlanner
+from plan import PlanWriter, read_plan
+from decision_store import DecisionStore, group_fingerprint
+from scene_table import SceneTable, StashScene
+from path_matcher import PathMatcher
+
+# pyCommon is installed as its own plugin next to this one
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+try:
+	from pyCommon.transport import AsyncTransport
+	from pyCommon.instrument import instrument_run
+	from pyCommon.replay import record_run
+	from pyCommon.journal import Journal
+except ModuleNotFoundError:
+	# without pyCommon scene details are fetched one page at a time and interrupted tasks start over
+	AsyncTransport = instrument_run = record_run = Journal = None
+
+try:
+	from phash_index import find_local_duplicates
+except ModuleNotFoundError:
+	# numpy is only needed when matching locally
+	find_local_duplicates = None
+
+try:
+	from ranking import KeepRanker, ranked_priority
+except ModuleNotFoundError:
+	# without numpy keep scenes are picked with the pairwise compare functions
+	KeepRanker = ranked_priority = None
+
 FRAGMENT = json.loads(sys.stdin.read())
 stash = StashInterface(FRAGMENT["server_connection"])
+# opened on first use by get_transport()
+transport = None
+# timings of this run when the instrument plugin setting is on, set on startup
+instrument = None
+# records the requests of this run into a fixture when PYCOMMON_RECORD is set
+recorder = record_run(stash, "phashDuplicateTagger") if record_run else None
+ignore_paths = PathMatcher(config.IGNORE_PATHS)
+PLAN_PATH = Path(getattr(config, "PLAN_FILE", None) or Path(__file__).parent / "pdt_plan.jsonl")
+decision_store = DecisionStore(Path(__file__).parent / "pdt_decisions.db") if getattr(config, "INCREMENTAL_TAGGING", True) else None
+tag_cache = TagCache(
+	stash,
+	[config.REMOVE_TAG_NAME, config.KEEP_TAG_NAME, config.UNKNOWN_TAG_NAME, config.IGNORE_TAG_NAME],
+	Path(__file__).parent / "tag_cache.json" if getattr(config, "PERSIST_TAG_CACHE", False) else None,
+)
 
 SLIM_SCENE_FRAGMENT = """
 id
@@ -39,20 +84,124 @@ files {
 }
 """
 
+# number of scenes requested per page when fetching details of duplicate groups
+DUPLICATE_BATCH_SIZE = 500
+# number of groups requested per page when grouping exact matches in sql
+EXACT_GROUP_PAGE_SIZE = 5000
+# scenes held in one SceneTable before a new one is started for the following groups
+SCENE_TABLE_ROWS = 20000
+# number of rows or scenes changed between two journal commits by the cleanup, oshash split and tagging
+CHECKPOINT_PAGE_SIZE = 5000
+# PRIORITY when keep scenes can be ranked with numpy, set on startup
+RANKED_PRIORITY = None
+
+FIND_SCENES_BY_IDS = """
+query FindScenesByIds($scene_ids: [Int!]) {
+	findScenes(scene_ids: $scene_ids, filter: {per_page: -1}) {
+		scenes {
+			...Scene
+		}
+	}
+}
+"""
+
+EXACT_DUPLICATES_QUERY = """
+SELECT files_fingerprints.fingerprint, GROUP_CONCAT(DISTINCT scenes_files.scene_id)
+FROM files_fingerprints
+JOIN scenes_files ON scenes_files.file_id = files_fingerprints.file_id
+WHERE files_fingerprints.type = 'phash' {after}
+GROUP BY files_fingerprints.fingerprint
+HAVING COUNT(DISTINCT scenes_files.scene_id) > 1
+ORDER BY files_fingerprints.fingerprint
+LIMIT ?
+"""
+
+# titles are matched loosely in sql (LIKE ignores case), strip_title only removes exact [PDT: ...] prefixes
+TAGGED_TITLES_QUERY = """
+SELECT id, title FROM scenes
+WHERE id > ? AND title LIKE '[PDT: %'
+ORDER BY id
+LIMIT ?
+"""
+TAGGED_TITLES_COUNT = "SELECT COUNT(*) FROM scenes WHERE id > ? AND title LIKE '[PDT: %'"
+MANAGED_TAG_SCENES_QUERY = "SELECT scene_id FROM scenes_tags WHERE tag_id = ?"
+
+# files that are not the primary file of their scene and share their oshash with another file
+MERGED_OSHASH_FILTER = """
+FROM scenes_files
+JOIN scenes ON scenes.id = scenes_files.scene_id
+JOIN files_fingerprints ON files_fingerprints.file_id = scenes_files.file_id AND files_fingerprints.type = 'oshash'
+WHERE scenes_files.file_id > ? AND NOT scenes_files."primary"
+AND files_fingerprints.fingerprint IN (
+	SELECT fingerprint FROM files_fingerprints WHERE type = 'oshash' GROUP BY fingerprint HAVING COUNT(*) > 1
+)
+AND scenes_files.scene_id NOT IN (SELECT scene_id FROM scenes_tags WHERE tag_id = ?)
+"""
+MERGED_OSHASH_FILES_QUERY = f"""
+SELECT scenes_files.file_id, scenes.title
+{MERGED_OSHASH_FILTER}
+ORDER BY scenes_files.file_id
+LIMIT ?
+"""
+MERGED_OSHASH_FILES_COUNT = f"SELECT COUNT(*) {MERGED_OSHASH_FILTER}"
+
+# file attributes that can change the decision for a group, used to fingerprint groups,
+# the compare functions themselves are part of the run signature through the config file
+SCENE_ATTRIBUTES_QUERY = """
+SELECT scenes_files.scene_id, scenes.title, scenes.date, files.size, files.mod_time, files.created_at,
+	folders.path, files.basename, video_files.bit_rate, video_files.video_codec,
+	video_files.width, video_files.height, video_files.frame_rate, video_files.duration
+FROM scenes_files
+JOIN scenes ON scenes.id = scenes_files.scene_id
+JOIN files ON files.id = scenes_files.file_id
+JOIN folders ON folders.id = files.parent_folder_id
+LEFT JOIN video_files ON video_files.file_id = files.id
+WHERE scenes_files.scene_id IN ({})
+"""
+# galleries and tags compare functions can read from StashScene.gallery_ids and tag_ids,
+# tags the plugin sets are left out, they change with every decision
+SCENE_GALLERIES_QUERY = """
+SELECT scene_id, gallery_id FROM scenes_galleries WHERE scene_id IN ({})
+"""
+SCENE_TAGS_QUERY = """
+SELECT scenes_tags.scene_id, scenes_tags.tag_id
+FROM scenes_tags
+JOIN tags ON tags.id = scenes_tags.tag_id
+WHERE scenes_tags.scene_id IN ({}) AND tags.name NOT IN (?, ?, ?) AND tags.name NOT LIKE '[Reason: %'
+"""
+
+EXACT_DUPLICATES_COUNT = """
+SELECT COUNT(*) FROM (
+	SELECT files_fingerprints.fingerprint
+	FROM files_fingerprints
+	JOIN scenes_files ON scenes_files.file_id = files_fingerprints.file_id
+	WHERE files_fingerprints.type = 'phash'
+	GROUP BY files_fingerprints.fingerprint
+	HAVING COUNT(DISTINCT scenes_files.scene_id) > 1
+)
+"""
+
 def plugin_main():
 	MODE = FRAGMENT["args"]["mode"]
+	# plan tasks write their decisions to the plan file instead of changing scenes
+	plan_path = PLAN_PATH if FRAGMENT["args"].get("plan") else None
 	
-	if MODE == "remove":
-		clean_scenes()
+	# tags are only destroyed once no scene is left with them, a failed cleanup is resumed by the next run
+	if MODE == "remove" and clean_scenes():
 		for tag in get_managed_tags():
 			stash.destroy_tag(tag["id"])
+			tag_cache.forget(tag["id"])
 
 	if MODE == "tag_exact":
-		process_duplicates(PhashDistance.EXACT)
+		process_duplicates(PhashDistance.EXACT, plan_path=plan_path)
 	if MODE == "tag_high":
-		process_duplicates(PhashDistance.HIGH)
+		process_duplicates(PhashDistance.HIGH, plan_path=plan_path)
 	if MODE == "tag_medium":
-		process_duplicates(PhashDistance.MEDIUM)
+		process_duplicates(PhashDistance.MEDIUM, plan_path=plan_path)
+	if MODE == "tag_custom":
+		process_duplicates(config.CUSTOM_DISTANCE, local=True, plan_path=plan_path)
+	if MODE == "apply_plan":
+		apply_plan(PLAN_PATH)
 
 	if MODE == "split_merged_oshash":
 		split_out_oshash_matches()
@@ -62,6 +211,9 @@ def plugin_main():
 	if MODE == "generate_phash":
 		stash.metadata_generate({"phashes": True})
 
+	tag_cache.save()
+	if transport:
+		transport.close()
 	log.exit("Plugin exited normally.")
 
 def hooks_main():
@@ -79,227 +231,540 @@ def format_title(group_size, scene_id, flag, title):
 	})
 	return f"[PDT: {user_template}] {title}"
 
-def parse_timestamp(ts, format="%Y-%m-%dT%H:%M:%S%z"):
-	ts = re.sub(r"\.\d+", "", ts)  # remove fractional seconds
-	return dt.datetime.strptime(ts, format)
-
-
-class StashScene:
-
-	def __init__(self, scene=None) -> None:
-		if len(scene["files"]) != 1:
-			raise Exception(f"Scene has {len(scene['files'])} file(s), must have one file for comparing")
-		file = scene["files"][0]
+def find_scenes_by_ids(scene_ids, fragment=SLIM_SCENE_FRAGMENT):
+	query = FIND_SCENES_BY_IDS.replace("...Scene", fragment)
+	return stash.call_GQL(query, {"scene_ids": scene_ids})["findScenes"]["scenes"]
 
-		self.id = int(scene["id"])
-		self.created_at = parse_timestamp(file["created_at"])
-		if scene.get("date"):
-			self.date = parse_timestamp(scene["date"], format="%Y-%m-%d")
-		else:
-			self.date = None
-		self.path = scene.get("path")
-		self.width = file["width"]
-		self.height = file["height"]
-		# File size in # of BYTES
-		self.size = int(file["size"])
-		self.frame_rate = int(file["frame_rate"])
-		self.bitrate = int(file["bit_rate"])
-		self.duration = float(file["duration"])
-		# replace any existing tagged title
-		self.title = re.sub(r"^\[Dupe: \d+[KR]\]\s+", "", scene["title"])
-		self.path = file["path"]
-		self.tag_ids = [t["id"] for t in scene["tags"]]
-		self.gallery_ids = [g["id"] for g in scene["galleries"]]
-
-		self.remove_reason = None
-
-		self.codec = file["video_codec"].upper()
-		if self.codec in config.CODEC_PRIORITY:
-			self.codec_priority = config.CODEC_PRIORITY[self.codec]
+def find_tagged_scene_ids(tag_id):
+	scenes = stash.find_scenes(
+		f={"tags": {"value": [tag_id], "modifier": "INCLUDES", "depth": 0}},
+		fragment="id",
+	)
+	return {int(s["id"]) for s in scenes}
+
+def iter_exact_duplicate_id_groups():
+	"""groups identical phashes in sql, paging through fingerprints so no response holds every group"""
+	last_fingerprint = None
+	while True:
+		if last_fingerprint is None:
+			query, args = EXACT_DUPLICATES_QUERY.format(after=""), [EXACT_GROUP_PAGE_SIZE]
 		else:
-			self.codec_priority = None
-			log.warning(f"could not find codec {self.codec} used in SceneID:{self.id}")
-
-	def __repr__(self) -> str:
-		return f"<StashScene ({self.id})>"
-
-	def __str__(self) -> str:
-		return f"id:{self.id}, height:{self.height}, size:{human_bytes(self.size)}, file_created_at:{self.created_at}, title:{self.title}"
-
-	def compare(self, other):
-		if not (isinstance(other, StashScene)):
-			raise Exception(f"can only compare to <StashScene> not <{type(other)}>")
-
-		if self.id == other.id:
-			return None, f"Matching IDs {self.id}=={other.id}"
-
-		def compare_not_found(*args, **kwargs):
-			raise Exception("comparison not found")
-		for type in config.PRIORITY:
-			try:
-				compare_function = getattr(self, f"compare_{type}", compare_not_found)
-				result = compare_function(other)
-				if result and len(result) == 2:
-					best, msg = result
-					return best, msg
-			except Exception as e:
-				log.error(f"Issue Comparing {self.id} {other.id} using <{type}> {e}")
-		return None, f"{self.id} worse than {other.id}"
-
-def process_duplicates(distance:PhashDistance=PhashDistance.EXACT):
-
-	clean_scenes()  # clean old results
-
-	ignore_tag_id = stash.find_tag(config.IGNORE_TAG_NAME, create=True).get("id")
-	duplicate_list = stash.find_duplicate_scenes(distance, fragment=SLIM_SCENE_FRAGMENT)
-
-	total = len(duplicate_list)
-	log.info(f"Found {total} sets of duplicates.")
-
-	for i, group in enumerate(duplicate_list):
-		scene_group = []
-		for s in group:
-			try:
-				scene_group.append(StashScene(s))
-			except Exception as e:
-				log.warning(f"Issue parsing SceneID:{s['id']} - {e}")
-		filtered_group = []
-		for scene in scene_group:
-			if ignore_tag_id in scene.tag_ids:
-				log.debug(f"Ignore from Tag {scene.id} {scene.title}")
-			elif any([Path(ignore_path) in Path(scene.path).parents for ignore_path in config.IGNORE_PATHS]):
-				log.warning(f"Ignore from Path {scene.id} {scene.path}")
+			query, args = EXACT_DUPLICATES_QUERY.format(after="AND files_fingerprints.fingerprint > ?"), [last_fingerprint, EXACT_GROUP_PAGE_SIZE]
+		rows = stash.sql_query(query, args).get("rows") or []
+		for fingerprint, scene_ids in rows:
+			yield [int(scene_id) for scene_id in str(scene_ids).split(",")]
+		if len(rows) < EXACT_GROUP_PAGE_SIZE:
+			return
+		last_fingerprint = rows[-1][0]
+
+def find_duplicate_id_groups(distance:PhashDistance=PhashDistance.EXACT, local=False):
+	"""returns the number of duplicate groups and an iterator of the groups as lists of scene ids"""
+	if local:
+		if not find_local_duplicates:
+			log.exit(err="local phash matching needs numpy (pip install numpy)")
+		distance = distance.value if isinstance(distance, PhashDistance) else int(distance)
+		log.info(f"Matching phashes locally within distance {distance}")
+		id_groups = find_local_duplicates(stash, distance)
+		return len(id_groups), iter(id_groups)
+	if distance == PhashDistance.EXACT:
+		rows = stash.sql_query(EXACT_DUPLICATES_COUNT).get("rows") or [[0]]
+		return rows[0][0], iter_exact_duplicate_id_groups()
+	# only ids are requested so the response stays small, details are fetched per batch of groups
+	id_groups = [[int(s["id"]) for s in group] for group in stash.find_duplicate_scenes(distance, fragment="id")]
+	return len(id_groups), iter(id_groups)
+
+def iter_id_batches(id_groups, ignore_scene_ids=set(), done=()):
+	"""yields lists of (index, [scene_id]) holding about DUPLICATE_BATCH_SIZE scenes, ignored scenes are removed
+
+	groups whose scenes are all in done are skipped
+	"""
+	batch = []
+	batch_size = 0
+	for i, id_group in enumerate(id_groups):
+		scene_ids = []
+		for scene_id in id_group:
+			if scene_id in ignore_scene_ids:
+				log.debug(f"Ignore from Tag {scene_id}")
 			else:
-				filtered_group.append(scene)
-
-		if len(filtered_group) > 1:
-			tag_files(filtered_group)
-
-		log.progress(i / total)
+				scene_ids.append(scene_id)
+		if len(scene_ids) < 2 or all(scene_id in done for scene_id in scene_ids):
+			continue
+		batch.append((i, scene_ids))
+		batch_size += len(scene_ids)
+		if batch_size >= DUPLICATE_BATCH_SIZE:
+			yield batch
+			batch = []
+			batch_size = 0
+	if batch:
+		yield batch
+
+def fetch_group_details(batch):
+	return group_details(batch, {int(s["id"]): s for s in find_scenes_by_ids(batch_scene_ids(batch))})
+
+def group_details(batch, scenes):
+	for i, scene_ids in batch:
+		yield i, [scenes[scene_id] for scene_id in scene_ids if scene_id in scenes]
+
+def batch_scene_ids(batch):
+	return [scene_id for _, ids in batch for scene_id in ids]
+
+def fetch_batches(batches):
+	"""yields every batch with {scene_id: scene} of its scenes, up to REQUEST_CONCURRENCY pages are fetched at once with pyCommon"""
+	if not (transport := get_transport()):
+		for batch in batches:
+			yield batch, {int(s["id"]): s for s in find_scenes_by_ids(batch_scene_ids(batch))}
+		return
+	query = FIND_SCENES_BY_IDS.replace("...Scene", SLIM_SCENE_FRAGMENT)
+	requested = deque()
+	def calls():
+		for batch in batches:
+			requested.append(batch)
+			yield query, {"scene_ids": batch_scene_ids(batch)}
+	for data in transport.stream(calls()):
+		yield requested.popleft(), {int(s["id"]): s for s in data["findScenes"]["scenes"]}
+
+def get_transport():
+	global transport
+	concurrency = getattr(config, "REQUEST_CONCURRENCY", 4)
+	if transport is None and AsyncTransport and concurrency > 1:
+		transport = AsyncTransport(stash, concurrency=concurrency, batch_size=getattr(config, "MUTATION_BATCH_SIZE", 500))
+		if instrument:
+			instrument.watch_transport(transport)
+		if recorder:
+			recorder.watch_transport(transport)
+	return transport
+
+def new_mutation_planner():
+	return MutationPlanner(stash, get_transport(), batch_size=getattr(config, "MUTATION_BATCH_SIZE", 500))
+
+def process_duplicates(distance:PhashDistance=PhashDistance.EXACT, local=None, plan_path=None):
+	"""tags duplicate groups in stash, or only writes the decisions to plan_path when it is given"""
+	if local is None:
+		local = getattr(config, "LOCAL_MATCHING", False)
+
+	signature = run_signature(distance, local)
+	incremental = not plan_path and decision_store and decision_store.last_signature() == signature
+	# the journal of a run with the same signature is only started after its cleanup finished
+	journal = None if plan_path else open_journal("process_duplicates", signature)
+	resuming = journal and journal.resumed and (not decision_store or decision_store.resume_run(signature))
+
+	if plan_path:
+		# planning must not change anything in stash, so the ignore tag is not created
+		ignore_tag_id = tag_cache.get(config.IGNORE_TAG_NAME)
+	else:
+		if resuming:
+			log.info(f"resuming an interrupted run, {len(journal.done)} scenes were already tagged")
+		elif not incremental and not clean_scenes():  # clean old results
+			return
+		ignore_tag_id = tag_cache.get(config.IGNORE_TAG_NAME, create=True)
+	ignore_scene_ids = find_tagged_scene_ids(ignore_tag_id) if ignore_tag_id else set()
+
+	total, id_groups = find_duplicate_id_groups(distance, local)
+	log.info(f"Found {total} sets of duplicates.")
 
+	if plan_path:
+		distance = distance.value if isinstance(distance, PhashDistance) else int(distance)
+		with PlanWriter(plan_path, distance=distance, local=local) as plan:
+			for decision in iter_decisions(total, id_groups, ignore_scene_ids):
+				plan.write(decision)
+		log.info(f"Wrote plan for {plan.scenes} scenes in {plan.groups} groups to {plan_path}")
+		return
 
-def tag_files(group):
-	
+	if journal and not resuming:
+		journal.start()
+	if decision_store:
+		if not resuming:
+			decision_store.start_run(signature)
+		finished = tag_changed_groups(total, id_groups, ignore_scene_ids, journal)
+	else:
+		finished = tag_groups(total, id_groups, ignore_scene_ids, journal)
+	if journal and finished:
+		journal.finish()
+
+def tag_groups(total, id_groups, ignore_scene_ids, journal=None):
+	"""tags every duplicate group, groups whose scenes are in the journal were tagged by an interrupted run"""
+	planner = new_mutation_planner()
+	scene_ids = []
+	for decision in iter_decisions(total, id_groups, ignore_scene_ids, done=journal or ()):
+		apply_decision(decision, planner)
+		scene_ids.extend(decision["group"])
+		if len(scene_ids) >= CHECKPOINT_PAGE_SIZE:
+			if not commit_changes(planner, journal, scene_ids):
+				return False
+			scene_ids = []
+	return commit_changes(planner, journal, scene_ids)
+
+def commit_changes(planner, journal, scene_ids):
+	"""sends the queued changes and journals the scenes they were for, False when a request failed"""
+	planner.flush()
+	if planner.failed:
+		# the scenes are tagged again when the task is run again, titles and tags are set to the same values
+		log.error(f"{planner.failed} scene update requests failed, stopping after {len(journal.done) if journal else 0} tagged scenes")
+		return False
+	if journal:
+		journal.commit(scene_ids)
+	return True
+
+def run_signature(distance, local):
+	"""identifies the settings a run was made with, stored decisions are only reused by runs with the same signature"""
+	distance = distance.value if isinstance(distance, PhashDistance) else int(distance)
+	settings = [distance, bool(local), TITLE_TEMPLATE.template, Path(config.__file__).read_text(encoding="utf-8")]
+	return hashlib.sha1(json.dumps(settings).encode()).hexdigest()
+
+def find_scene_attributes(scene_ids):
+	"""file attribute rows of every scene as {scene_id: [row]}, with a row of its gallery ids and one of its tag ids"""
+	attributes = {}
+	managed_names = [config.KEEP_TAG_NAME, config.REMOVE_TAG_NAME, config.UNKNOWN_TAG_NAME]
+	for start in range(0, len(scene_ids), 500):
+		chunk = scene_ids[start:start + 500]
+		placeholders = ",".join("?" * len(chunk))
+		for row in stash.sql_query(SCENE_ATTRIBUTES_QUERY.format(placeholders), chunk).get("rows") or []:
+			scene_id, title, *values = row
+			attributes.setdefault(int(scene_id), []).append([strip_title(title or ""), *values])
+		galleries, tags = {}, {}
+		for scene_id, gallery_id in stash.sql_query(SCENE_GALLERIES_QUERY.format(placeholders), chunk).get("rows") or []:
+			galleries.setdefault(int(scene_id), []).append(int(gallery_id))
+		for scene_id, tag_id in stash.sql_query(SCENE_TAGS_QUERY.format(placeholders), [*chunk, *managed_names]).get("rows") or []:
+			tags.setdefault(int(scene_id), []).append(int(tag_id))
+		for scene_id in chunk:
+			attributes.setdefault(int(scene_id), []).extend([
+				["galleries", sorted(galleries.get(int(scene_id), []))],
+				["tags", sorted(tags.get(int(scene_id), []))],
+			])
+	return attributes
+
+def existing_scene_ids():
+	return {int(row[0]) for row in stash.sql_query("SELECT id FROM scenes").get("rows") or []}
+
+def tag_changed_groups(total, id_groups, ignore_scene_ids, journal=None):
+	"""recomputes only groups whose fingerprint changed since the last run and updates only scenes whose state changed
+
+	scenes in the journal were updated by an interrupted run, the groups decided by that run are reused
+	"""
+	previous = decision_store.scene_states()
+	states = {}
+	table = new_scene_table()
+	reused = 0
+	for batch in iter_id_batches(id_groups, ignore_scene_ids):
+		attributes = find_scene_attributes([scene_id for _, scene_ids in batch for scene_id in scene_ids])
+		fingerprints = [group_fingerprint(scene_ids, attributes) for _, scene_ids in batch]
+		decisions = decision_store.decisions(fingerprints)
+		reused += len(decisions)
+		changed = [(item, fingerprint) for item, fingerprint in zip(batch, fingerprints) if fingerprint not in decisions]
+		if len(table) >= SCENE_TABLE_ROWS:
+			table = new_scene_table()
+		changed_groups = [group for _, group in fetch_group_details([item for item, _ in changed])] if changed else []
+		new_decisions = dict(zip([fingerprint for _, fingerprint in changed], decide_groups(changed_groups, table)))
+		decision_store.save_decisions(new_decisions)
+		decisions.update(new_decisions)
+
+		for decision in decisions.values():
+			for scene in (decision or {}).get("scenes", []):
+				states[scene["id"]] = (scene["title"], tuple(scene["tags"]))
+		log.progress(batch[-1][0] / total)
+	log.info(f"Reused {reused} unchanged groups")
+
+	planner = new_mutation_planner()
+	updated = 0
+	scene_ids = []
+	for scene_id, (title, tags) in states.items():
+		old_title, old_tags = previous.get(scene_id, (None, ()))
+		if (title, tags) == (old_title, old_tags) or scene_id in (journal or ()):
+			continue
+		updated += 1
+		if title != old_title:
+			planner.set_title(scene_id, title)
+		planner.remove_tags(scene_id, [tag_cache.get(name) for name in old_tags if name not in tags])
+		planner.add_tags(scene_id, [tag_cache.get(name, create=True) for name in tags if name not in old_tags])
+		scene_ids.append(scene_id)
+		if len(scene_ids) >= CHECKPOINT_PAGE_SIZE:
+			if not commit_changes(planner, journal, scene_ids):
+				return False
+			scene_ids = []
+
+	# scenes that are no longer duplicates go back to how they were before tagging
+	existing_ids = existing_scene_ids()
+	cleaned = 0
+	for scene_id, (title, tags) in previous.items():
+		if scene_id in states or scene_id not in existing_ids or scene_id in (journal or ()):
+			continue
+		cleaned += 1
+		planner.set_title(scene_id, strip_title(title))
+		planner.remove_tags(scene_id, [tag_cache.get(name) for name in tags])
+		scene_ids.append(scene_id)
+		if len(scene_ids) >= CHECKPOINT_PAGE_SIZE:
+			if not commit_changes(planner, journal, scene_ids):
+				return False
+			scene_ids = []
+	if not commit_changes(planner, journal, scene_ids):
+		return False
+
+	decision_store.set_scene_states(states)
+	decision_store.finish_run()
+	log.info(f"Updated {updated} scenes, cleaned {cleaned} scenes that are no longer duplicates")
+	return True
+
+def apply_plan(plan_path):
+	"""applies the decisions of a plan file written by a plan task"""
+	try:
+		header, decisions = read_plan(plan_path)
+	except (OSError, ValueError) as e:
+		log.exit(err=f"could not read plan {plan_path}: {e}")
+	log.info(f"Applying plan from {dt.datetime.fromtimestamp(header['created'])} (distance {header.get('distance')})")
+
+	if not clean_scenes():  # clean old results
+		return False
+
+	existing_ids = existing_scene_ids()
+	planner = new_mutation_planner()
+	skipped = 0
+	for decision in decisions:
+		scenes = [s for s in decision["scenes"] if s["id"] in existing_ids]
+		skipped += len(decision["scenes"]) - len(scenes)
+		apply_decision({**decision, "scenes": scenes}, planner)
+	planner.flush()
+	if skipped:
+		log.warning(f"Skipped {skipped} scenes from the plan that no longer exist")
+	if planner.failed:
+		# applying the plan again cleans the scenes first and sets the same titles and tags
+		log.error(f"{planner.failed} scene updates from the plan failed, apply the plan again to finish it")
+		return False
+	return True
+
+def apply_decision(decision, planner):
+	for scene in decision["scenes"]:
+		tag_ids = [tag_cache.get(name, create=True) for name in scene["tags"]]
+		planner.update(scene["id"], scene["title"], tag_ids)
+
+def iter_decisions(total, id_groups, ignore_scene_ids, done=()):
+	"""yields the keep/remove/unknown decision for every duplicate group"""
+	table = new_scene_table()
+	for batch, scenes in fetch_batches(iter_id_batches(id_groups, ignore_scene_ids, done)):
+		if len(table) >= SCENE_TABLE_ROWS:
+			table = new_scene_table()
+		groups = [group for _, group in group_details(batch, scenes)]
+		for decision in decide_groups(groups, table):
+			if decision:
+				yield decision
+		log.progress(batch[-1][0] / total)
+
+def new_scene_table():
+	return SceneTable(config.CODEC_PRIORITY, getattr(config, "PATH_PRIORITY", []))
+
+def decide_groups(groups, table):
+	"""decisions for a list of groups of scene dicts, None for groups with fewer than two scenes to compare"""
+	scene_groups = [load_group(group, table) for group in groups]
+	comparable = [scenes for scenes in scene_groups if len(scenes) > 1]
+	keep_scenes = iter(choose_keep_scenes(comparable, table))
+	return [tag_files(scenes, next(keep_scenes)) if len(scenes) > 1 else None for scenes in scene_groups]
+
+def choose_keep_scenes(scene_groups, table):
+	"""the scene to keep from every group, ranked for all groups at once when the compare functions allow it"""
+	if not scene_groups:
+		return []
+	if RANKED_PRIORITY is None:
+		return [pairwise_keep_scene(scenes) for scenes in scene_groups]
+
+	ranker = KeepRanker(table, RANKED_PRIORITY, getattr(config, "PATH_PRIORITY", []))
+	keep_rows, reasons = ranker.keep_rows([[s.row for s in scenes] for scenes in scene_groups])
+	keep_scenes = []
+	for scenes, keep_row in zip(scene_groups, keep_rows):
+		for scene in scenes:
+			scene.remove_reason = reasons.get(scene.row)
+			if scene.row == keep_row:
+				keep_scenes.append(scene)
+	return keep_scenes
+
+def pairwise_keep_scene(group):
 	keep_scene = group[0]
-	total_size = group[0].size
 	for scene in group[1:]:
-		total_size += scene.size
 		better, msg = scene.compare(keep_scene)
 		if better:
 			keep_scene = better
 			log.debug(f"{better.id} better than {keep_scene.id} - {msg}")
+	return keep_scene
+
+def load_group(group, table):
+	"""StashScene views of a group of scene dicts without scenes that can not be compared or are in IGNORE_PATHS"""
+	scene_group = []
+	for s in group:
+		try:
+			scene_group.append(StashScene(table=table, row=table.add(s)))
+		except Exception as e:
+			log.warning(f"Issue parsing SceneID:{s['id']} - {e}")
+	filtered_group = []
+	for scene in scene_group:
+		if ignore_paths.contains(scene.path):
+			log.warning(f"Ignore from Path {scene.id} {scene.path}")
+		else:
+			filtered_group.append(scene)
+	return filtered_group
+
+
+def tag_files(group, keep_scene):
+	"""returns the title and tag names for every scene of the group given the scene to keep"""
+	
+	total_size = sum(scene.size for scene in group)
 
 	reason_tags = [s.remove_reason for s in group if s.remove_reason]
 	total_size = human_bytes(total_size, round=2, prefix="G")
-	reason_tag_ids = [stash.find_tag(f"[Reason: {t}]", fragment="id", create=True)["id"]  for t in reason_tags]
+	reason_tag_names = [reason_tag_name(t) for t in reason_tags]
+	decision = {"group": [s.id for s in group], "keep": keep_scene.id if keep_scene else None, "scenes": []}
 
 	if not keep_scene:
 		log.info(f"could not determine better scene from {group}")
-		if config.UNKNOWN_TAG_NAME:
-			group_id = group[0].id
-			for scene in group:
-				tag_ids = [stash.find_tag(config.UNKNOWN_TAG_NAME, create=True).get("id")]
-				stash.update_scenes({
-					"ids": [scene.id],
-					"title": format_title(total_size, group_id, "U", scene.title),
-					"tag_ids": {"mode": "ADD", "ids": tag_ids},
-				})
-		return
+		if not config.UNKNOWN_TAG_NAME:
+			return
+		group_id = group[0].id
+		for scene in group:
+			decision["scenes"].append({
+				"id": scene.id,
+				"flag": "U",
+				"title": format_title(total_size, group_id, "U", scene.title),
+				"tags": [config.UNKNOWN_TAG_NAME],
+			})
+		return decision
 
 	log.info(f"{keep_scene.id} best of:{[s.id for s in group]} {reason_tags}")
 
 	for scene in group:
 		if scene.id == keep_scene.id:
-			tag_ids = [stash.find_tag(config.KEEP_TAG_NAME, create=True).get("id")]
-			tag_ids.extend(reason_tag_ids)
-			stash.update_scenes({
-				"ids": [scene.id],
+			decision["scenes"].append({
+				"id": scene.id,
+				"flag": "K",
 				"title": format_title(total_size, keep_scene.id,"K", scene.title),
-				"tag_ids": {"mode": "ADD", "ids": tag_ids},
+				"tags": [config.KEEP_TAG_NAME, *reason_tag_names],
 			})
 		else:
-			tag_ids = []
-			tag_ids.append(
-				stash.find_tag(config.REMOVE_TAG_NAME, create=True).get("id")
-			)
+			tags = [config.REMOVE_TAG_NAME]
 			if scene.remove_reason:
-				tag_ids.append(stash.find_tag(f"[Reason: {scene.remove_reason}]", create=True).get("id"))
-			stash.update_scenes({
-				"ids": [scene.id],
+				tags.append(reason_tag_name(scene.remove_reason))
+			decision["scenes"].append({
+				"id": scene.id,
+				"flag": "R",
 				"title": format_title(total_size, keep_scene.id, "R", scene.title),
-				"tag_ids": {"mode": "ADD", "ids": tag_ids},
+				"tags": tags,
 			})
+	return decision
 
 
 def clean_scenes():
-	scene_count, scenes = stash.find_scenes(
-		f={"title": {"modifier": "MATCHES_REGEX", "value": "^\\[PDT: .+?\\]"}},
-		fragment="id title",
-		get_count=True,
-	)
-
+	"""strips [PDT: ...] titles and removes the managed tags, resuming a cleanup that was interrupted
+
+	tagged scenes are read in pages ordered by id, after every page is cleaned its last id is
+	journaled so the next cleanup starts after it instead of reading the cleaned scenes again,
+	returns False when an update failed, scenes can then still have titles or tags of an old run
+	"""
+	# the decision store and an interrupted tag run stop matching the scenes with the first cleaned page,
+	# they are dropped before it so a cleanup that stops early is finished before any scene is tagged again
+	if decision_store:
+		decision_store.clear()
+	if tag_journal := open_journal("process_duplicates"):
+		tag_journal.finish()
+
+	journal = open_journal("clean_scenes")
+	last_id = journal.last if journal and journal.last else 0
+	if last_id:
+		log.info(f"resuming cleanup after SceneID:{last_id}")
+	scene_count = (stash.sql_query(TAGGED_TITLES_COUNT, [last_id]).get("rows") or [[0]])[0][0]
 	log.info(f"Cleaning Titles/Tags of {scene_count} Scenes ")
 
 	# Clean scene Title
-	for i, scene in enumerate(scenes):
-		title = re.sub(r"\[PDT: .+?\]\s+", "", scene["title"])
-		stash.update_scenes({"ids": [scene["id"]], "title": title})
-		log.progress(i / scene_count)
+	cleaned = 0
+	while True:
+		rows = stash.sql_query(TAGGED_TITLES_QUERY, [last_id, CHECKPOINT_PAGE_SIZE]).get("rows") or []
+		if not rows:
+			break
+		mutations = new_mutation_planner()
+		for scene_id, title in rows:
+			if (stripped := strip_title(title)) != title:
+				mutations.set_title(int(scene_id), stripped)
+		mutations.flush()
+		if mutations.failed:
+			# the journal stays before this page so its scenes are cleaned again next time
+			log.error(f"{mutations.failed} title updates failed, stopping cleanup after SceneID:{last_id}")
+			return False
+		last_id = int(rows[-1][0])
+		if journal:
+			journal.commit([last_id])
+		cleaned += len(rows)
+		log.progress(cleaned / max(scene_count, 1))
 
 	# Remove Tags
+	mutations = new_mutation_planner()
 	for tag in get_managed_tags():
-		scene_count, scenes = stash.find_scenes(
-			f={"tags": {"value": [tag["id"]], "modifier": "INCLUDES", "depth": 0}},
-			fragment="id",
-			get_count=True,
-		)
-		if not scene_count > 0:
+		scene_ids = [int(row[0]) for row in stash.sql_query(MANAGED_TAG_SCENES_QUERY, [tag["id"]]).get("rows") or []]
+		if not scene_ids:
 			continue
-		log.info(f'removing tag {tag["name"]} from {scene_count} scenes')
-		stash.update_scenes({
-			"ids": [s["id"] for s in scenes],
-			"tag_ids": {"mode": "REMOVE", "ids": [tag["id"]]},
-		})
-
-def get_managed_tags(fragment="id name"):
-	tags = stash.find_tags(
-		f={"name": {"value": "^\\[Reason", "modifier": "MATCHES_REGEX"}},
-		fragment=fragment,
-	)
-	tag_name_list = [
+		log.info(f'removing tag {tag["name"]} from {len(scene_ids)} scenes')
+		for scene_id in scene_ids:
+			mutations.remove_tags(scene_id, [tag["id"]])
+	mutations.flush()
+	if mutations.failed:
+		# titles are journaled as clean, the tags are looked up again by the next cleanup
+		log.error(f"{mutations.failed} scenes could not be untagged, stopping cleanup")
+		return False
+
+	if journal:
+		journal.finish()
+	return True
+
+def open_journal(task, key=""):
+	"""the journal of task in the plugin folder, with the units an interrupted run with the same key finished
+
+	None without pyCommon, tasks then run from the start every time
+	"""
+	if not Journal:
+		return None
+	return Journal(Path(__file__).parent / f"pdt_{task}.journal", key)
+
+def strip_title(title):
+	return re.sub(r"\[PDT: .+?\]\s+", "", title)
+
+def get_managed_tags():
+	return tag_cache.managed([
 		config.REMOVE_TAG_NAME,
 		config.KEEP_TAG_NAME,
 		config.UNKNOWN_TAG_NAME,
 		# config.IGNORE_TAG_NAME,
-	]
-	for tag_name in tag_name_list:
-		if tag := stash.find_tag(tag_name):
-			tags.append(tag)
-	return tags
+	])
 
 def split_out_oshash_matches():
-
-	dupe_oshash_rows = stash.sql_query('SELECT fingerprint, COUNT(*) c FROM files_fingerprints WHERE type is "oshash" GROUP BY fingerprint HAVING c > 1;').get("rows", [])
-
-	ignore_tag_id = stash.find_tag(config.IGNORE_TAG_NAME, create=True).get("id")
-
-	for i, row in enumerate(dupe_oshash_rows):
-		oshash, _ = row
-		scenes = stash.find_scenes({
-			"oshash":{"value": oshash, "modifier": "EQUALS"},
-			"file_count":{"modifier": "GREATER_THAN","value": 1 },
-			"tags":{"excludes": [ignore_tag_id], "modifier": "INCLUDES_ALL"},
-		}, fragment="id title files {id fingerprints  { type value } }")
-
-		for s in scenes:
-			for f in s["files"][1:]:
-				for fingerprint in f["fingerprints"]:
-					if fingerprint["value"] == oshash:
-						stash.create_scene({
-							"title": s["title"],
-							"file_ids":[f["id"]]
-						})
-		log.progress(i/len(dupe_oshash_rows))
+	"""moves every extra file that shares its oshash with another file into a scene of its own
+
+	the files are found with one sql query and read in pages ordered by file id, after the
+	scenes of a page are created its last file id is journaled so an interrupted split resumes there,
+	a file that was moved is the primary file of its new scene so it is never split twice
+	"""
+	# scenes can only have the ignore tag when it exists
+	ignore_tag_id = tag_cache.get(config.IGNORE_TAG_NAME) or 0
+	journal = open_journal("split_merged_oshash")
+	last_id = journal.last if journal and journal.last else 0
+	if last_id:
+		log.info(f"resuming oshash split after FileID:{last_id}")
+	file_count = (stash.sql_query(MERGED_OSHASH_FILES_COUNT, [last_id, ignore_tag_id]).get("rows") or [[0]])[0][0]
+	log.info(f"splitting {file_count} files with merged oshashes into their own scenes")
+
+	split = 0
+	while True:
+		rows = stash.sql_query(MERGED_OSHASH_FILES_QUERY, [last_id, ignore_tag_id, CHECKPOINT_PAGE_SIZE]).get("rows") or []
+		if not rows:
+			break
+		mutations = new_mutation_planner()
+		for file_id, title in rows:
+			mutations.create_scene({"title": title, "file_ids": [str(file_id)]})
+		mutations.flush()
+		if mutations.failed:
+			# files that were moved are primary files now, the rest are found again from the journal
+			log.error(f"{mutations.failed} scenes could not be created, stopping split after FileID:{last_id}")
+			return
+		last_id = int(rows[-1][0])
+		if journal:
+			journal.commit([last_id])
+		split += len(rows)
+		log.progress(split / max(file_count, 1))
+	if journal:
+		journal.finish()
 
 if __name__ == "__main__":
 	if FRAGMENT["args"].get("hookContext"):
@@ -311,7 +776,19 @@ if __name__ == "__main__":
 		log.warning(f"Issue using config.SCENE_TITLE_TEMPLATE {e}, using default template instead")
 		TITLE_TEMPLATE = Template("$group_size|$scene_id$flag")\
 
+	StashScene.priority = config.PRIORITY
+	StashScene.codec_priorities = config.CODEC_PRIORITY
+	StashScene.path_priorities = getattr(config, "PATH_PRIORITY", [])
+	# keep scenes are ranked with numpy unless a compare function in PRIORITY was changed from the shipped one
+	RANKED_PRIORITY = ranked_priority(config) if ranked_priority and getattr(config, "VECTORIZED_RANKING", True) else None
+	log.debug(f"picking keep scenes {'with vectorized ranking' if RANKED_PRIORITY else 'pairwise'}")
 	for name, func in getmembers(config, isfunction):
 		if re.match(r"^compare_", name):
 			setattr(StashScene, name, func)
+	if instrument_run and (instrument := instrument_run(stash, "phashDuplicateTagger", Path(__file__).parent)):
+		instrument.patch(sys.modules[__name__], "process_duplicates", "choose_keep_scenes", "tag_files", "clean_scenes", "split_out_oshash_matches")
+		instrument.patch(StashScene, "__init__")
+		instrument.patch(SceneTable, "add")
+		if KeepRanker:
+			instrument.patch(KeepRanker, "keep_rows")
 	plugin_main()
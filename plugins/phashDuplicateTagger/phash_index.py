@@ -0,0 +1,174 @@
+from math import comb
+from itertools import combinations
+
+import numpy as np
+
+from hamming import hamming
+
+UINT64_MASK = 0xFFFFFFFFFFFFFFFF
+
+# widest band indexed, each band keeps a lookup table of 2^bits bucket offsets
+MAX_BAND_BITS = 22
+# number of hashes probed at once, bounds the size of the candidate arrays
+PROBE_CHUNK = 1 << 18
+
+PHASH_QUERY = """
+SELECT scenes_files.scene_id, files_fingerprints.fingerprint
+FROM files_fingerprints
+JOIN scenes_files ON scenes_files.file_id = files_fingerprints.file_id
+WHERE files_fingerprints.type = 'phash'
+"""
+
+def parse_phash(value):
+	"""phash fingerprint from the stash database as an unsigned 64 bit int, stored as a signed int or a hex string"""
+	if isinstance(value, str):
+		value = int(value, 16)
+	return int(value) & UINT64_MASK
+
+def flip_masks(bits, radius):
+	"""every mask of bits width with at most radius bits set"""
+	masks = [0]
+	for weight in range(1, radius + 1):
+		for positions in combinations(range(bits), weight):
+			mask = 0
+			for position in positions:
+				mask |= 1 << position
+			masks.append(mask)
+	return np.array(masks, dtype=np.uint64)
+
+def band_widths(count, distance):
+	"""splits 64 bits into the bands that minimize the estimated work to find pairs within distance
+
+	more bands means a smaller search radius per band but narrower bands with fuller buckets,
+	the estimate counts one lookup per flipped probe plus the expected candidates it returns
+	"""
+	best_widths, best_cost = None, None
+	for bands in range(1, 65):
+		widths = [64 // bands + (1 if band < 64 % bands else 0) for band in range(bands)]
+		if widths[0] > MAX_BAND_BITS:
+			continue
+		radius = distance // bands
+		cost = sum(
+			sum(comb(width, weight) for weight in range(radius + 1)) * (1 + count / 2**width)
+			for width in widths
+		)
+		if best_cost is None or cost < best_cost:
+			best_widths, best_cost = widths, cost
+	return best_widths
+
+class PhashIndex:
+	"""multi-index hash over the phashes of every scene file for finding duplicates locally
+
+	hashes are split into m bands, if two hashes are within distance d at least one band
+	differs by no more than d // m bits, so only hashes whose band matches one of the flipped
+	variants of another hash's band are compared, instead of every pair of hashes
+	"""
+
+	def __init__(self, scene_ids, hashes):
+		scene_ids = np.asarray(scene_ids, dtype=np.int64)
+		hashes = np.asarray(hashes, dtype=np.uint64)
+		# identical hashes are only compared once, rows map each (scene, hash) back to its unique hash
+		self.hashes, self.row_hash = np.unique(hashes, return_inverse=True)
+		self.scene_ids, self.row_scene = np.unique(scene_ids, return_inverse=True)
+		self.row_hash = self.row_hash.reshape(-1)
+		self.row_scene = self.row_scene.reshape(-1)
+		# bands are built per distance by pairs()
+		self.bands = {}
+
+	def _build_bands(self, widths):
+		bands = []
+		shift = 0
+		for width in widths:
+			keys = ((self.hashes >> np.uint64(shift)) & np.uint64((1 << width) - 1)).astype(np.int64)
+			order = np.argsort(keys, kind="stable").astype(np.int32)
+			# starts[key]:starts[key+1] is the range of order holding hashes with that band key
+			starts = np.zeros((1 << width) + 1, dtype=np.int32)
+			np.cumsum(np.bincount(keys, minlength=1 << width), out=starts[1:])
+			bands.append((width, keys, order, starts))
+			shift += width
+		return bands
+
+	def __repr__(self) -> str:
+		return f"<PhashIndex ({len(self.scene_ids)} scenes, {len(self.hashes)} hashes)>"
+
+	def __len__(self):
+		return len(self.hashes)
+
+	@classmethod
+	def from_rows(cls, rows):
+		"""builds the index from (scene_id, fingerprint) rows of PHASH_QUERY"""
+		scene_ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+		hashes = np.fromiter((parse_phash(row[1]) for row in rows), dtype=np.uint64, count=len(rows))
+		return cls(scene_ids, hashes)
+
+	@classmethod
+	def from_stash(cls, stash):
+		return cls.from_rows(stash.sql_query(PHASH_QUERY).get("rows") or [])
+
+	def pairs(self, distance):
+		"""yields (i, j) arrays of unique hash indexes with i < j within hamming distance of each other"""
+		widths = band_widths(len(self.hashes), distance)
+		if tuple(widths) not in self.bands:
+			self.bands = {tuple(widths): self._build_bands(widths)}
+		bands = self.bands[tuple(widths)]
+		radius = distance // len(bands)
+		for width, keys, order, starts in bands:
+			for mask in flip_masks(width, radius).astype(np.int64):
+				for start in range(0, len(keys), PROBE_CHUNK):
+					query = np.arange(start, min(start + PROBE_CHUNK, len(keys)))
+					i, j = self._probe(query, keys[query] ^ mask, order, starts)
+					close = hamming(self.hashes[i], self.hashes[j]) <= distance
+					if close.any():
+						yield i[close], j[close]
+
+	@staticmethod
+	def _probe(query, probe_keys, order, starts):
+		left = starts[probe_keys]
+		counts = starts[probe_keys + 1] - left
+		hit = counts > 0
+		query, left, counts = query[hit], left[hit], counts[hit]
+		# expand every query's [left, right) range of matching keys into one candidate per match
+		total = int(counts.sum())
+		starts = np.repeat(left - (np.cumsum(counts) - counts), counts)
+		i = np.repeat(query, counts)
+		j = order[starts + np.arange(total)]
+		keep = i < j
+		return i[keep], j[keep]
+
+	def components(self, edges):
+		"""labels nodes by connected component using min label propagation with pointer jumping"""
+		node_count = len(self.scene_ids) + len(self.hashes)
+		labels = np.arange(node_count)
+		if not edges:
+			return labels
+		a = np.concatenate([e[0] for e in edges])
+		b = np.concatenate([e[1] for e in edges])
+		while True:
+			low = np.minimum(labels[a], labels[b])
+			updated = labels.copy()
+			np.minimum.at(updated, a, low)
+			np.minimum.at(updated, b, low)
+			updated = updated[updated]
+			if np.array_equal(updated, labels):
+				return labels
+			labels = updated
+
+	def groups(self, distance):
+		"""groups of scene ids connected through hashes within distance, the same grouping stash uses for duplicates"""
+		hash_offset = len(self.scene_ids)
+		# every scene is linked to its hashes and every hash to the hashes close to it
+		edges = [(self.row_scene, self.row_hash + hash_offset)]
+		for i, j in self.pairs(distance):
+			edges.append((i + hash_offset, j + hash_offset))
+		labels = self.components(edges)[:hash_offset]
+
+		order = np.argsort(labels, kind="stable")
+		sorted_labels = labels[order]
+		bounds = np.flatnonzero(np.diff(sorted_labels)) + 1
+		groups = [self.scene_ids[members].tolist() for members in np.split(order, bounds) if len(members) > 1]
+		groups.sort(key=lambda group: group[0])
+		return groups
+
+def find_local_duplicates(stash, distance):
+	"""groups of duplicate scene ids within distance found from the phashes stored in stash"""
+	return PhashIndex.from_stash(stash).groups(int(distance))
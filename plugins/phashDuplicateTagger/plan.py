@@ -0,0 +1,53 @@
+import json, os, time
+from pathlib import Path
+
+PLAN_VERSION = 1
+
+class PlanWriter:
+	"""writes duplicate decisions to a jsonl plan file, one group per line after a header line
+
+	the plan is written to a temporary file and only replaces the previous plan once it is complete
+	"""
+
+	def __init__(self, path, **header):
+		self.path = Path(path)
+		self.tmp = self.path.with_suffix(self.path.suffix + ".tmp")
+		self.header = {"plan": PLAN_VERSION, "created": time.time(), **header}
+		self.file = None
+		self.groups = 0
+		self.scenes = 0
+
+	def __repr__(self) -> str:
+		return f"<PlanWriter {self.path} ({self.groups} groups)>"
+
+	def __enter__(self):
+		self.file = open(self.tmp, "w", encoding="utf-8")
+		self.file.write(json.dumps(self.header) + "\n")
+		return self
+
+	def __exit__(self, exc_type, exc, tb):
+		self.file.close()
+		if exc_type:
+			self.tmp.unlink(missing_ok=True)
+			return
+		os.replace(self.tmp, self.path)
+
+	def write(self, decision):
+		self.file.write(json.dumps(decision, separators=(",", ":")) + "\n")
+		self.groups += 1
+		self.scenes += len(decision["scenes"])
+
+def read_plan(path):
+	"""returns the header of a plan file and an iterator of its decisions"""
+	f = open(path, encoding="utf-8")
+	header = json.loads(f.readline() or "{}")
+	if header.get("plan") != PLAN_VERSION:
+		f.close()
+		raise ValueError(f"{path} is not a version {PLAN_VERSION} plan file")
+
+	def decisions():
+		with f:
+			for line in f:
+				if line.strip():
+					yield json.loads(line)
+	return header, decisions()
@@ -0,0 +1,153 @@
+import io, hashlib, inspect, tokenize
+
+import numpy as np
+
+from scene_table import MISSING
+
+# token hashes of the compare functions shipped in config_example.py, a function in config.py is only
+# ranked here when it is unchanged from the shipped one, update these when config_example.py changes
+BUILTIN_COMPARATORS = {
+	"bitrate_per_pixel": "fa131893a4d75a6c44db8c9f0ba5cdabcd53cd4c",
+	"frame_rate": "3a993fb3a877e91e7a77ac55ff7fd5e908472922",
+	"resolution": "3162730a9b052124959ad2ec01a3eccba0d87988",
+	"bitrate": "b89114369b26be501ce897966243627d2c934ce5",
+	"size": "2c2fb217007a6dedc0ae82e9235681732ee55c50",
+	"age": "71b41c51e7d2a695ebc23384f710e83939535667",
+	"encoding": "3585a2f480c0faea9f7b4700dc19125005829f33",
+	"path": "5851c1fbf7aedbe3f367ed253b4e614e67630951",
+	"gallery_count": "b78763543fa83dd3fda8adb5e656bf0bb9b5c56d",
+}
+
+DEFAULT_PATH_PRIORITY = "/root/most/important/path"
+
+def source_hash(func):
+	"""hash of the tokens of a function, ignoring comments, blank lines and indentation"""
+	skip = {tokenize.COMMENT, tokenize.NL, tokenize.NEWLINE, tokenize.INDENT, tokenize.DEDENT}
+	source = inspect.getsource(func)
+	tokens = tokenize.generate_tokens(io.StringIO(source).readline)
+	return hashlib.sha1("\x00".join(t.string for t in tokens if t.type not in skip).encode()).hexdigest()
+
+def ranked_priority(config):
+	"""config.PRIORITY when every compare function it uses can be ranked here, otherwise None"""
+	for name in config.PRIORITY:
+		func = getattr(config, f"compare_{name}", None)
+		try:
+			if not func or source_hash(func) != BUILTIN_COMPARATORS.get(name):
+				return None
+		except (OSError, TypeError, tokenize.TokenError):
+			return None
+	return list(config.PRIORITY)
+
+def sign(values):
+	return np.sign(values).astype(np.int8)
+
+class KeepRanker:
+	"""picks the keep scene of many groups at once with the same decisions as StashScene.compare
+
+	tolerance bands make the comparisons intransitive, so instead of sorting every group is played
+	as the same tournament compare runs, the winner so far against the next scene of the group,
+	with each round run for every group at once and every comparator vectorized over those pairs
+	"""
+
+	def __init__(self, table, priority, path_priority=()):
+		self.table = table
+		self.priority = priority
+		self.path_priority = list(path_priority)
+		# columns are copied, a view would stop the table from growing while it is alive
+		self.sizes = np.array(table.sizes, dtype=np.int64)
+		self.heights = np.array(table.heights, dtype=np.int64)
+		self.widths = np.array(table.widths, dtype=np.int64)
+		self.bitrates = np.array(table.bitrates, dtype=np.int64)
+		self.frame_rates = np.array(table.frame_rates, dtype=np.int64)
+		self.created_at = np.array(table.created_at, dtype=np.int64)
+		self.codec_priorities = np.array(table.codec_priorities, dtype=np.int64)
+		self.path_scores = np.array(table.path_scores, dtype=np.int64)
+		self._gallery_counts = None
+
+	def __repr__(self) -> str:
+		return f"<KeepRanker ({len(self.table)} scenes, {self.priority})>"
+
+	def compare_bitrate_per_pixel(self, a, b):
+		pixels_a = self.widths[a] * self.heights[a] * self.frame_rates[a]
+		pixels_b = self.widths[b] * self.heights[b] * self.frame_rates[b]
+		valid = (pixels_a != 0) & (pixels_b != 0)
+		bpp_a = self.bitrates[a] / np.where(valid, pixels_a, 1)
+		bpp_b = self.bitrates[b] / np.where(valid, pixels_b, 1)
+		return np.where(valid & (np.abs(bpp_a - bpp_b) > 0.01), sign(bpp_a - bpp_b), 0)
+
+	def compare_frame_rate(self, a, b):
+		diff = self.frame_rates[a] - self.frame_rates[b]
+		return np.where(np.abs(diff) >= 5, sign(diff), 0)
+
+	def compare_resolution(self, a, b):
+		return sign(self.heights[a] - self.heights[b])
+
+	def compare_bitrate(self, a, b):
+		return sign(self.bitrates[a] - self.bitrates[b])
+
+	def compare_size(self, a, b):
+		diff = self.sizes[a] - self.sizes[b]
+		return np.where(np.abs(diff) > 100000, sign(diff), 0)
+
+	def compare_age(self, a, b):
+		# older files are better
+		return sign(self.created_at[b] - self.created_at[a])
+
+	def compare_encoding(self, a, b):
+		codec_a, codec_b = self.codec_priorities[a], self.codec_priorities[b]
+		known = (codec_a != MISSING) & (codec_b != MISSING)
+		return np.where(known, sign(codec_b - codec_a), 0)
+
+	def compare_path(self, a, b):
+		if not self.path_priority or self.path_priority[0] == DEFAULT_PATH_PRIORITY:
+			return np.zeros(len(a), dtype=np.int8)
+		known = (self.path_scores[a] != MISSING) & (self.path_scores[b] != MISSING)
+		return np.where(known, sign(self.path_scores[b] - self.path_scores[a]), 0)
+
+	def compare_gallery_count(self, a, b):
+		if self._gallery_counts is None:
+			self._gallery_counts = np.zeros(len(self.table), dtype=np.int64)
+			for row, gallery_ids in self.table.gallery_ids.items():
+				self._gallery_counts[row] = len(gallery_ids)
+		return sign(self._gallery_counts[a] - self._gallery_counts[b])
+
+	# reason set on the worse scene, the same remove_reason the compare functions set
+	REASONS = {
+		"bitrate_per_pixel": "bitrate_per_pxl",
+		"frame_rate": "frame_rate",
+		"resolution": "resolution",
+		"bitrate": "bitrate",
+		"size": "file_size",
+		"age": "age",
+		"encoding": "video_codec",
+		"path": "filepath",
+		"gallery_count": "gallery count",
+	}
+
+	def keep_rows(self, groups):
+		"""returns the keep row of every group (a list of table rows) and {row: remove_reason}"""
+		width = max(len(g) for g in groups)
+		rows = np.full((len(groups), width), -1, dtype=np.int64)
+		for n, group in enumerate(groups):
+			rows[n, :len(group)] = group
+		keep = rows[:, 0].copy()
+		reasons = {}
+
+		for position in range(1, width):
+			active = np.flatnonzero(rows[:, position] >= 0)
+			challenger, current = rows[active, position], keep[active]
+			result = np.zeros(len(active), dtype=np.int8)
+			reason = np.full(len(active), -1, dtype=np.int64)
+			for n, name in enumerate(self.priority):
+				undecided = np.flatnonzero(result == 0)
+				if not len(undecided):
+					break
+				outcome = getattr(self, f"compare_{name}")(challenger[undecided], current[undecided])
+				decided = undecided[outcome != 0]
+				result[decided] = outcome[outcome != 0]
+				reason[decided] = n
+			for n in np.flatnonzero(result != 0):
+				worse = current[n] if result[n] > 0 else challenger[n]
+				reasons[int(worse)] = self.REASONS[self.priority[reason[n]]]
+			keep[active] = np.where(result > 0, challenger, current)
+		return keep, reasons
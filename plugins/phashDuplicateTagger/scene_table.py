@@ -0,0 +1,236 @@
+import re
+import datetime as dt
+from array import array
+from functools import lru_cache
+from operator import attrgetter
+
+import stashapi.log as log
+from stashapi.tools import human_bytes
+
+from path_matcher import PathMatcher
+
+# stored in integer columns for values that are missing
+MISSING = -1
+
+ISO_FORMAT = "%Y-%m-%dT%H:%M:%S%z"
+# distinct timestamps remembered, scenes of one library share many dates and file times
+TIMESTAMP_CACHE_SIZE = 8192
+
+@lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
+def parse_timestamp(ts, format=ISO_FORMAT):
+	"""parses a stash timestamp without fractional seconds
+
+	ISO 8601 timestamps with an offset are parsed with fromisoformat, anything else
+	(other formats, or a python too old to read "Z") goes through strptime
+	"""
+	if format == ISO_FORMAT:
+		try:
+			parsed = dt.datetime.fromisoformat(ts)
+			if parsed.tzinfo is not None:
+				return parsed.replace(microsecond=0)
+		except ValueError:
+			pass
+	ts = re.sub(r"\.\d+", "", ts)  # remove fractional seconds
+	return dt.datetime.strptime(ts, format)
+
+@lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
+def parse_epoch(ts):
+	"""epoch seconds of a stash timestamp"""
+	return int(parse_timestamp(ts).timestamp())
+
+@lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
+def parse_date_ordinal(date):
+	return dt.date.fromisoformat(date).toordinal()
+
+def strip_tagged_title(title):
+	"""title without a [Dupe: ...] or [PDT: ...] prefix left by an earlier run"""
+	if not title.startswith("["):
+		return title
+	title = re.sub(r"^\[Dupe: \d+[KR]\]\s+", "", title)
+	return re.sub(r"^\[PDT: .+?\]\s+", "", title)
+
+class SceneTable:
+	"""the attributes of duplicate scenes that are compared, stored as one typed column per attribute
+
+	every scene is a row, paths, titles and codecs are stored once and referenced by index,
+	rows are read through StashScene views so compare functions still see a scene object
+	"""
+
+	def __init__(self, codec_priority=None, path_priority=()):
+		self.codec_priority = codec_priority or {}
+		self.path_priority = PathMatcher(path_priority)
+		self.ids = array("q")
+		self.sizes = array("q")
+		self.widths = array("l")
+		self.heights = array("l")
+		self.bitrates = array("q")
+		self.frame_rates = array("l")
+		self.durations = array("d")
+		self.codec_priorities = array("l")
+		# created_at as epoch seconds, date as a proleptic ordinal
+		self.created_at = array("q")
+		self.dates = array("l")
+		self.path_index = array("l")
+		self.title_index = array("l")
+		self.codec_index = array("l")
+		# index of the PATH_PRIORITY folder holding the file, len(PATH_PRIORITY) when none does
+		self.path_scores = array("l")
+		self.paths = []
+		self.titles = []
+		self.codecs = []
+		self.codec_lookup = {}
+		# tag and gallery ids are rarely used by compare functions, only scenes that have any are stored
+		self.tag_ids = {}
+		self.gallery_ids = {}
+
+	def __repr__(self) -> str:
+		return f"<SceneTable ({len(self)} scenes)>"
+
+	def __len__(self):
+		return len(self.ids)
+
+	def add(self, scene):
+		"""adds a scene dict with one file and returns its row"""
+		if len(scene["files"]) != 1:
+			raise Exception(f"Scene has {len(scene['files'])} file(s), must have one file for comparing")
+		file = scene["files"][0]
+
+		# convert every value before appending so a bad scene does not leave a partial row
+		values = (
+			int(scene["id"]),
+			int(file["size"]),
+			int(file["width"] or 0),
+			int(file["height"] or 0),
+			int(file["bit_rate"]),
+			int(file["frame_rate"]),
+			float(file["duration"]),
+			parse_epoch(file["created_at"]),
+			parse_date_ordinal(scene["date"]) if scene.get("date") else MISSING,
+		)
+		codec = file["video_codec"].upper()
+		title = strip_tagged_title(scene["title"])
+
+		row = len(self.ids)
+		for column, value in zip(
+			(self.ids, self.sizes, self.widths, self.heights, self.bitrates, self.frame_rates, self.durations, self.created_at, self.dates),
+			values,
+		):
+			column.append(value)
+		if (codec_index := self.codec_lookup.get(codec)) is None:
+			codec_index = self.codec_lookup[codec] = len(self.codecs)
+			self.codecs.append(codec)
+		self.codec_index.append(codec_index)
+		self.codec_priorities.append(self.codec_priority.get(codec, MISSING))
+		self.path_index.append(len(self.paths))
+		self.paths.append(file["path"])
+		if not file["path"]:
+			self.path_scores.append(MISSING)
+		else:
+			score = self.path_priority.match(file["path"])
+			self.path_scores.append(len(self.path_priority.folders) if score is None else score)
+		self.title_index.append(len(self.titles))
+		self.titles.append(title)
+		if scene.get("tags"):
+			self.tag_ids[row] = [t["id"] for t in scene["tags"]]
+		if scene.get("galleries"):
+			self.gallery_ids[row] = [g["id"] for g in scene["galleries"]]
+		return row
+
+def column(name, missing=False):
+	"""read only attribute of a StashScene view backed by a SceneTable column"""
+	get_column = attrgetter(name)
+	if missing:
+		def get(self):
+			value = get_column(self.table)[self.row]
+			return None if value == MISSING else value
+	else:
+		def get(self):
+			return get_column(self.table)[self.row]
+	return property(get)
+
+class StashScene:
+	"""view of one SceneTable row with the attributes compare functions use
+
+	compare functions can set remove_reason on the view, it has no other writable attributes
+	"""
+	__slots__ = ("table", "row", "remove_reason")
+
+	# compare order, codec and path priorities, set from the config by the plugin
+	priority = []
+	codec_priorities = {}
+	path_priorities = []
+
+	id = column("ids")
+	size = column("sizes")  # File size in # of BYTES
+	width = column("widths")
+	height = column("heights")
+	bitrate = column("bitrates")
+	frame_rate = column("frame_rates")
+	duration = column("durations")
+	codec_priority = column("codec_priorities", missing=True)
+	path_score = column("path_scores", missing=True)
+
+	def __init__(self, scene=None, table=None, row=None) -> None:
+		if table is None:
+			table = SceneTable(self.codec_priorities, self.path_priorities)
+			row = table.add(scene)
+		self.table = table
+		self.row = row
+		self.remove_reason = None
+		if self.codec_priority is None:
+			log.warning(f"could not find codec {self.codec} used in SceneID:{self.id}")
+
+	@property
+	def created_at(self):
+		return dt.datetime.fromtimestamp(self.table.created_at[self.row], dt.timezone.utc)
+
+	@property
+	def date(self):
+		date = self.table.dates[self.row]
+		return None if date == MISSING else dt.datetime.fromordinal(date)
+
+	@property
+	def path(self):
+		return self.table.paths[self.table.path_index[self.row]]
+
+	@property
+	def title(self):
+		return self.table.titles[self.table.title_index[self.row]]
+
+	@property
+	def codec(self):
+		return self.table.codecs[self.table.codec_index[self.row]]
+
+	@property
+	def tag_ids(self):
+		return self.table.tag_ids.get(self.row, [])
+
+	@property
+	def gallery_ids(self):
+		return self.table.gallery_ids.get(self.row, [])
+
+	def __repr__(self) -> str:
+		return f"<StashScene ({self.id})>"
+
+	def __str__(self) -> str:
+		return f"id:{self.id}, height:{self.height}, size:{human_bytes(self.size)}, file_created_at:{self.created_at}, title:{self.title}"
+
+	def compare(self, other):
+		if not (isinstance(other, StashScene)):
+			raise Exception(f"can only compare to <StashScene> not <{type(other)}>")
+
+		if self.id == other.id:
+			return None, f"Matching IDs {self.id}=={other.id}"
+
+		def compare_not_found(*args, **kwargs):
+			raise Exception("comparison not found")
+		for type in self.priority:
+			try:
+				compare_function = getattr(self, f"compare_{type}", compare_not_found)
+				result = compare_function(other)
+				if result and len(result) == 2:
+					best, msg = result
+					return best, msg
+			except Exception as e:
+				log.error(f"Issue Comparing {self.id} {other.id} using <{type}> {e}")
+		return None, f"{self.id} worse than {other.id}"
@@ -0,0 +1,140 @@
+import re, json, os
+from pathlib import Path
+
+import stashapi.log as log
+
+REASON_TAG_FORMAT = "[Reason: {}]"
+
+FIND_TAGS_BY_IDS = """
+query FindTagsByIds($ids: [ID!]) {
+	findTags(ids: $ids, filter: {per_page: -1}) {
+		tags { id name aliases }
+	}
+}
+"""
+
+def regex_escape(value):
+	"""escapes regex syntax for stash, which rejects the escaped spaces re.escape produces"""
+	return re.sub(r"([\\.^$|?*+()\[\]{}])", r"\\\1", value)
+
+def reason_tag_name(reason):
+	return REASON_TAG_FORMAT.format(reason)
+
+class TagCache:
+	"""resolves tag names to ids with one query per run instead of one per scene
+
+	the cache is warmed with a single regex query for every tag the plugin manages,
+	names missing after that are looked up (and created) once and remembered,
+	when a path is given the name -> id map is saved there and validated against stash on the next run
+	"""
+
+	def __init__(self, stash, names, path=None):
+		self.stash = stash
+		self.names = [n for n in names if n]
+		self.path = Path(path) if path else None
+		self.ids = {}
+		self.tags = {}
+		self.warm = False
+		self.dirty = False
+
+	def __repr__(self) -> str:
+		return f"<TagCache ({len(self.tags)} tags)>"
+
+	def _add(self, tag):
+		self.tags[tag["id"]] = tag
+		for name in [tag["name"], *(tag.get("aliases") or [])]:
+			if name:
+				self.ids[name.lower()] = tag["id"]
+
+	def _pattern(self, names=None):
+		names = "|".join(regex_escape(n) for n in (names if names is not None else self.names) if n)
+		reason = regex_escape(REASON_TAG_FORMAT.split("{}")[0])
+		return f"^({names}|{reason}.+)$" if names else f"^{reason}.+$"
+
+	def _find(self, names=None):
+		return self.stash.find_tags(
+			f={"name": {"value": self._pattern(names), "modifier": "MATCHES_REGEX"}},
+			filter={"per_page": -1},
+			fragment="id name aliases",
+		)
+
+	def load(self):
+		"""reads the saved cache, keeping only tags that still exist in stash under the same name"""
+		if not self.path or not self.path.exists():
+			return False
+		try:
+			saved = json.loads(self.path.read_text(encoding="utf-8"))
+			if not saved:
+				return False
+			result = self.stash.call_GQL(FIND_TAGS_BY_IDS, {"ids": [t["id"] for t in saved]})
+		except Exception as e:
+			log.debug(f"could not use saved tag cache {self.path}: {e}")
+			return False
+		current = {t["id"]: t for t in result["findTags"]["tags"]}
+		stale = [t for t in saved if current.get(t["id"], {}).get("name") != t["name"]]
+		if stale:
+			log.debug(f"saved tag cache has {len(stale)} stale tags, refreshing")
+			return False
+		for tag in current.values():
+			self._add(tag)
+		return True
+
+	def save(self):
+		if not self.path or not self.dirty:
+			return
+		tmp = self.path.with_suffix(".tmp")
+		tmp.write_text(json.dumps([{"id": t["id"], "name": t["name"]} for t in self.tags.values()]), encoding="utf-8")
+		os.replace(tmp, self.path)
+		self.dirty = False
+
+	def refresh(self):
+		"""warms the cache with every managed tag, loading the saved cache when it is still valid"""
+		self.ids, self.tags = {}, {}
+		self.warm = True
+		if self.load():
+			return
+		for tag in self._find():
+			self._add(tag)
+		self.dirty = True
+
+	def get(self, name, create=False):
+		"""id of the tag with this name, optionally creating it, None if it does not exist"""
+		if not name:
+			return None
+		if not self.warm:
+			self.refresh()
+		if tag_id := self.ids.get(name.lower()):
+			return tag_id
+		tag = self.stash.find_tag(name, fragment="id name aliases", create=create)
+		if not tag:
+			return None
+		self._add(tag)
+		self.dirty = True
+		return tag["id"]
+
+	def managed(self, names=None):
+		"""tags created by the plugin, every reason tag and the given names
+
+		they are looked up in stash again, a saved cache misses the tags created by a run that stopped before save()
+		"""
+		if not self.warm:
+			self.refresh()
+		for tag in self._find(names):
+			if tag["id"] not in self.tags:
+				self._add(tag)
+				self.dirty = True
+		names = {n.lower() for n in (names if names is not None else self.names) if n}
+		prefix = REASON_TAG_FORMAT.split("{}")[0].lower()
+		return [
+			{"id": t["id"], "name": t["name"]}
+			for t in self.tags.values()
+			if t["name"].lower() in names or t["name"].lower().startswith(prefix)
+		]
+
+	def forget(self, tag_id):
+		"""drops a destroyed tag from the cache"""
+		if tag := self.tags.pop(tag_id, None):
+			for name in [tag["name"], *(tag.get("aliases") or [])]:
+				if name:
+					self.ids.pop(name.lower(), None)
+			self.dirty = True
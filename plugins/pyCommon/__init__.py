@@ -0,0 +1,5 @@
+"""code shared by the plugins in this repository, installed as its own plugin
+
+plugins that use it list `# requires: pyCommon` in their yml and add the folder holding
+their own plugin folder to sys.path, where stash installs pyCommon next to them
+"""
@@ -0,0 +1,107 @@
+"""end to end benchmark of a plugin task replayed from a recorded fixture, no stash server needed
+
+	python benchmarks/bench_replay.py phashDuplicateTagger pdt_high.jsonl.gz --args '{"mode": "tag_high"}'
+	python benchmarks/bench_replay.py performerBodyCalculator pbc.jsonl.gz --args '{"mode": "run_calculator"}' --scale 1 10 100
+
+record a fixture by running the task once in stash with PYCOMMON_RECORD=<fixture path> set in the
+environment of stash, the plugin and pyCommon are copied to a temporary folder for every run so
+files the plugin writes (caches, checkpoints, decisions) start empty, the stand-in server answers
+from the fixture with every scene and performer copied `scale` times, wall time, round trips and the
+peak RSS of the plugin process are reported
+
+sql responses are not scaled, a run that got sql responses is flagged when scale is above 1,
+findFileErrors reads the stash log from disk and the log is not part of a fixture, it can not be replayed
+"""
+import os, re, sys, json, time, shutil, argparse, platform, tempfile, subprocess
+from pathlib import Path
+
+PLUGINS = Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, str(PLUGINS))
+from pyCommon.stand_in import StandInServer
+from pyCommon.replay import ReplayResolver
+
+def plugin_entry(plugin_dir):
+	"""the script the plugin yml runs"""
+	for yml in plugin_dir.glob("*.yml"):
+		if match := re.search(r'"\{pluginDir\}/([^"]+\.py)"', yml.read_text(encoding="utf-8")):
+			return match.group(1)
+	raise SystemExit(f"no python script found in the yml of {plugin_dir}")
+
+def prepare_plugin(plugin_dir, folder):
+	"""copies the plugin and pyCommon into folder, with config.py made from the example when there is none"""
+	target = folder / plugin_dir.name
+	ignore = shutil.ignore_patterns("__pycache__", "*.db", "*.json", "*.jsonl", "*.gz", "*.txt", "benchmarks")
+	shutil.copytree(plugin_dir, target, ignore=ignore)
+	shutil.copytree(PLUGINS / "pyCommon", folder / "pyCommon", ignore=ignore)
+	for example in ("config_example.py", "example_config.py"):
+		if (target / example).exists() and not (target / "config.py").exists():
+			shutil.copy(target / example, target / "config.py")
+	return target
+
+def peak_rss_mb(process_rusage):
+	# ru_maxrss is KB on linux, bytes on macos
+	return process_rusage.ru_maxrss / (1024**2 if sys.platform == "darwin" else 1024)
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("plugin", help="folder name of the plugin in plugins/")
+	parser.add_argument("fixture", help="gzipped fixture recorded with PYCOMMON_RECORD")
+	parser.add_argument("--args", default='{"mode": "tag_high"}', help="task args as json, the defaultArgs of the task")
+	parser.add_argument("--scale", type=int, nargs="+", default=[1])
+	parser.add_argument("--latency", type=float, default=0.0, help="seconds the stand-in server waits per request")
+	parser.add_argument("--verbose", action="store_true", help="print the plugin log")
+	parser.add_argument("--json", help="append results as json lines to this file")
+	args = parser.parse_args()
+
+	plugin_dir = PLUGINS / args.plugin
+	task_args = json.loads(args.args)
+	env = dict(os.environ)
+	env.pop("PYCOMMON_RECORD", None)
+
+	print(f"{'plugin':>24} {'scale':>6} {'seconds':>8} {'requests':>9} {'peak MB':>8} {'exit':>5}")
+	for scale in args.scale:
+		resolver = ReplayResolver(args.fixture, scale=scale)
+		with tempfile.TemporaryDirectory() as folder, StandInServer(resolver, latency=args.latency) as server:
+			entry = prepare_plugin(plugin_dir, Path(folder)) / plugin_entry(plugin_dir)
+			fragment = json.dumps({
+				"server_connection": {"Scheme": "http", "Host": server.host, "Port": server.port},
+				"args": task_args,
+			})
+			start = time.perf_counter()
+			process = subprocess.Popen(
+				[sys.executable, entry.name], cwd=entry.parent, env=env,
+				stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+			)
+			process.stdin.write(fragment.encode("utf-8"))
+			process.stdin.close()
+			# the plugin log is read while it runs so a full pipe never blocks it, stdout only gets the exit message
+			stderr = process.stderr.read().decode("utf-8", "replace")
+			stdout = process.stdout.read().decode("utf-8", "replace")
+			_, status, rusage = os.wait4(process.pid, 0)
+			seconds = time.perf_counter() - start
+			process.returncode = os.waitstatus_to_exitcode(status)
+
+		if args.verbose or process.returncode:
+			print(stderr.replace("\x01", "").replace("\x02", " "), file=sys.stderr)
+		result = {
+			"plugin": args.plugin,
+			"args": task_args,
+			"scale": scale,
+			"seconds": seconds,
+			"requests": server.requests,
+			"unscaled_sql": resolver.unscaled,
+			"peak_rss_mb": peak_rss_mb(rusage),
+			"exit_code": process.returncode,
+			"output": stdout.strip()[-200:],
+			"python": platform.python_version(),
+			"time": time.time(),
+		}
+		print(f"{args.plugin:>24} {scale:>6} {seconds:>8.2f} {server.requests:>9} {result['peak_rss_mb']:>8.1f} {process.returncode:>5}")
+		if scale > 1 and resolver.unscaled:
+			print(f"{'':>24} {resolver.unscaled} sql responses were replayed at the recorded size, not scaled x{scale}", file=sys.stderr)
+		if args.json:
+			with open(args.json, "a", encoding="utf-8") as f:
+				f.write(json.dumps(result) + "\n")
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,111 @@
+"""round trips per second of AsyncTransport against sequential StashInterface calls on a stand-in server
+
+	python benchmarks/bench_transport.py
+	python benchmarks/bench_transport.py --count 5000 --latency 0.005 --json results.jsonl
+
+the stand-in server waits `latency` seconds per request like stash does while it works on a query,
+queries are timed sequentially through StashInterface.call_GQL (the path plugins use today) and
+through the transport at several concurrencies, with repeated queries to show coalescing, and
+single scene updates are timed one request each against batched aliased mutations
+"""
+import re, sys, json, time, random, argparse, platform
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+import stashapi.log
+from stashapi.stashapp import StashInterface
+from pyCommon.transport import AsyncTransport
+from pyCommon.stand_in import StandInServer
+
+FIND_SCENE = "query FindScene($id: ID!) { findScene(id: $id) { id title } }"
+SCENE_UPDATE = "mutation SceneUpdate($input: SceneUpdateInput!) { sceneUpdate(input: $input) { id } }"
+
+def resolve(query, variables):
+	"""answers the few queries StashInterface and the benchmark send"""
+	if "version" in query:
+		return {"version": {"version": "v0.27.0", "hash": "bench", "build_time": "2024-01-01 00:00:00"}}
+	if "apiKey" in query:
+		return {"configuration": {"general": {"apiKey": ""}}}
+	if "findScene" in query:
+		return {"findScene": {"id": variables["id"], "title": f"scene {variables['id']}"}}
+	# one field per mutation, plain or aliased by the transport
+	data = {}
+	for alias, field, variable in re.findall(r"(?:(\w+):\s*)?(\w+)\(input:\s*\$(\w+)\)", query):
+		data[alias or field] = {"id": variables[variable]["id"]}
+	return data
+
+def timed(name, server, count, run):
+	start_requests = server.requests
+	start = time.perf_counter()
+	run()
+	seconds = time.perf_counter() - start
+	return {
+		"case": name,
+		"operations": count,
+		"requests": server.requests - start_requests,
+		"seconds": seconds,
+		"ops_per_sec": count / seconds,
+	}
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--count", type=int, default=2000)
+	parser.add_argument("--latency", type=float, default=0.002, help="seconds the stand-in server waits per request")
+	parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+	parser.add_argument("--distinct", type=int, default=50, help="distinct scenes in the repeated query case")
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--json", help="append results as json lines to this file")
+	args = parser.parse_args()
+
+	# StashInterface logs its connection in the plugin log format, that is not part of what is measured
+	stashapi.log.debug = lambda *args, **kwargs: None
+	rng = random.Random(args.seed)
+	ids = [str(n) for n in range(args.count)]
+	repeated = [str(rng.randrange(args.distinct)) for _ in range(args.count)]
+	results = []
+
+	with StandInServer(resolve, latency=args.latency) as server:
+		stash = StashInterface({"Host": server.host, "Port": server.port})
+		results.append(timed("sequential queries", server, args.count, lambda: [
+			stash.call_GQL(FIND_SCENE, {"id": scene_id}) for scene_id in ids
+		]))
+		for concurrency in args.concurrency:
+			with AsyncTransport(stash, concurrency=concurrency) as transport:
+				results.append(timed(f"transport x{concurrency} queries", server, args.count, lambda: list(
+					transport.stream((FIND_SCENE, {"id": scene_id}) for scene_id in ids)
+				)))
+		with AsyncTransport(stash, concurrency=max(args.concurrency)) as transport:
+			results.append(timed(f"transport x{transport.concurrency} repeated", server, args.count, lambda: list(
+				transport.stream((FIND_SCENE, {"id": scene_id}) for scene_id in repeated)
+			)))
+
+		results.append(timed("sequential updates", server, args.count, lambda: [
+			stash.call_GQL(SCENE_UPDATE, {"input": {"id": scene_id}}) for scene_id in ids
+		]))
+		with AsyncTransport(stash, concurrency=max(args.concurrency)) as transport:
+			def batched_updates():
+				futures = [transport.submit_mutation("sceneUpdate", {"id": scene_id}, "SceneUpdateInput!") for scene_id in ids]
+				return [future.result() for future in futures]
+			results.append(timed(f"transport x{transport.concurrency} updates", server, args.count, batched_updates))
+
+	baseline = {"queries": results[0]["ops_per_sec"]}
+	print(f"{'case':>24} {'ops':>7} {'requests':>9} {'seconds':>8} {'ops/s':>9} {'speedup':>8}")
+	for result in results:
+		kind = "updates" if result["case"].endswith("updates") else "queries"
+		baseline.setdefault(kind, result["ops_per_sec"])
+		result.update({
+			"latency": args.latency,
+			"speedup": result["ops_per_sec"] / baseline[kind],
+			"python": platform.python_version(),
+			"time": time.time(),
+		})
+		print(
+			f"{result['case']:>24} {result['operations']:>7} {result['requests']:>9} "
+			f"{result['seconds']:>8.2f} {result['ops_per_sec']:>9.0f} {result['speedup']:>7.1f}x"
+		)
+		if args.json:
+			with open(args.json, "a", encoding="utf-8") as f:
+				f.write(json.dumps(result) + "\n")
+
+if __name__ == "__main__":
+	main()
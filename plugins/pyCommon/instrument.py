@@ -0,0 +1,192 @@
+import os, re, json, time, atexit, threading
+from array import array
+from pathlib import Path
+from functools import wraps
+
+import stashapi.log as log
+
+# set to 1 to instrument every plugin run without changing plugin settings, used by benchmarks
+ENV_VAR = "PYCOMMON_INSTRUMENT"
+# calls kept in the chrome trace, later calls are still counted in the summary
+MAX_TRACE_EVENTS = 200_000
+PERCENTILES = (50, 95, 99)
+
+OPERATION_NAME = re.compile(r"^\s*(?:query|mutation)\s+(\w+)")
+
+def instrument_run(stash, plugin_id, folder):
+	"""an Instrument for this run when the plugin setting `instrument` or PYCOMMON_INSTRUMENT is set, else None"""
+	enabled = os.environ.get(ENV_VAR, "").lower() in ("1", "true", "yes")
+	if not enabled:
+		try:
+			enabled = bool(stash.find_plugin_config(plugin_id, {"instrument": False}).get("instrument"))
+		except Exception:
+			enabled = False
+	if not enabled:
+		return None
+	instrument = Instrument(plugin_id, folder)
+	instrument.watch_stash(stash)
+	return instrument
+
+def percentile(values, p):
+	"""nearest rank percentile of sorted values"""
+	if not values:
+		return 0.0
+	return values[min(len(values) - 1, max(0, round(p / 100 * len(values) + 0.5) - 1))]
+
+class Stat:
+	__slots__ = ("calls", "wall", "cpu", "durations", "bytes_sent", "bytes_received")
+
+	def __init__(self):
+		self.calls = 0
+		self.wall = 0.0
+		self.cpu = 0.0
+		self.durations = array("d")
+		self.bytes_sent = 0
+		self.bytes_received = 0
+
+class Instrument:
+	"""records call counts, wall and cpu time, payload sizes and latency percentiles of a plugin run
+
+	functions are timed by replacing them with a wrapper (patch), stash requests are timed per
+	graphql operation with the bytes sent and received, json decoding of responses is timed
+	on its own, at exit a summary table and a chrome trace (chrome://tracing, ui.perfetto.dev)
+	are written to the plugin folder
+	"""
+
+	def __init__(self, name, folder):
+		self.name = name
+		self.folder = Path(folder)
+		self.stats = {}
+		self.events = []
+		self.dropped_events = 0
+		self.lock = threading.Lock()
+		self.local = threading.local()
+		self.started = time.perf_counter()
+		self.pid = os.getpid()
+		atexit.register(self.write)
+
+	def __repr__(self) -> str:
+		return f"<Instrument ({self.name}, {len(self.stats)} names)>"
+
+	def record(self, name, start, wall, cpu, bytes_sent=0, bytes_received=0):
+		with self.lock:
+			if (stat := self.stats.get(name)) is None:
+				stat = self.stats[name] = Stat()
+			stat.calls += 1
+			stat.wall += wall
+			stat.cpu += cpu
+			stat.durations.append(wall)
+			stat.bytes_sent += bytes_sent
+			stat.bytes_received += bytes_received
+			if len(self.events) < MAX_TRACE_EVENTS:
+				self.events.append({
+					"name": name,
+					"ph": "X",
+					"ts": (start - self.started) * 1e6,
+					"dur": wall * 1e6,
+					"pid": self.pid,
+					"tid": threading.get_ident(),
+				})
+			else:
+				self.dropped_events += 1
+
+	def wrap(self, func, name=None):
+		name = name or getattr(func, "__qualname__", repr(func))
+		@wraps(func)
+		def timed(*args, **kwargs):
+			start, cpu_start = time.perf_counter(), time.thread_time()
+			try:
+				return func(*args, **kwargs)
+			finally:
+				self.record(name, start, time.perf_counter() - start, time.thread_time() - cpu_start)
+		return timed
+
+	def patch(self, owner, *names):
+		"""replaces functions or methods of a module or class with timed wrappers"""
+		for attr in names:
+			setattr(owner, attr, self.wrap(getattr(owner, attr)))
+
+	def watch_stash(self, stash):
+		"""times every graphql request of a StashInterface by operation name, with its payload sizes"""
+		instrument = self
+		gql, handle_response = stash._GQL, stash._handle_GQL_response
+
+		def timed_gql(query, variables={}):
+			match = OPERATION_NAME.match(query)
+			name = f"graphql {match.group(1) if match else 'anonymous'}"
+			instrument.local.sizes = (0, 0)
+			start, cpu_start = time.perf_counter(), time.thread_time()
+			try:
+				return gql(query, variables)
+			finally:
+				instrument.record(name, start, time.perf_counter() - start, time.thread_time() - cpu_start, *instrument.local.sizes)
+
+		stash._GQL = timed_gql
+		stash._handle_GQL_response = self.wrap(handle_response, "graphql decode response")
+		stash.s.hooks["response"].append(self._record_sizes)
+
+	def watch_transport(self, transport):
+		"""times the requests an AsyncTransport sends from its worker threads"""
+		instrument = self
+		post = transport._post
+
+		def timed_post(payload):
+			match = OPERATION_NAME.match(payload.get("query", ""))
+			name = f"transport {match.group(1) if match else 'anonymous'}"
+			instrument.local.sizes = (0, 0)
+			start, cpu_start = time.perf_counter(), time.thread_time()
+			try:
+				return post(payload)
+			finally:
+				instrument.record(name, start, time.perf_counter() - start, time.thread_time() - cpu_start, *instrument.local.sizes)
+
+		transport._post = timed_post
+		transport.session.hooks["response"].append(self._record_sizes)
+
+	def _record_sizes(self, response, *args, **kwargs):
+		"""response hook keeping the payload sizes of the request the current thread is sending"""
+		self.local.sizes = (len(response.request.body or b""), len(response.content))
+
+	def summary(self):
+		"""rows of name, calls, wall, cpu, p50/p95/p99 in ms and bytes, slowest total first"""
+		rows = []
+		with self.lock:
+			stats = list(self.stats.items())
+		for name, stat in sorted(stats, key=lambda item: item[1].wall, reverse=True):
+			durations = sorted(stat.durations)
+			rows.append({
+				"name": name,
+				"calls": stat.calls,
+				"wall_s": stat.wall,
+				"cpu_s": stat.cpu,
+				**{f"p{p}_ms": percentile(durations, p) * 1000 for p in PERCENTILES},
+				"bytes_sent": stat.bytes_sent,
+				"bytes_received": stat.bytes_received,
+			})
+		return rows
+
+	def format_summary(self):
+		rows = self.summary()
+		width = max([len(r["name"]) for r in rows] + [4])
+		lines = [
+			f"{self.name} ran for {time.perf_counter() - self.started:.2f}s",
+			f"{'name':<{width}} {'calls':>8} {'wall s':>9} {'cpu s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'sent KB':>9} {'recv KB':>9}",
+		]
+		for r in rows:
+			lines.append(
+				f"{r['name']:<{width}} {r['calls']:>8} {r['wall_s']:>9.3f} {r['cpu_s']:>9.3f} {r['p50_ms']:>9.2f} "
+				f"{r['p95_ms']:>9.2f} {r['p99_ms']:>9.2f} {r['bytes_sent'] / 1024:>9.1f} {r['bytes_received'] / 1024:>9.1f}"
+			)
+		if self.dropped_events:
+			lines.append(f"{self.dropped_events} calls after the first {MAX_TRACE_EVENTS} are not in the trace")
+		return "\n".join(lines)
+
+	def write(self):
+		"""writes <name>_profile.txt and <name>_trace.json, once"""
+		atexit.unregister(self.write)
+		summary = self.format_summary()
+		(self.folder / f"{self.name}_profile.txt").write_text(summary + "\n", encoding="utf-8")
+		with self.lock:
+			trace = {"traceEvents": self.events, "displayTimeUnit": "ms"}
+		(self.folder / f"{self.name}_trace.json").write_text(json.dumps(trace), encoding="utf-8")
+		log.info(summary)
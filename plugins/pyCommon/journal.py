@@ -0,0 +1,103 @@
+import os, json
+from pathlib import Path
+
+class Journal:
+	"""append-only file of the units of work a task has finished, so an interrupted task continues after them
+
+	a journal belongs to one run of a task, identified by `key` (the settings or data the run works on),
+	a journal left with another key is ignored and replaced when the run starts, units are written
+	with commit() once the changes they stand for are confirmed by stash, one line per commit that
+	is fsync'd before commit() returns, a line torn by a crash is dropped when the journal is read
+
+	work done after the last commit is done again when the task resumes, so it has to give the
+	same result when it is repeated, like setting a title or adding a tag
+	"""
+
+	def __init__(self, path, key=""):
+		self.path = Path(path)
+		self.key = key
+		self.done = set()
+		# the unit committed last, the position to continue from for tasks that work through ordered rows
+		self.last = None
+		self.file = None
+		self.resumed = self._load()
+		# units can be appended to the file, it holds the header of this run
+		self.started = self.resumed
+
+	def __repr__(self) -> str:
+		return f"<Journal ({self.path}, {len(self.done)} units{', resumed' if self.resumed else ''})>"
+
+	def __contains__(self, unit):
+		return unit in self.done
+
+	def _load(self):
+		"""reads the units of an earlier run with the same key, True when there is one
+
+		a line torn by a crash is cut off the file, so the lines appended by this run start on a line of their own
+		"""
+		try:
+			with open(self.path, "rb") as f:
+				header = json.loads(f.readline())
+				if header.get("key") != self.key:
+					return False
+				# end of the last complete line
+				end = f.tell()
+				for line in iter(f.readline, b""):
+					try:
+						if not line.endswith(b"\n"):
+							raise ValueError("line without end")
+						units = json.loads(line)
+					except ValueError:
+						break
+					self.done.update(units)
+					if units:
+						self.last = units[-1]
+					end = f.tell()
+				torn = f.seek(0, os.SEEK_END) > end
+			if torn:
+				os.truncate(self.path, end)
+		except (OSError, ValueError, AttributeError):
+			return False
+		return True
+
+	def start(self):
+		"""begins a new journal for this run, forgetting the units of any earlier run"""
+		self.close()
+		self.done = set()
+		self.last = None
+		self.resumed = self.started = False
+		tmp_path = self.path.with_suffix(".tmp")
+		with open(tmp_path, "w", encoding="utf-8") as f:
+			f.write(json.dumps({"key": self.key}) + "\n")
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp_path, self.path)
+		self.started = True
+
+	def commit(self, units):
+		"""records units as finished, they are on disk when this returns"""
+		units = list(units)
+		if not units:
+			return
+		if not self.started:
+			self.start()
+		if self.file is None:
+			self.file = open(self.path, "a", encoding="utf-8")
+		self.file.write(json.dumps(units) + "\n")
+		self.file.flush()
+		os.fsync(self.file.fileno())
+		self.done.update(units)
+		self.last = units[-1]
+
+	def close(self):
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+
+	def finish(self):
+		"""removes the journal once the task is done, the next run starts from the beginning"""
+		self.close()
+		self.path.unlink(missing_ok=True)
+		self.done = set()
+		self.last = None
+		self.resumed = self.started = False
@@ -0,0 +1,233 @@
+import os, re, gzip, json, atexit, threading
+from collections import defaultdict
+
+# set to a path to record the graphql traffic of a plugin run into a fixture
+ENV_VAR = "PYCOMMON_RECORD"
+FIXTURE_VERSION = 1
+# copy n of a scaled entity has id + n * ID_STRIDE, larger than any id of a real library
+ID_STRIDE = 10**8
+
+OPERATION = re.compile(r"^\s*(query|mutation)\b\s*(\w*)")
+FIELD = re.compile(r"(?:(\w+)\s*:\s*)?(\w+)\s*[({]")
+
+def normalize_query(query):
+	return " ".join(query.split())
+
+def request_key(query, variables):
+	return normalize_query(query), json.dumps(variables or {}, sort_keys=True, default=str)
+
+def record_run(stash, plugin_id):
+	"""a Recorder of this run when PYCOMMON_RECORD is set to the fixture path, else None"""
+	if not (path := os.environ.get(ENV_VAR)):
+		return None
+	recorder = Recorder(path, plugin=plugin_id, stash_version=str(getattr(stash, "version", "")))
+	recorder.watch_session(stash.s)
+	# StashInterface reads the schema while connecting, before it could be recorded, a replay needs it to connect
+	stash._get_fragments_introspection({}, {})
+	return recorder
+
+class Recorder:
+	"""records every graphql request and response sent through a requests session into a fixture
+
+	the fixture is gzipped json lines, a header followed by one {query, variables, response}
+	per request in the order they were sent, written when the plugin exits
+	"""
+
+	def __init__(self, path, **header):
+		self.path = path
+		self.header = {"version": FIXTURE_VERSION, **header}
+		self.entries = []
+		self.lock = threading.Lock()
+		atexit.register(self.write)
+
+	def __repr__(self) -> str:
+		return f"<Recorder ({self.path}, {len(self.entries)} requests)>"
+
+	def watch_session(self, session):
+		session.hooks["response"].append(self.capture)
+
+	def watch_transport(self, transport):
+		self.watch_session(transport.session)
+
+	def capture(self, response, *args, **kwargs):
+		try:
+			request = json.loads(response.request.body or b"{}")
+			content = response.json()
+		except ValueError:
+			return
+		with self.lock:
+			self.entries.append({
+				"query": request.get("query", ""),
+				"variables": request.get("variables") or {},
+				"response": content,
+			})
+
+	def write(self):
+		atexit.unregister(self.write)
+		with self.lock:
+			entries = list(self.entries)
+		tmp_path = f"{self.path}.tmp"
+		with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+			f.write(json.dumps(self.header) + "\n")
+			for entry in entries:
+				f.write(json.dumps(entry, default=str) + "\n")
+		os.replace(tmp_path, self.path)
+
+def read_fixture(path):
+	"""returns the header and the list of recorded requests of a fixture"""
+	with gzip.open(path, "rt", encoding="utf-8") as f:
+		header = json.loads(f.readline())
+		if header.get("version") != FIXTURE_VERSION:
+			raise ValueError(f"{path} is fixture version {header.get('version')}, expected {FIXTURE_VERSION}")
+		return header, [json.loads(line) for line in f if line.strip()]
+
+def scaled_id(value, copy_number):
+	if not copy_number:
+		return value
+	if isinstance(value, int):
+		return value + copy_number * ID_STRIDE
+	if isinstance(value, str) and value.isdigit():
+		return str(int(value) + copy_number * ID_STRIDE)
+	return value
+
+def base_id(value):
+	"""the recorded id and copy number of a scaled id"""
+	number = int(value)
+	return type(value)(number % ID_STRIDE), number // ID_STRIDE
+
+def with_id(entity, copy_number):
+	if not copy_number:
+		return entity
+	entity = dict(entity)
+	entity["id"] = scaled_id(entity["id"], copy_number)
+	return entity
+
+def is_entity_list(value):
+	return bool(value) and isinstance(value, list) and all(isinstance(v, dict) and "id" in v for v in value)
+
+def is_group_list(value):
+	return bool(value) and isinstance(value, list) and all(is_entity_list(v) for v in value)
+
+def scale_data(data, scale):
+	"""copies of every list of entities (or of groups of entities) with shifted ids, counts scaled to match"""
+	if scale <= 1:
+		return data
+	if isinstance(data, dict):
+		scaled = {key: scale_data(value, scale) for key, value in data.items()}
+		if isinstance(scaled.get("count"), int) and any(is_entity_list(v) or is_group_list(v) for v in data.values()):
+			scaled["count"] = data["count"] * scale
+		return scaled
+	if is_group_list(data):
+		return [[with_id(e, n) for e in group] for n in range(scale) for group in data]
+	if is_entity_list(data):
+		return [with_id(e, n) for n in range(scale) for e in data]
+	if isinstance(data, list):
+		return [scale_data(v, scale) for v in data]
+	return data
+
+def empty_lists(data):
+	"""the same response with every list of entities emptied, the answer for a page past the recorded ones"""
+	if isinstance(data, dict):
+		return {key: empty_lists(value) for key, value in data.items()}
+	if isinstance(data, list) and (is_entity_list(data) or is_group_list(data)):
+		return []
+	return data
+
+class ReplayResolver:
+	"""answers requests for a StandInServer from a recorded fixture, the same way every time
+
+	a request recorded more than once gets its recorded responses in order, the last one after
+	that, with scale > 1 lists of scenes, performers and duplicate groups are answered with
+	scale copies of every entity with shifted ids, scenes requested by id (scene_ids) are
+	answered from every scene seen in the fixture, mutations that were not recorded get the
+	recorded answer of the same operation
+
+	sql responses are replayed as recorded and never scaled, their rows have no common shape
+	and tasks page through them with the last id of a page, so a task that reads its work with
+	sql (exact matching, local matching, cleanup, the oshash split) runs at the recorded size
+	whatever the scale, `unscaled` counts the sql responses served
+	"""
+
+	def __init__(self, path, scale=1):
+		self.header, entries = read_fixture(path)
+		self.scale = max(1, int(scale))
+		self.responses = defaultdict(list)
+		self.by_query = {}
+		self.by_operation = {}
+		self.scenes = {}
+		self.served = defaultdict(int)
+		self.unscaled = 0
+		self.lock = threading.Lock()
+		for entry in entries:
+			key = request_key(entry["query"], entry["variables"])
+			self.responses[key].append(entry["response"])
+			self.by_query.setdefault(key[0], entry["response"])
+			if (operation := OPERATION.match(entry["query"])) and operation.group(2):
+				self.by_operation.setdefault(operation.group(2), entry["response"])
+			self.index_scenes(entry["response"].get("data"))
+
+	def __repr__(self) -> str:
+		return f"<ReplayResolver ({len(self.responses)} requests, {len(self.scenes)} scenes, x{self.scale})>"
+
+	def index_scenes(self, data):
+		"""keeps every scene of a response, merging the fields requested by different queries"""
+		if isinstance(data, dict):
+			for key, value in data.items():
+				if key in ("scenes", "findDuplicateScenes") and (is_entity_list(value) or is_group_list(value)):
+					for scene in (s for group in value for s in group) if is_group_list(value) else value:
+						self.scenes.setdefault(str(scene["id"]), {}).update(scene)
+				else:
+					self.index_scenes(value)
+		elif isinstance(data, list):
+			for value in data:
+				self.index_scenes(value)
+
+	def __call__(self, query, variables):
+		key = request_key(query, variables)
+		operation = OPERATION.match(query)
+		kind, name = (operation.group(1), operation.group(2)) if operation else ("query", "")
+
+		if "scene_ids" in variables and (self.scale > 1 or key not in self.responses):
+			return self.find_scenes_by_ids(query, variables["scene_ids"])
+		if responses := self.responses.get(key):
+			with self.lock:
+				served = self.served[key]
+				self.served[key] += 1
+			response = responses[min(served, len(responses) - 1)]
+			if response.get("errors"):
+				raise Exception("; ".join(e.get("message", "") for e in response["errors"]))
+			if "querySQL" in (response.get("data") or {}):
+				with self.lock:
+					self.unscaled += 1
+				return response["data"]
+			return scale_data(response["data"], self.scale)
+		if "querySQL" in query:
+			# sql runs against the recorded library, other statements or arguments find nothing
+			return {"querySQL": {"columns": [], "rows": []}}
+		if kind == "mutation" and name in self.by_operation:
+			return self.by_operation[name].get("data")
+		if key[0] in self.by_query:
+			# the same query with other variables, a page past the last recorded page
+			return empty_lists(self.by_query[key[0]].get("data"))
+		return self.builtin(query, name)
+
+	def find_scenes_by_ids(self, query, scene_ids):
+		scenes = []
+		for scene_id in scene_ids:
+			recorded_id, copy_number = base_id(scene_id)
+			if (scene := self.scenes.get(str(recorded_id))) is not None:
+				scenes.append(with_id(scene, copy_number))
+		field = FIELD.findall(query.split("{", 1)[1])[0]
+		alias = field[0] or field[1]
+		return {alias: {"count": len(scenes), "scenes": scenes}}
+
+	def builtin(self, query, name):
+		"""answers for the requests StashInterface sends while connecting, which happen before recording starts"""
+		if "version" in query and "build_time" in query:
+			version = self.header.get("stash_version") or "v0.0.0"
+			return {"version": {"version": version.split("-")[0], "hash": "replay", "build_time": "1970-01-01 00:00:00"}}
+		if "apiKey" in query:
+			return {"configuration": {"general": {"apiKey": ""}}}
+		if "plugins" in query:
+			return {"configuration": {"plugins": {}}}
+		raise Exception(f"request {name or normalize_query(query)[:80]} is not in the fixture")
@@ -0,0 +1,92 @@
+import json, time, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class StandInServer:
+	"""local http server standing in for the stash graphql endpoint in tests and benchmarks
+
+	every post is answered with resolve(query, variables), which returns the data dict or raises,
+	after waiting `latency` seconds to act like a server doing real work, connections are kept
+	alive like stash keeps them so pooled and unpooled clients can be compared
+
+		with StandInServer(resolve, latency=0.002) as server:
+			stash = StashInterface({"Port": server.port})
+	"""
+
+	def __init__(self, resolve, latency=0.0, host="127.0.0.1", port=0):
+		self.resolve = resolve
+		self.latency = latency
+		self.requests = 0
+		self.connections = 0
+		self.lock = threading.Lock()
+		self.server = ThreadingHTTPServer((host, port), self.handler())
+		self.server.daemon_threads = True
+		self.thread = None
+
+	def __repr__(self) -> str:
+		return f"<StandInServer ({self.url}, {self.requests} requests)>"
+
+	def __enter__(self):
+		self.start()
+		return self
+
+	def __exit__(self, *exc):
+		self.stop()
+
+	@property
+	def host(self):
+		return self.server.server_address[0]
+
+	@property
+	def port(self):
+		return self.server.server_address[1]
+
+	@property
+	def url(self):
+		return f"http://{self.host}:{self.port}/graphql"
+
+	def start(self):
+		self.thread = threading.Thread(target=self.server.serve_forever, name="stand-in-server", daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		self.server.shutdown()
+		self.server.server_close()
+		self.thread.join()
+
+	def answer(self, body):
+		with self.lock:
+			self.requests += 1
+		if self.latency:
+			time.sleep(self.latency)
+		try:
+			request = json.loads(body)
+			return {"data": self.resolve(request["query"], request.get("variables") or {})}
+		except Exception as e:
+			return {"data": None, "errors": [{"message": str(e)}]}
+
+	def handler(self):
+		stand_in = self
+
+		class Handler(BaseHTTPRequestHandler):
+			protocol_version = "HTTP/1.1"
+			# headers and body are written separately, with nagle every response would wait for a delayed ack
+			disable_nagle_algorithm = True
+
+			def setup(self):
+				super().setup()
+				with stand_in.lock:
+					stand_in.connections += 1
+
+			def do_POST(self):
+				body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+				response = json.dumps(stand_in.answer(body)).encode("utf-8")
+				self.send_response(200)
+				self.send_header("Content-Type", "application/json")
+				self.send_header("Content-Length", str(len(response)))
+				self.end_headers()
+				self.wfile.write(response)
+
+			def log_message(self, format, *args):
+				pass
+
+		return Handler
@@ -0,0 +1,209 @@
+import json, asyncio, threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_HEADERS = {
+	"Accept-Encoding": "gzip, deflate",
+	"Content-Type": "application/json",
+	"Accept": "application/json",
+	"Connection": "keep-alive",
+}
+
+class GraphQLError(Exception):
+	"""a request stash answered with errors or without data"""
+
+	def __init__(self, errors, status=None):
+		self.errors = errors
+		self.status = status
+		messages = "; ".join(str(e.get("message", e)) for e in errors) if errors else "no data in response"
+		super().__init__(f"{status} {messages}" if status else messages)
+
+class AsyncTransport:
+	"""sends GraphQL requests to stash concurrently over one pool of keep-alive connections
+
+	requests run on up to `concurrency` worker threads sharing one requests session, whose
+	connection pool keeps as many connections open, coordinated by an asyncio loop on a
+	background thread so plugins can keep calling it from plain synchronous code
+
+	identical queries that are in flight at the same time are sent once and share the response,
+	mutations queued with mutate() within `batch_window` seconds of each other are sent as one
+	document of aliased fields, up to `batch_size` per request
+	"""
+
+	def __init__(self, stash=None, url=None, concurrency=8, batch_size=50, batch_window=0.005, verify=True):
+		self.concurrency = max(1, int(concurrency))
+		self.batch_size = max(1, int(batch_size))
+		self.batch_window = batch_window
+
+		self.session = requests.Session()
+		self.session.headers.update(DEFAULT_HEADERS)
+		self.session.verify = verify
+		if stash is not None:
+			# same endpoint and credentials as the StashInterface, but not its session which is not shared across threads
+			url = url or stash.url
+			self.session.headers.update(stash.s.headers)
+			self.session.cookies.update(stash.s.cookies)
+			self.session.verify = stash.s.verify
+		if not url:
+			raise ValueError("AsyncTransport needs a StashInterface or the url of the graphql endpoint")
+		self.url = url
+		adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency, pool_block=True)
+		self.session.mount("http://", adapter)
+		self.session.mount("https://", adapter)
+
+		self.stats = {"requests": 0, "coalesced": 0, "mutations": 0, "mutation_requests": 0, "bytes_sent": 0, "bytes_received": 0}
+		self._stats_lock = threading.Lock()
+		self._in_flight = {}
+		self._mutations = []
+		self._flush_handle = None
+		self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="transport")
+		self._loop = asyncio.new_event_loop()
+		self._thread = threading.Thread(target=self._loop.run_forever, name="transport-loop", daemon=True)
+		self._thread.start()
+
+	def __repr__(self) -> str:
+		return f"<AsyncTransport ({self.url}, {self.concurrency} connections)>"
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def _post(self, payload):
+		"""sends one request from a worker thread, returns the decoded response"""
+		body = json.dumps(payload, default=str).encode("utf-8")
+		response = self.session.post(self.url, data=body)
+		with self._stats_lock:
+			self.stats["requests"] += 1
+			self.stats["bytes_sent"] += len(body)
+			self.stats["bytes_received"] += len(response.content)
+		try:
+			content = response.json()
+		except ValueError:
+			content = {}
+		if response.status_code != 200 or content.get("data") is None:
+			raise GraphQLError(content.get("errors"), f"{response.status_code} {response.reason}")
+		return content
+
+	async def _send(self, query, variables):
+		payload = {"query": query}
+		if variables:
+			payload["variables"] = variables
+		return await self._loop.run_in_executor(self._executor, self._post, payload)
+
+	async def query(self, query, variables=None):
+		"""data of one query, identical queries already in flight are not sent again"""
+		key = (query, json.dumps(variables, sort_keys=True, default=str))
+		task = self._in_flight.get(key)
+		if task is None:
+			task = self._in_flight[key] = self._loop.create_task(self._send(query, variables))
+			task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+		else:
+			self.stats["coalesced"] += 1
+		content = await asyncio.shield(task)
+		if content.get("errors"):
+			raise GraphQLError(content["errors"])
+		return content["data"]
+
+	async def mutate(self, field, input, input_type, selection="id"):
+		"""result of one `field(input: $input)` mutation, sent in a batch with the mutations queued next to it"""
+		future = self._loop.create_future()
+		self._mutations.append((field, input, input_type, selection, future))
+		if len(self._mutations) >= self.batch_size:
+			self._flush_mutations()
+		elif self._flush_handle is None:
+			self._flush_handle = self._loop.call_later(self.batch_window, self._flush_mutations)
+		return await future
+
+	def _flush_mutations(self):
+		if self._flush_handle is not None:
+			self._flush_handle.cancel()
+			self._flush_handle = None
+		while self._mutations:
+			batch, self._mutations = self._mutations[:self.batch_size], self._mutations[self.batch_size:]
+			self._loop.create_task(self._send_mutations(batch))
+
+	async def _send_mutations(self, batch):
+		variables = ", ".join(f"$input{n}: {input_type}" for n, (_, _, input_type, _, _) in enumerate(batch))
+		fields = "\n".join(
+			f"\tm{n}: {field}(input: $input{n}) {{ {selection} }}"
+			for n, (field, _, _, selection, _) in enumerate(batch)
+		)
+		query = f"mutation Batch({variables}) {{\n{fields}\n}}"
+		self.stats["mutation_requests"] += 1
+		try:
+			content = await self._send(query, {f"input{n}": input for n, (_, input, _, _, _) in enumerate(batch)})
+		except Exception as e:
+			for *_, future in batch:
+				if not future.done():
+					future.set_exception(e)
+			return
+		self.stats["mutations"] += len(batch)
+		# an error only fails the mutation whose alias is at the start of its path
+		errors = {}
+		for error in content.get("errors") or []:
+			path = error.get("path") or [None]
+			errors.setdefault(path[0], []).append(error)
+		for n, (*_, future) in enumerate(batch):
+			alias = f"m{n}"
+			if future.done():
+				continue
+			if alias in errors or (None in errors and content["data"].get(alias) is None):
+				future.set_exception(GraphQLError(errors.get(alias) or errors[None]))
+			else:
+				future.set_result(content["data"].get(alias))
+
+	def submit(self, query, variables=None):
+		"""starts a query from synchronous code, returns a concurrent.futures.Future of its data"""
+		return asyncio.run_coroutine_threadsafe(self.query(query, variables), self._loop)
+
+	def submit_mutation(self, field, input, input_type, selection="id"):
+		return asyncio.run_coroutine_threadsafe(self.mutate(field, input, input_type, selection), self._loop)
+
+	def call(self, query, variables=None):
+		return self.submit(query, variables).result()
+
+	def stream(self, calls, ahead=None):
+		"""yields the data of every (query, variables) in order, with up to `ahead` of them in flight"""
+		ahead = ahead or self.concurrency
+		pending = deque()
+		for query, variables in calls:
+			pending.append(self.submit(query, variables))
+			if len(pending) >= ahead:
+				yield pending.popleft().result()
+		while pending:
+			yield pending.popleft().result()
+
+	def stream_mutations(self, mutations, ahead=None):
+		"""yields the result of every (field, input, input_type) mutation in order, with up to `ahead` of them in flight"""
+		ahead = ahead or self.concurrency
+		pending = deque()
+		for field, input, input_type in mutations:
+			pending.append(self.submit_mutation(field, input, input_type))
+			if len(pending) >= ahead:
+				yield pending.popleft().result()
+		self.flush()
+		while pending:
+			yield pending.popleft().result()
+
+	def flush(self):
+		"""sends mutations still waiting for their batch window"""
+		self._loop.call_soon_threadsafe(self._flush_mutations)
+
+	def close(self):
+		if not self._loop.is_running():
+			return
+		async def drain():
+			self._flush_mutations()
+			tasks = [t for t in asyncio.all_tasks(self._loop) if t is not asyncio.current_task()]
+			await asyncio.gather(*tasks, return_exceptions=True)
+		asyncio.run_coroutine_threadsafe(drain(), self._loop).result()
+		self._loop.call_soon_threadsafe(self._loop.stop)
+		self._thread.join()
+		self._loop.close()
+		self._executor.shutdown()
+		self.session.close()